@@ -0,0 +1,317 @@
+# Copyright (C) 2026 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+"""A stand-in for the Agent in the guest, for tests and benchmarks of the
+installer and snapshot pipeline without a Windows VM.
+
+    with FakeAgent(latency=0.01) as fa:
+        fa.respond("wusa.exe", {"exit_code": 3010})
+        a = Agent(fa.ipaddr, fa.port)
+        ...
+
+Files that are stored or extracted are kept in memory, in fa.files. Every
+executed command is appended to fa.commands. Commands without a scripted
+response succeed with no output. 'shutdown -r' reboots the fake agent: the
+port closes for 'downtime' seconds and comes back up.
+"""
+
+import hashlib
+import io
+import json
+import ntpath
+import re
+import socket
+import threading
+import time
+import urllib.parse
+import zipfile
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_ENVIRON = {
+    "COMPUTERNAME": "FAKEAGENT",
+    "SYSTEMDRIVE": "C:",
+    "SYSTEMROOT": "C:\\Windows",
+    "TEMP": "C:\\Users\\user\\AppData\\Local\\Temp",
+    "USERPROFILE": "C:\\Users\\user",
+}
+
+def _parse_form(content_type, body):
+    """Return the fields of a urlencoded or multipart/form-data body as a
+    dict of name to str, or bytes for files."""
+    if not content_type.startswith("multipart/"):
+        return {
+            k: v[0] for k, v in urllib.parse.parse_qs(body.decode()).items()
+        }
+
+    msg = BytesParser().parsebytes(
+        b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body
+    )
+    fields = {}
+    for part in msg.get_payload():
+        name = part.get_param("name", header="content-disposition")
+        value = part.get_payload(decode=True)
+        if part.get_filename() is None:
+            value = value.decode()
+        fields[name] = value
+    return fields
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.fake.connections.add(self.connection)
+
+    def finish(self):
+        super().finish()
+        self.server.fake.connections.discard(self.connection)
+
+    def _reply(self, status, body, content_type="application/json"):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, fields):
+        fake = self.server.fake
+        fake.requests.append((self.command, self.path, fields))
+        if fake.latency:
+            time.sleep(fake.latency)
+
+        handler = getattr(fake, "_do_" + self.path.strip("/"), None)
+        if not handler:
+            return self._reply(404, {"message": "Not found"})
+
+        status, body = handler(fields)
+        if isinstance(body, bytes):
+            self._reply(status, body, "application/octet-stream")
+        else:
+            self._reply(status, body)
+
+    def do_GET(self):
+        self._handle({})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length)
+        self._handle(_parse_form(self.headers.get("Content-Type", ""), body))
+
+class FakeAgent(object):
+    """Serves the Agent API on 127.0.0.1. 'latency' is the amount of
+    seconds each request takes. 'downtime' is the amount of seconds the
+    agent is unreachable during a reboot."""
+
+    def __init__(self, port=0, latency=0, downtime=0.5, environ=None):
+        self.latency = latency
+        self.downtime = downtime
+        self.environ = dict(environ or DEFAULT_ENVIRON)
+        self.ipaddr = "127.0.0.1"
+        self.port = port
+        self.files = {}
+        self.commands = []
+        self.requests = []
+        self.connections = set()
+        self.boots = 0
+        self.up = threading.Event()
+        self._responses = []
+        self._server = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        """Start serving. Also used to come back up after a reboot."""
+        server = ThreadingHTTPServer((self.ipaddr, self.port), _Handler)
+        server.fake = self
+        self.port = server.server_port
+        self._server = server
+        self.boots += 1
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.up.set()
+
+    def stop(self):
+        """Stop serving and drop all connections, like a guest that powers
+        off."""
+        with self._lock:
+            server, self._server = self._server, None
+        if not server:
+            return
+
+        self.up.clear()
+        server.shutdown()
+        server.server_close()
+        for conn in list(self.connections):
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def reboot(self, downtime=None, delay=0):
+        """Go down after 'delay' seconds, stay down for 'downtime' seconds
+        and come back up on the same port. Returns right away."""
+        downtime = self.downtime if downtime is None else downtime
+
+        def _reboot():
+            time.sleep(delay)
+            self.stop()
+            time.sleep(downtime)
+            self.start()
+
+        threading.Thread(target=_reboot, daemon=True).start()
+
+    def respond(self, pattern, response, times=None):
+        """Reply to executed commands that match the regex pattern with the
+        response. This is a dict with any of exit_code, stdout, stderr and
+        duration (seconds the command takes), or a callable that is given
+        the command and returns such a dict. With times, the response is
+        only used that many times. Later responses take precedence."""
+        self._responses.insert(0, [re.compile(pattern, re.I), response, times])
+
+    def read(self, path):
+        """Return the contents of a file in the guest, or None."""
+        return self.files.get(ntpath.normcase(path))
+
+    def _run(self, command):
+        self.commands.append(command)
+        with self._lock:
+            for entry in self._responses:
+                pattern, response, times = entry
+                if not pattern.search(command):
+                    continue
+                if times is not None:
+                    if times <= 0:
+                        continue
+                    entry[2] -= 1
+                break
+            else:
+                response = self._builtin(command)
+
+        if callable(response):
+            response = response(command)
+        response = dict(response)
+        time.sleep(response.pop("duration", 0))
+        return {
+            "message": "Successfully executed command",
+            "exit_code": response.get("exit_code", 0),
+            "stdout": response.get("stdout", ""),
+            "stderr": response.get("stderr", ""),
+        }
+
+    def _builtin(self, command):
+        shutdown = re.match(
+            r"shutdown\s+[-/]([rs])(?:.*[-/]t\s+(\d+))?", command, re.I
+        )
+        if shutdown and shutdown.group(1).lower() == "r":
+            self.reboot(delay=int(shutdown.group(2) or 0))
+        elif shutdown:
+            threading.Timer(
+                int(shutdown.group(2) or 0), self.stop
+            ).start()
+
+        hashfile = re.match(r"certutil -hashfile \"?(.+?)\"? SHA1", command)
+        if hashfile:
+            data = self.read(hashfile.group(1))
+            if data is None:
+                return {"exit_code": 1, "stdout": "CertUtil: -hashfile FAILED"}
+            return {"stdout": (
+                f"SHA1 hash of {hashfile.group(1)}:\r\n"
+                f"{hashlib.sha1(data).hexdigest()}\r\n"
+                "CertUtil: -hashfile command completed successfully.\r\n"
+            )}
+        return {}
+
+    def _do_(self, fields):
+        return 200, {
+            "message": "Cuckoo Agent!", "version": "0.10",
+            "features": ["execpy", "pinning", "logs", "largefile"],
+        }
+
+    def _do_environ(self, fields):
+        return 200, {
+            "message": "Environment variables", "environ": self.environ
+        }
+
+    def _do_execute(self, fields):
+        if "command" not in fields:
+            return 400, {"message": "No command has been provided"}
+
+        if "async" in fields:
+            # Run after the reply, as an async command on the agent does.
+            threading.Thread(
+                target=self._run, args=(fields["command"],), daemon=True
+            ).start()
+            return 200, {"message": "Successfully executed command"}
+        return 200, self._run(fields["command"])
+
+    def _do_execpy(self, fields):
+        if "filepath" not in fields:
+            return 400, {"message": "No Python file has been provided"}
+        return 200, self._run(f"python {fields['filepath']}")
+
+    def _do_store(self, fields):
+        if "file" not in fields or "filepath" not in fields:
+            return 400, {"message": "No file has been provided"}
+
+        self.files[ntpath.normcase(fields["filepath"])] = fields["file"]
+        return 200, {"message": "Successfully stored file"}
+
+    def _do_retrieve(self, fields):
+        data = self.read(fields.get("filepath", ""))
+        if data is None:
+            return 404, {"message": "File not found"}
+        return 200, data
+
+    def _do_remove(self, fields):
+        path = ntpath.normcase(fields.get("path", "")).rstrip("\\")
+        removed = [
+            p for p in self.files if p == path or p.startswith(path + "\\")
+        ]
+        if not removed:
+            return 404, {"message": "Path provided does not exist"}
+
+        for p in removed:
+            del self.files[p]
+        return 200, {"message": "Successfully deleted file"}
+
+    def _do_extract(self, fields):
+        if "zipfile" not in fields or "dirpath" not in fields:
+            return 400, {"message": "No zip file has been provided"}
+
+        with zipfile.ZipFile(io.BytesIO(fields["zipfile"])) as z:
+            for name in z.namelist():
+                if name.endswith("/"):
+                    continue
+                path = ntpath.join(fields["dirpath"], name)
+                self.files[ntpath.normcase(path)] = z.read(name)
+        return 200, {"message": "Successfully extracted zip file"}
+
+    def _do_kill(self, fields):
+        threading.Thread(target=self.stop, daemon=True).start()
+        return 200, {"message": "Quit the Cuckoo Agent"}
+
+if __name__ == "__main__":
+    import sys
+
+    # Serve on a fixed port to benchmark against: fakeagent.py [port] [latency]
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0
+    with FakeAgent(port=port, latency=latency) as fa:
+        print(f"Fake agent listening on {fa.ipaddr}:{fa.port}")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
@@ -2,6 +2,18 @@
 # This file is part of VMCloak - http://www.vmcloak.org/.
 # See the file 'docs/LICENSE.txt' for copying permission.
 
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import zipfile
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
 from vmcloak.agent import Agent
 
 class TestAgent(object):
@@ -15,3 +27,293 @@ class TestAgent(object):
         self.a.postfile = none
         self.a.upload("/tmp/hello", "contents")
         self.a.upload("/tmp/hello", "contents")
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    fail_next = 0
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, body):
+        self.server.peers.add(self.client_address)
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.gets.append(self.path)
+        if self.server.fail_next:
+            self.server.fail_next -= 1
+            # Close without a response, like an agent that went away.
+            self.close_connection = True
+            return
+        self._reply(b'{"environ": {"COMPUTERNAME": "vm1"}}')
+
+    def do_POST(self):
+        length = int(self.headers["Content-Length"])
+        self.server.bodies.append(self.rfile.read(length))
+        self.server.content_types.append(self.headers["Content-Type"])
+        if self.path == "/retrieve":
+            self._reply(self.server.retrieve_data)
+        else:
+            self._reply(b'{"exit_code": 0}')
+
+def _serve():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    server.peers = set()
+    server.bodies = []
+    server.content_types = []
+    server.gets = []
+    server.fail_next = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def test_keepalive_session():
+    server = _serve()
+    a = Agent("127.0.0.1", server.server_port)
+    for _ in range(5):
+        assert a.environ("COMPUTERNAME") == "vm1"
+        assert a.execute("echo hi")["exit_code"] == 0
+    assert len(server.peers) == 1
+
+    # Changing the address must not reuse the old connections.
+    a.ipaddr = "localhost"
+    a.ipaddr = "127.0.0.1"
+    a.environ()
+    assert len(server.peers) == 2
+    server.shutdown()
+
+def test_retry_idempotent():
+    server = _serve()
+    a = Agent("127.0.0.1", server.server_port, backoff=0.01)
+    server.fail_next = 2
+    assert a.environ("COMPUTERNAME") == "vm1"
+
+    server.fail_next = 1
+    with pytest.raises(requests.ConnectionError):
+        a.get("/environ", idempotent=False)
+    server.shutdown()
+
+def test_retry_rewinds_upload(monkeypatch):
+    server = _serve()
+    a = Agent("127.0.0.1", server.server_port, backoff=0.01)
+    real_request = requests.Session.request
+    calls = []
+
+    def flaky_request(self, *args, **kwargs):
+        calls.append(args)
+        if len(calls) == 1:
+            # Consume the upload as a failed attempt would.
+            kwargs["files"]["file"].read()
+            raise requests.ConnectionError("reset")
+        return real_request(self, *args, **kwargs)
+
+    monkeypatch.setattr(requests.Session, "request", flaky_request)
+    a.upload("C:\\hello.txt", "contents")
+    assert len(calls) == 2
+    assert b"contents" in server.bodies[-1]
+    server.shutdown()
+
+def _parse_multipart(content_type, body):
+    msg = BytesParser().parsebytes(
+        b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body
+    )
+    return {
+        part.get_param("name", header="content-disposition"):
+            part.get_payload(decode=True)
+        for part in msg.get_payload()
+    }
+
+def test_upload_from_streams():
+    server = _serve()
+    a = Agent("127.0.0.1", server.server_port)
+    data = os.urandom(3 * 1024 * 1024 + 5)
+    path = os.path.join(tempfile.mkdtemp(), "installer.exe")
+    with open(path, "wb") as fp:
+        fp.write(data)
+
+    progress = []
+    sha1 = a.upload_from(
+        "C:\\installer.exe", path,
+        progress=lambda done, total: progress.append((done, total))
+    )
+    assert sha1 == hashlib.sha1(data).hexdigest()
+    assert progress[-1] == (len(data), len(data))
+
+    fields = _parse_multipart(server.content_types[-1], server.bodies[-1])
+    assert fields["filepath"] == b"C:\\installer.exe"
+    assert fields["file"] == data
+
+    # File objects are streamed from their current position.
+    fp = io.BytesIO(b"skipcontents")
+    fp.seek(4)
+    a.upload("C:\\hello.txt", fp)
+    fields = _parse_multipart(server.content_types[-1], server.bodies[-1])
+    assert fields["file"] == b"contents"
+    server.shutdown()
+
+def test_retrieve_to():
+    server = _serve()
+    server.retrieve_data = os.urandom(2 * 1024 * 1024)
+    a = Agent("127.0.0.1", server.server_port)
+    path = os.path.join(tempfile.mkdtemp(), "ntoskrnl.exe")
+
+    size, sha1 = a.retrieve_to("C:\\Windows\\ntoskrnl.exe", path)
+    assert size == len(server.retrieve_data)
+    assert sha1 == hashlib.sha1(server.retrieve_data).hexdigest()
+    with open(path, "rb") as fp:
+        assert fp.read() == server.retrieve_data
+    assert a.retrieve("C:\\Windows\\ntoskrnl.exe") == server.retrieve_data
+    server.shutdown()
+
+def test_execute_many(monkeypatch):
+    a = Agent("localhost", 8000)
+    uploaded = {}
+    posted = []
+
+    class Response(object):
+        def json(self):
+            return {"stdout": "\r\n".join([
+                "@@vmcloak-batch@@ begin 0",
+                "The operation completed successfully.",
+                "@@vmcloak-batch@@ end 0 0",
+                "@@vmcloak-batch@@ begin 1",
+                "ERROR: The system was unable to find the specified key.",
+                "@@vmcloak-batch@@ end 1 1",
+            ])}
+
+    monkeypatch.setattr(
+        a, "upload", lambda path, contents: uploaded.update({path: contents})
+    )
+    monkeypatch.setattr(
+        a, "post", lambda method, **kw: posted.append(method) or Response()
+    )
+
+    results = a.execute_many([
+        "reg add HKCU\\Software\\Test /v A /d 100% /f",
+        "reg delete HKCU\\Software\\Missing /f",
+        "echo never",
+    ], stop_on_error=True)
+
+    (path, script), = uploaded.items()
+    assert path.endswith(".bat") and posted == ["/execute"]
+    assert "(reg add HKCU\\Software\\Test /v A /d 100%% /f) 2>&1\r\n" \
+        in script
+    assert 'if not "%ERRORLEVEL%"=="0" goto done' in script
+    assert script.endswith(':done\r\n(goto) 2>nul & del "%~f0"\r\n')
+    assert [r["exit_code"] for r in results] == [0, 1, None]
+    assert results[0]["output"] == "The operation completed successfully."
+    assert "unable to find" in results[1]["output"]
+    assert results[2]["output"] == ""
+
+def test_execute_many_no_newline(monkeypatch):
+    a = Agent("localhost", 8000)
+
+    class Response(object):
+        def json(self):
+            return {"stdout": "\r\n".join([
+                "@@vmcloak-batch@@ begin 0",
+                "no newline@@vmcloak-batch@@ end 0 0",
+                "@@vmcloak-batch@@ begin 1",
+                "first",
+                "second@@vmcloak-batch@@ end 1 2",
+            ])}
+
+    monkeypatch.setattr(a, "upload", lambda path, contents: None)
+    monkeypatch.setattr(a, "post", lambda method, **kw: Response())
+
+    results = a.execute_many(["set /p=no newline<nul", "type lines.txt"])
+    assert [r["exit_code"] for r in results] == [0, 2]
+    assert results[0]["output"] == "no newline"
+    assert results[1]["output"] == "first\nsecond"
+
+def test_environ_cache():
+    server = _serve()
+    a = Agent("127.0.0.1", server.server_port)
+    assert a.environ("COMPUTERNAME") == "vm1"
+    assert a.environ("USERPROFILE", "C:\\Users\\user") == "C:\\Users\\user"
+    a.environ()["COMPUTERNAME"] = "changed"
+    assert a.environ("COMPUTERNAME") == "vm1"
+    assert server.gets.count("/environ") == 1
+
+    # A reboot or address change means a new Agent process.
+    a.reboot()
+    a.environ()
+    a.ipaddr = "localhost"
+    a.environ()
+    assert server.gets.count("/environ") == 3
+    server.shutdown()
+
+def test_upload_bundle():
+    server = _serve()
+    a = Agent("127.0.0.1", server.server_port)
+    dirpath = tempfile.mkdtemp()
+    path = os.path.join(dirpath, "setup.msu")
+    data = os.urandom(1024 * 1024)
+    with open(path, "wb") as fp:
+        fp.write(data)
+
+    paths = a.upload_bundle("C:\\vmcloak\\certs\\", {
+        "setup.msu": path,
+        "certs\\root.der": io.BytesIO(b"A" * 4096),
+    })
+    assert paths == [
+        "C:\\vmcloak\\certs\\setup.msu", "C:\\vmcloak\\certs\\certs\\root.der"
+    ]
+    assert len(server.bodies) == 1
+
+    fields = _parse_multipart(server.content_types[-1], server.bodies[-1])
+    assert fields["dirpath"] == b"C:\\vmcloak\\certs\\"
+    with zipfile.ZipFile(io.BytesIO(fields["zipfile"])) as z:
+        assert z.read("setup.msu") == data
+        assert z.read("certs/root.der") == b"A" * 4096
+        # Compressed packages are stored, other files deflated.
+        assert z.getinfo("setup.msu").compress_type == zipfile.ZIP_STORED
+        assert z.getinfo("certs/root.der").compress_type == \
+            zipfile.ZIP_DEFLATED
+    server.shutdown()
+
+def test_hostname_live(monkeypatch):
+    a = Agent("localhost", 8000)
+    commands = []
+    monkeypatch.setattr(a, "environ", lambda value: "template")
+    monkeypatch.setattr(a, "execute", commands.append)
+
+    a.hostname("vm7", live=True)
+    assert 'name="template" call rename name="vm7"' in commands[0]
+    assert any("ActiveComputerName" in c and "/d vm7" in c for c in commands)
+    assert any("Tcpip" in c and "/d vm7" in c for c in commands)
+
+def test_static_ip_checks_mac(monkeypatch):
+    a = Agent("localhost", 8000)
+    uploaded = {}
+    getmac = (
+        '"Ethernet","Intel(R) PRO/1000 MT","52-54-00-AB-CD-EF",'
+        '"\\Device\\Tcpip_{GUID}"\r\n'
+    )
+    monkeypatch.setattr(
+        a, "upload", lambda path, contents: uploaded.update({path: contents})
+    )
+    monkeypatch.setattr(a, "request", lambda *args, **kw: None)
+    monkeypatch.setattr(a, "remove", lambda path: None)
+    monkeypatch.setattr(a, "execute", lambda cmd: {"stdout": getmac})
+    monkeypatch.setattr(
+        "vmcloak.agent.wait_for_agent", lambda agent: None
+    )
+
+    a.static_ip(
+        "192.168.30.20", "255.255.255.0", "192.168.30.1", "Ethernet",
+        mac="52:54:00:ab:cd:ef"
+    )
+    assert a.ipaddr == "192.168.30.20"
+    script, = uploaded.values()
+    assert '-Value "525400ABCDEF"' in script
+
+    # The NIC still uses the MAC address of the template.
+    with pytest.raises(IOError):
+        a.static_ip(
+            "192.168.30.21", "255.255.255.0", "192.168.30.1", "Ethernet",
+            mac="52:54:00:ab:cd:00"
+        )
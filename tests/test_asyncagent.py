@@ -0,0 +1,111 @@
+# Copyright (C) 2026 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import asyncio
+import hashlib
+import io
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from vmcloak.asyncagent import AsyncAgent, wait_for_agents
+
+from fakeagent import FakeAgent
+
+def _closed_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def test_async_agent():
+    fakes = [FakeAgent().__enter__() for _ in range(3)]
+    agents = [AsyncAgent(fa.ipaddr, fa.port) for fa in fakes]
+    down = AsyncAgent("127.0.0.1", _closed_port())
+    data = os.urandom(3 * 1024 * 1024 + 5)
+    fakes[2].respond("vmcloak_batch", {"stdout": "\r\n".join([
+        "@@vmcloak-batch@@ begin 0", "a", "@@vmcloak-batch@@ end 0 0",
+        "@@vmcloak-batch@@ begin 1", "b", "@@vmcloak-batch@@ end 1 1",
+    ])})
+
+    async def run():
+        ready = await wait_for_agents(agents + [down], timeout=1)
+        environs = await asyncio.gather(
+            *(a.environ("COMPUTERNAME") for a in agents)
+        )
+        executed = await agents[0].execute("echo hi")
+        sha1 = await agents[1].upload_from("C:\\a.bin", io.BytesIO(data))
+        retrieved = await agents[1].retrieve_to("C:\\a.bin", io.BytesIO())
+        results = await agents[2].execute_many(["echo a", "echo b"])
+        return ready, environs, executed, sha1, retrieved, results
+
+    ready, environs, executed, sha1, retrieved, results = asyncio.run(run())
+    assert all(ready[a] is not None for a in agents)
+    assert ready[down] is None
+    assert environs == ["FAKEAGENT"] * 3
+    assert executed["exit_code"] == 0
+    assert sha1 == hashlib.sha1(data).hexdigest()
+    assert retrieved == (len(data), sha1)
+    assert [r["output"] for r in results] == ["a", "b"]
+    assert [r["exit_code"] for r in results] == [0, 1]
+    for fa in fakes:
+        fa.stop()
+
+def test_concurrent_long_commands():
+    fakes = [FakeAgent().__enter__() for _ in range(20)]
+    agents = []
+    for fa in fakes:
+        fa.respond("setup.exe", {"duration": 0.5})
+        agents.append(AsyncAgent(fa.ipaddr, fa.port))
+
+    async def run():
+        return await asyncio.gather(*(
+            a.execute(f"setup.exe /q {i}") for a in agents for i in range(4)
+        ))
+
+    # No thread pool limits how many commands run at the same time.
+    start = time.monotonic()
+    results = asyncio.run(run())
+    assert time.monotonic() - start < 2
+    assert [r["exit_code"] for r in results] == [0] * 80
+    stopping = [threading.Thread(target=fa.stop) for fa in fakes]
+    for t in stopping:
+        t.start()
+    for t in stopping:
+        t.join()
+
+def test_connections_per_agent():
+    with FakeAgent() as fa:
+        fa.respond("setup.exe", {"duration": 0.2})
+        a = AsyncAgent(fa.ipaddr, fa.port, max_connections=2)
+
+        async def run():
+            await asyncio.gather(
+                *(a.execute(f"setup.exe /q {i}") for i in range(6))
+            )
+            await a.environ()
+
+        asyncio.run(run())
+        # The idle keep-alive connections are reused.
+        assert len(a._idle) == 2
+        assert len(fa.commands) == 6
+
+def test_read_timeout():
+    with FakeAgent() as fa:
+        fa.respond("setup.exe", {"duration": 1.5})
+
+        async def run(a):
+            return await a.execute("setup.exe /q")
+
+        # There is no read timeout by default.
+        a = AsyncAgent(fa.ipaddr, fa.port)
+        assert asyncio.run(run(a))["exit_code"] == 0
+
+        a = AsyncAgent(fa.ipaddr, fa.port, read_timeout=0.5)
+        with pytest.raises(asyncio.TimeoutError):
+            asyncio.run(run(a))
@@ -0,0 +1,177 @@
+# Copyright (C) 2026 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import hashlib
+import os
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import vmcloak.abstract
+from vmcloak import depcache
+from vmcloak.abstract import fetch_downloadable
+from vmcloak.depcache import (
+    HashIndex, file_status, open_artifact_cache, DirectoryCache
+)
+from vmcloak.mirrors import HostStats
+
+def test_hash_index(monkeypatch):
+    dirpath = tempfile.mkdtemp()
+    path = os.path.join(dirpath, "setup.exe")
+    with open(path, "wb") as fp:
+        fp.write(b"installer")
+    expected = hashlib.sha1(b"installer").hexdigest()
+
+    hashed = []
+    real_sha1_file = depcache.sha1_file
+    monkeypatch.setattr(
+        depcache, "sha1_file", lambda p: hashed.append(p) or real_sha1_file(p)
+    )
+
+    index = HashIndex(dirpath)
+    assert index.cached(path) is None
+    assert index.sha1(path) == expected
+    assert index.sha1(path) == expected
+    assert hashed == [path]
+
+    # A new process reads the stored index.
+    assert HashIndex(dirpath).sha1(path) == expected
+    assert HashIndex(dirpath).sha1(path, verify=True) == expected
+    assert hashed == [path, path]
+
+    # A changed file is hashed again.
+    with open(path, "ab") as fp:
+        fp.write(b"!")
+    assert index.cached(path) is None
+    assert index.sha1(path) == hashlib.sha1(b"installer!").hexdigest()
+    assert len(hashed) == 3
+
+def test_file_status():
+    dirpath = tempfile.mkdtemp()
+    path = os.path.join(dirpath, "kb.msu")
+    expected = hashlib.sha1(b"kb").hexdigest()
+    assert file_status(path, expected) == "missing"
+
+    with open(path, "wb") as fp:
+        fp.write(b"kb")
+    assert file_status(path) == "ok"
+    assert file_status(path, expected) == "unverified"
+    assert file_status(path, expected, verify=True) == "ok"
+    assert file_status(path, expected) == "ok"
+    assert file_status(path, "0" * 40) == "corrupt"
+
+class _CacheHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200 if self.path in self.server.files else 404)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        data = self.server.files.get(self.path)
+        self.send_response(200 if data is not None else 404)
+        # A truncated response closes the connection before the end.
+        self.send_header(
+            "Content-Length", str(len(data or b"") + self.server.truncate)
+        )
+        self.end_headers()
+        self.wfile.write(data or b"")
+
+    def do_PUT(self):
+        length = int(self.headers["Content-Length"])
+        self.server.files[self.path] = self.rfile.read(length)
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+def _cache_backends():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _CacheHandler)
+    server.files = {}
+    server.truncate = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    http = open_artifact_cache(f"http://127.0.0.1:{server.server_port}/")
+    return server, [
+        open_artifact_cache(f"file://{tempfile.mkdtemp()}"), http
+    ]
+
+def test_artifact_cache():
+    server, backends = _cache_backends()
+    dirpath = tempfile.mkdtemp()
+    path = os.path.join(dirpath, "setup.exe")
+    with open(path, "wb") as fp:
+        fp.write(b"installer")
+    sha1 = hashlib.sha1(b"installer").hexdigest()
+
+    for cache in backends:
+        target = os.path.join(dirpath, f"copy-{id(cache)}.exe")
+        assert not cache.fetch(sha1, target)
+        cache.publish(sha1, path)
+        assert cache.fetch(sha1, target)
+        with open(target, "rb") as fp:
+            assert fp.read() == b"installer"
+    assert list(server.files) == [f"/{sha1[:2]}/{sha1}"]
+
+    # A corrupt cache entry is not used.
+    server.files[f"/{sha1[:2]}/{sha1}"] = b"corrupt"
+    assert not backends[1].fetch(sha1, os.path.join(dirpath, "new.exe"))
+    assert not os.path.exists(os.path.join(dirpath, "new.exe"))
+
+    # A broken connection or an unreadable cache entry is a cache miss.
+    server.files[f"/{sha1[:2]}/{sha1}"] = b"installer"
+    server.truncate = 100
+    assert not backends[1].fetch(sha1, os.path.join(dirpath, "new.exe"))
+    os.remove(backends[0].path(sha1))
+    os.mkdir(backends[0].path(sha1))
+    assert not backends[0].fetch(sha1, os.path.join(dirpath, "new.exe"))
+    assert sorted(os.listdir(dirpath)) == sorted(
+        ["setup.exe"] + [f"copy-{id(cache)}.exe" for cache in backends]
+    )
+    server.shutdown()
+
+def test_directory_cache_partial_publish(monkeypatch):
+    cache = DirectoryCache(tempfile.mkdtemp())
+    path = os.path.join(tempfile.mkdtemp(), "setup.exe")
+    with open(path, "wb") as fp:
+        fp.write(b"installer")
+    sha1 = hashlib.sha1(b"installer").hexdigest()
+
+    def copyfile(src, dst):
+        with open(dst, "wb") as fp:
+            fp.write(b"inst")
+        raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr(depcache.shutil, "copyfile", copyfile)
+    cache.publish(sha1, path)
+    assert os.listdir(os.path.dirname(cache.path(sha1))) == []
+
+def test_fetch_downloadable_cache(monkeypatch):
+    cache = DirectoryCache(tempfile.mkdtemp())
+    monkeypatch.setattr(vmcloak.abstract, "artifact_cache", lambda: cache)
+    monkeypatch.setattr(vmcloak.abstract, "order_urls", lambda urls, s: urls)
+    stats = HostStats(os.path.join(tempfile.mkdtemp(), "hoststats.json"))
+    monkeypatch.setattr(vmcloak.abstract, "host_stats", lambda: stats)
+    downloads = []
+
+    def download_file(url, filepath, segments=1):
+        downloads.append(url)
+        with open(filepath, "wb") as fp:
+            fp.write(b"installer")
+        return True, hashlib.sha1(b"installer").hexdigest()
+
+    monkeypatch.setattr(vmcloak.abstract, "download_file", download_file)
+    sha1 = hashlib.sha1(b"installer").hexdigest()
+    hosts = [
+        os.path.join(tempfile.mkdtemp(), "setup.exe") for _ in range(2)
+    ]
+    urls = ["http://example/setup.exe"]
+    for filepath in hosts:
+        fetch_downloadable((filepath, urls, sha1, None))
+        with open(filepath, "rb") as fp:
+            assert fp.read() == b"installer"
+
+    # The second host took the file from the cache.
+    assert downloads == urls
+    assert os.path.isfile(cache.path(sha1))
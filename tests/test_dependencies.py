@@ -0,0 +1,60 @@
+# Copyright (C) 2026 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import base64
+from types import SimpleNamespace
+
+import pytest
+
+from vmcloak.abstract import Dependency
+from vmcloak.exceptions import CommandError
+
+class ScriptAgent(object):
+    def __init__(self, exit_code, stderr=""):
+        self.exit_code = exit_code
+        self.stderr = stderr
+        self.scripts = []
+
+    def execute(self, command, cucksync=False):
+        assert command.startswith("powershell ")
+        encoded = command.split("-EncodedCommand ", 1)[1]
+        self.scripts.append(base64.b64decode(encoded).decode("utf-16-le"))
+        return {
+            "exit_code": self.exit_code, "stdout": "", "stderr": self.stderr
+        }
+
+class WaitDependency(Dependency):
+    name = "waitdependency"
+
+    def __init__(self, h, a):
+        self.h = h
+        self.a = a
+
+def test_wait_process_in_guest():
+    a = ScriptAgent(0)
+    d = WaitDependency(SimpleNamespace(name="win7"), a)
+    d.wait_process_exit("Setup.EXE", timeout=30)
+    d.wait_process_appear("iexplore.exe")
+
+    assert len(a.scripts) == 2
+    assert "Wait-Process -Name 'Setup' -Timeout $left" in a.scripts[0]
+    assert "(30 -gt 0)" in a.scripts[0]
+    assert "Get-Process -Name 'iexplore'" in a.scripts[1]
+    assert "(0 -gt 0" in a.scripts[1]
+
+def test_wait_process_timeout():
+    d = WaitDependency(SimpleNamespace(name="win10"), ScriptAgent(3))
+    with pytest.raises(TimeoutError):
+        d.wait_process_exit("java.exe", timeout=1)
+    with pytest.raises(TimeoutError):
+        d.wait_process_appear("java.exe", timeout=1)
+
+@pytest.mark.parametrize("exit_code", [1, None])
+def test_wait_process_error(exit_code):
+    a = ScriptAgent(exit_code, stderr="powershell is not recognized")
+    d = WaitDependency(SimpleNamespace(name="win10"), a)
+    with pytest.raises(CommandError, match="powershell is not recognized"):
+        d.wait_process_exit("java.exe", timeout=1)
+    with pytest.raises(CommandError):
+        d.wait_process_appear("java.exe")
@@ -0,0 +1,83 @@
+# Copyright (C) 2026 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import io
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from vmcloak.agent import Agent
+from vmcloak.dependencies.carootcert import CaRootCert
+from vmcloak.exceptions import DependencyError
+from vmcloak.misc import wait_for_reboot
+
+from fakeagent import FakeAgent
+
+def test_fake_agent_api():
+    with FakeAgent() as fa:
+        a = Agent(fa.ipaddr, fa.port)
+        assert a.ping().json()["message"] == "Cuckoo Agent!"
+        assert a.environ("COMPUTERNAME") == "FAKEAGENT"
+
+        fa.respond("^ver$", {"stdout": "Microsoft Windows [10.0.19041]"})
+        fa.respond("wusa.exe", {"exit_code": 3010}, times=1)
+        assert "10.0" in a.execute("ver")["stdout"]
+        assert a.execute("wusa.exe C:\\setup.msu")["exit_code"] == 3010
+        assert a.execute("wusa.exe C:\\setup.msu")["exit_code"] == 0
+        assert fa.commands == ["ver"] + ["wusa.exe C:\\setup.msu"] * 2
+
+        data = os.urandom(100000)
+        a.upload_from("C:\\Temp\\data.bin", io.BytesIO(data), verify=True)
+        assert fa.read("c:\\temp\\DATA.bin") == data
+        assert a.retrieve("C:\\Temp\\data.bin") == data
+
+        paths = a.upload_bundle("C:\\Temp\\bundle", {
+            "a.txt": io.BytesIO(b"a"), "sub/b.txt": io.BytesIO(b"b")
+        })
+        assert [fa.read(p) for p in paths] == [b"a", b"b"]
+        a.remove("C:\\Temp")
+        assert fa.files == {}
+
+        a.kill()
+        time.sleep(0.2)
+        assert not fa.up.is_set()
+
+def test_fake_agent_reboot():
+    with FakeAgent(downtime=0.5) as fa:
+        a = Agent(fa.ipaddr, fa.port)
+        a.environ()
+        a.reboot()
+        wait_for_reboot(a, timeout=10, down_timeout=5)
+        assert fa.boots == 2
+        assert a.environ("COMPUTERNAME") == "FAKEAGENT"
+        assert [p for _, p, _ in fa.requests].count("/environ") == 2
+
+def test_fake_agent_dependency(monkeypatch):
+    deps_path = tempfile.mkdtemp()
+    for cert in CaRootCert.files:
+        with open(os.path.join(deps_path, cert["filename"]), "wb") as fp:
+            fp.write(cert["filename"].encode())
+
+    # The certificates are not downloaded, the test ones are used.
+    monkeypatch.setattr(CaRootCert, "download", lambda self: None)
+    with FakeAgent(latency=0.01) as fa:
+        a = Agent(fa.ipaddr, fa.port)
+        h = SimpleNamespace(name="win10", arch="amd64")
+        d = CaRootCert(h=h, a=a)
+        d.deps_path = deps_path
+        d.run()
+
+        certutil = [c for c in fa.commands if "-addstore root" in c]
+        assert len(certutil) == len(CaRootCert.files)
+        # The certificates are staged with one upload and cleaned up.
+        assert [p for _, p, _ in fa.requests].count("/extract") == 1
+        assert fa.files == {}
+
+        fa.respond("-addstore", {"exit_code": 1, "stderr": "denied"})
+        with pytest.raises(DependencyError):
+            d.run()
+        assert fa.files == {}
@@ -0,0 +1,71 @@
+# Copyright (C) 2026 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import tempfile
+import threading
+import time
+
+import vmcloak.abstract
+import vmcloak.depcache
+from vmcloak import install, timing
+from vmcloak.dependencies import IE11, KB
+from vmcloak.exceptions import DependencyError
+
+def test_resolve_dependencies():
+    resolved = install.resolve_dependencies([("ie11", None)], "win7x64")
+    assert resolved[-1] == (IE11, None)
+    kbs = [version for dep, version in resolved if dep is KB]
+    assert len(kbs) == 9 and "2670838" in kbs
+
+    resolved = install.resolve_dependencies(
+        [("ie11", None), ("kb", "2670838")], "win7x64"
+    )
+    assert len(resolved) == 10
+
+def test_prefetch(monkeypatch):
+    deps_path = tempfile.mkdtemp()
+    monkeypatch.setattr(vmcloak.abstract, "deps_path", deps_path)
+    monkeypatch.setattr(timing, "record", lambda s: None)
+
+    # One KB is already downloaded and has the expected hash.
+    present = KB.downloadables("2670838", "win7x64", "amd64")[0]
+    monkeypatch.setattr(
+        vmcloak.depcache, "sha1_file", lambda path: present[2]
+    )
+    with open(present[0], "wb") as fp:
+        fp.write(b"kb")
+
+    lock = threading.Lock()
+    fetched = []
+    running = []
+
+    def fetch(downloadable):
+        with lock:
+            running.append(1)
+            concurrent = len(running)
+        time.sleep(0.05)
+        with lock:
+            running.pop()
+            fetched.append((downloadable[0], concurrent))
+        if "2729094" in downloadable[0]:
+            raise DependencyError("No valid file was downloaded")
+        with open(downloadable[0], "wb") as fp:
+            fp.write(b"downloaded")
+
+    monkeypatch.setattr(install, "fetch_downloadable", fetch)
+    failed = install.prefetch([("ie11", None)], "win7x64", parallel=3)
+
+    assert failed == 1
+    paths = [path for path, _ in fetched]
+    assert len(paths) == len(set(paths)) == 9
+    assert present[0] not in paths
+    assert all(path.startswith(deps_path) for path in paths)
+    assert max(c for _, c in fetched) <= 3
+
+    # Nothing is downloaded for dependencies that are installed already.
+    fetched.clear()
+    failed = install.prefetch(
+        [("ie11", None)], "win7x64", installed=lambda name, version: True
+    )
+    assert failed == 0 and fetched == []
@@ -0,0 +1,333 @@
+# Copyright (C) 2026 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import errno
+import json
+import os
+import struct
+import sys
+
+import pytest
+
+import vmcloak.abstract
+from vmcloak.exceptions import IsoImageError
+from vmcloak.isoimage import IsoImage
+from vmcloak.misc import find_nocase, iso_graft_points, write_path_list
+from vmcloak.win7 import Windows7x64
+
+# Records how it was called instead of creating an ISO file.
+FAKE_GENISOIMAGE = """#!%s
+import json, os, sys
+args = sys.argv[1:]
+with open(args[args.index("-path-list") + 1], "r") as fp:
+    path_list = fp.read().splitlines()
+outdir = args[-1]
+files = sorted(
+    os.path.relpath(os.path.join(dirpath, fname), outdir)
+    for dirpath, _, filenames in os.walk(outdir) for fname in filenames
+)
+grafted = {}
+bs = chr(92)
+for line in path_list:
+    i = 0
+    while line[i] != "=" or line[i - 1] == bs:
+        i += 1
+    target, source = line[:i], line[i + 1:].replace(bs + "=", "=")
+    if os.path.isfile(source):
+        with open(source, "rb") as fp:
+            grafted[target] = fp.read().decode("latin1")
+with open(args[args.index("-o") + 1], "w") as fp:
+    json.dump({
+        "args": args, "path_list": path_list, "files": files,
+        "grafted": grafted,
+    }, fp)
+sys.stderr.write(
+    "Warning: creating filesystem that does not conform to ISO-9660.\\n"
+)
+"""
+
+PRODUCT_INI = b"[BuildInfo]\nstaged=professional\n"
+
+def make_mount(path):
+    os.makedirs(os.path.join(path, "SOURCES"))
+    os.makedirs(os.path.join(path, "BOOT", "Fonts"))
+    with open(os.path.join(path, "SOURCES", "Product.ini"), "w") as fp:
+        fp.write("[BuildInfo]\nstaged=professional\n")
+    with open(os.path.join(path, "SOURCES", "install.wim"), "wb") as fp:
+        fp.write(b"wim")
+    with open(os.path.join(path, "Setup.EXE"), "wb") as fp:
+        fp.write(b"MZ")
+    with open(os.path.join(path, "a=b.txt"), "wb") as fp:
+        fp.write(b"")
+
+def test_iso_graft_points(tmp_path):
+    mount = str(tmp_path)
+    make_mount(mount)
+    grafts = iso_graft_points(mount, exclude=["SOURCES/product.ini"])
+    assert grafts == {
+        "sources/install.wim": os.path.join(mount, "SOURCES", "install.wim"),
+        "setup.exe": os.path.join(mount, "Setup.EXE"),
+        "a=b.txt": os.path.join(mount, "a=b.txt"),
+        "boot/fonts/": os.path.join(mount, "BOOT", "Fonts"),
+    }
+    assert find_nocase(mount, "sources\\product.ini") == \
+        os.path.join(mount, "SOURCES", "Product.ini")
+    assert find_nocase(mount, "sources/missing.ini") is None
+
+    path_list = str(tmp_path / "paths.lst")
+    write_path_list(path_list, {"a=b.txt": "/mnt/a=b\\.txt"})
+    with open(path_list, "r") as fp:
+        assert fp.read() == "a\\=b.txt=/mnt/a\\=b\\\\.txt\n"
+
+def test_buildiso_grafts_mount(tmp_path, monkeypatch):
+    mount = str(tmp_path / "mnt")
+    make_mount(mount)
+    bootstrap = tmp_path / "bootstrap"
+    bootstrap.mkdir()
+    (bootstrap / "extra.bat").write_text("echo")
+    agent = tmp_path / "agent.exe"
+    agent.write_bytes(b"MZ")
+
+    genisoimage = tmp_path / "genisoimage"
+    genisoimage.write_text(FAKE_GENISOIMAGE % sys.executable)
+    genisoimage.chmod(0o755)
+    monkeypatch.setattr(
+        vmcloak.abstract, "get_path", lambda name: str(genisoimage)
+    )
+    monkeypatch.setattr(
+        Windows7x64, "find_agent_binary", lambda self: (str(agent), ".exe")
+    )
+
+    h = Windows7x64()
+    h.configure(str(tmp_path), None)
+    h.serial_key = "AAAAA-BBBBB-CCCCC-DDDDD-EEEEE"
+    newiso = str(tmp_path / "new.iso")
+    assert h.buildiso(mount, newiso, str(bootstrap), str(tmp_path), {
+        "GUEST_IP": "192.168.56.2", "GUEST_MASK": "255.255.255.0",
+        "GUEST_GATEWAY": "192.168.56.1",
+    })
+
+    with open(newiso, "r") as fp:
+        result = json.load(fp)
+
+    # The original files are read from the mount under lowercase names.
+    assert "-graft-points" in result["args"]
+    assert sorted(result["path_list"]) == [
+        f"a\\=b.txt={mount}/a\\=b.txt",
+        f"boot/fonts/={mount}/BOOT/Fonts",
+        f"setup.exe={mount}/Setup.EXE",
+        f"sources/install.wim={mount}/SOURCES/install.wim",
+    ]
+
+    # Only the generated and changed files are in the directory.
+    oemdir = os.path.join("sources", "$oem$", "$1")
+    files = [f for f in result["files"] if "vmcloak" not in f]
+    assert sorted(files) == sorted([
+        "autounattend.xml", "boot.img",
+        os.path.join("sources", "product.ini"),
+        os.path.join(oemdir, "extra.bat"),
+    ])
+    assert os.path.join(oemdir, "vmcloak", "settings.bat") in result["files"]
+
+    # The temporary files are cleaned up.
+    assert sorted(os.listdir(tmp_path)) == [
+        "agent.exe", "bootstrap", "genisoimage", "mnt", "new.iso",
+    ]
+
+def iso9660_image(path):
+    """Write an ISO 9660 image with SETUP.EXE and SOURCES/PRODUCT.INI."""
+    def record(name, extent, size, flags=0):
+        buf = struct.pack("<B", 0) + struct.pack("<I", extent) + \
+            struct.pack(">I", extent) + struct.pack("<I", size) + \
+            struct.pack(">I", size) + b"\x00" * 7 + bytes([flags, 0, 0]) + \
+            struct.pack("<H", 1) + struct.pack(">H", 1) + \
+            bytes([len(name)]) + name
+        buf += b"\x00" * (len(buf) % 2 == 0)
+        return bytes([len(buf) + 1]) + buf
+
+    image = bytearray(24 * 2048)
+    pvd = 16 * 2048
+    image[pvd:pvd + 7] = b"\x01CD001\x01"
+    image[pvd + 128:pvd + 132] = struct.pack("<H", 2048) + \
+        struct.pack(">H", 2048)
+    image[pvd + 156:pvd + 190] = record(b"\x00", 18, 2048, flags=2)
+    image[17 * 2048:17 * 2048 + 7] = b"\xffCD001\x01"
+
+    root = record(b"\x00", 18, 2048, 2) + record(b"\x01", 18, 2048, 2) + \
+        record(b"SETUP.EXE;1", 20, 2) + record(b"SOURCES", 19, 2048, 2)
+    sources = record(b"\x00", 19, 2048, 2) + record(b"\x01", 18, 2048, 2) + \
+        record(b"PRODUCT.INI;1", 21, 32)
+    image[18 * 2048:18 * 2048 + len(root)] = root
+    image[19 * 2048:19 * 2048 + len(sources)] = sources
+    image[20 * 2048:20 * 2048 + 2] = b"MZ"
+    image[21 * 2048:21 * 2048 + 32] = PRODUCT_INI
+    with open(path, "wb") as fp:
+        fp.write(image)
+
+def udf_image(path):
+    """Write a UDF image with an embedded Setup.exe, a Sources directory
+    with an extended file entry and an install.wim with a sparse extent."""
+    partition = 300
+    image = bytearray((partition + 16) * 2048)
+
+    def sector(n, data, offset=0):
+        pos = n * 2048 + offset
+        image[pos:pos + len(data)] = data
+
+    def lb(n, data):
+        sector(partition + n, data)
+
+    def tag(ident):
+        return struct.pack("<H", ident) + b"\x00" * 14
+
+    def entry(ident, file_type, size, ad_type, ads):
+        buf = bytearray(tag(ident) + b"\x00" * 2032)
+        buf[27] = file_type
+        buf[34:36] = struct.pack("<H", ad_type)
+        buf[56:64] = struct.pack("<Q", size)
+        header = 176 if ident == 261 else 216
+        buf[header - 4:header] = struct.pack("<I", len(ads))
+        buf[header:header + len(ads)] = ads
+        return bytes(buf)
+
+    def fid(name, lb_, characteristics=0):
+        name = b"\x08" + name.encode() if name else b""
+        buf = tag(257) + struct.pack("<HBB", 1, characteristics, len(name))
+        buf += struct.pack("<IIH6xH", 2048, lb_, 0, 0) + name
+        return buf + b"\x00" * (-len(buf) % 4)
+
+    sector(16, b"\x00BEA01\x01")
+    sector(17, b"\x00NSR02\x01")
+    sector(18, b"\x00TEA01\x01")
+    sector(256, tag(2) + struct.pack("<II", 3 * 2048, 32))
+    sector(32, tag(5) + struct.pack("<IHH", 1, 1, 0))
+    sector(32, struct.pack("<II", partition, 16), 188)
+    lvd = bytearray(tag(6) + b"\x00" * 2032)
+    lvd[212:216] = struct.pack("<I", 2048)
+    lvd[248:258] = struct.pack("<IIH", 2048, 0, 0)
+    lvd[268:272] = struct.pack("<I", 1)
+    lvd[440:446] = struct.pack("<BBHH", 1, 6, 1, 0)
+    sector(33, lvd)
+    sector(34, tag(8))
+
+    fsd = bytearray(tag(256) + b"\x00" * 2032)
+    fsd[400:410] = struct.pack("<IIH", 2048, 1, 0)
+    lb(0, fsd)
+
+    root = fid("", 1, characteristics=8) + fid("Setup.exe", 3) + \
+        fid("Sources", 4, characteristics=2)
+    lb(1, entry(261, 4, len(root), 0, struct.pack("<II", len(root), 2)))
+    lb(2, root)
+    lb(3, entry(261, 5, 2, 3, b"MZ"))
+
+    sources = fid("", 1, characteristics=8) + fid("install.wim", 6) + \
+        fid("Product.ini", 8)
+    lb(4, entry(266, 4, len(sources), 1,
+                struct.pack("<IIH6x", len(sources), 5, 0)))
+    lb(5, sources)
+    lb(6, entry(261, 5, 2048 + 100, 0, struct.pack(
+        "<IIII", 2048, 7, (1 << 30) | 2048, 0
+    )))
+    lb(7, b"wim" * 682 + b"xx")
+    lb(8, entry(261, 5, 32, 0, struct.pack("<II", 2048, 9)))
+    lb(9, PRODUCT_INI)
+    with open(path, "wb") as fp:
+        fp.write(image)
+
+@pytest.mark.parametrize("build", [iso9660_image, udf_image])
+def test_iso_image(tmp_path, monkeypatch, build):
+    path = str(tmp_path / "win.iso")
+    build(path)
+
+    with IsoImage(path) as iso:
+        assert iso.read("sources/product.ini") == PRODUCT_INI
+        assert iso.read("SOURCES\\Product.INI") == PRODUCT_INI
+        assert iso.read("setup.exe") == b"MZ"
+        assert iso.read("missing.txt") is None
+        assert iso.read("sources") is None
+        iso.extract_tree(str(tmp_path / "out"))
+
+        # The data is copied with read() if copy_file_range() fails.
+        def copy_file_range(*args):
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+        monkeypatch.setattr(os, "copy_file_range", copy_file_range,
+                            raising=False)
+        iso.extract(iso.find("setup.exe"), str(tmp_path / "setup.exe"))
+
+    assert (tmp_path / "out" / "setup.exe").read_bytes() == b"MZ"
+    assert (tmp_path / "setup.exe").read_bytes() == b"MZ"
+    assert (tmp_path / "out" / "sources" / "product.ini").read_bytes() == \
+        PRODUCT_INI
+    if build is udf_image:
+        wim = (tmp_path / "out" / "sources" / "install.wim").read_bytes()
+        assert wim == b"wim" * 682 + b"xx" + b"\x00" * 100
+
+def test_iso_image_invalid(tmp_path, monkeypatch):
+    path = tmp_path / "empty.iso"
+    path.write_bytes(b"\x00" * 64 * 1024)
+    with pytest.raises(IsoImageError):
+        IsoImage(str(path))
+
+    iso9660_image(str(path))
+
+    def corrupt(self):
+        raise IndexError("index out of range")
+
+    monkeypatch.setattr(IsoImage, "_read_iso9660", corrupt)
+    with pytest.raises(IsoImageError):
+        IsoImage(str(path))
+
+@pytest.mark.parametrize("build", [iso9660_image, udf_image])
+def test_buildiso_image(tmp_path, monkeypatch, build):
+    path = str(tmp_path / "win.iso")
+    build(path)
+    bootstrap = tmp_path / "bootstrap"
+    bootstrap.mkdir()
+    (bootstrap / "extra.bat").write_text("echo")
+    agent = tmp_path / "agent.exe"
+    agent.write_bytes(b"MZ")
+
+    genisoimage = tmp_path / "genisoimage"
+    genisoimage.write_text(FAKE_GENISOIMAGE % sys.executable)
+    genisoimage.chmod(0o755)
+    monkeypatch.setattr(
+        vmcloak.abstract, "get_path", lambda name: str(genisoimage)
+    )
+    monkeypatch.setattr(
+        Windows7x64, "find_agent_binary", lambda self: (str(agent), ".exe")
+    )
+
+    h = Windows7x64()
+    h.configure(str(tmp_path), None)
+    h.serial_key = "AAAAA-BBBBB-CCCCC-DDDDD-EEEEE"
+    newiso = str(tmp_path / "new.iso")
+    with IsoImage(path) as iso:
+        assert h.buildiso_image(iso, newiso, str(bootstrap), str(tmp_path), {
+            "GUEST_IP": "192.168.56.2", "GUEST_MASK": "255.255.255.0",
+            "GUEST_GATEWAY": "192.168.56.1",
+        })
+
+    with open(newiso, "r") as fp:
+        result = json.load(fp)
+
+    # The installer files of the image are grafted and the new ISO file
+    # gets a UDF file system.
+    assert "-udf" in result["args"]
+    grafted = result["grafted"]
+    assert grafted["setup.exe"] == "MZ"
+    assert "sources/product.ini" not in grafted
+    if build is udf_image:
+        assert grafted["sources/install.wim"] == \
+            "wim" * 682 + "xx" + "\x00" * 100
+
+    oemdir = os.path.join("sources", "$oem$", "$1")
+    assert os.path.join("sources", "product.ini") in result["files"]
+    assert os.path.join(oemdir, "extra.bat") in result["files"]
+    assert "autounattend.xml" in result["files"]
+
+    # The temporary files are cleaned up.
+    assert sorted(os.listdir(tmp_path)) == [
+        "agent.exe", "bootstrap", "genisoimage", "new.iso", "win.iso",
+    ]
@@ -0,0 +1,110 @@
+# Copyright (C) 2026 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import io
+import json
+import os
+import random
+import subprocess
+import tempfile
+import threading
+
+from vmcloak.memstore import (
+    MemoryStore, ANCHOR, store_command, cat_command
+)
+
+CHUNK = 4096
+
+def dump(seed, shift=b""):
+    """A fake migration stream. It differs per seed in one place, and shift
+    is inserted near the start, which moves all data that follows."""
+    rand = random.Random(0)
+    parts = []
+    for i in range(64):
+        size = rand.randint(CHUNK // 2, CHUNK)
+        parts.append(bytes(rand.getrandbits(8) for _ in range(size)))
+    parts[2] = shift + parts[2]
+    parts[10] = bytes(CHUNK * 8)
+    parts[40] = b"seed-%d" % seed + parts[40]
+    return ANCHOR.join(parts) + b"tail-%d" % seed
+
+def chunks(manifest_path):
+    with open(manifest_path, "r") as fp:
+        return [d for d, _ in json.load(fp)["chunks"]]
+
+def test_store_restore_dedup():
+    tmp = tempfile.mkdtemp()
+    store = MemoryStore(os.path.join(tmp, "store"), chunk_size=CHUNK)
+    manifest1 = os.path.join(tmp, "1.manifest")
+    manifest2 = os.path.join(tmp, "2.manifest")
+
+    first, second = dump(1), dump(2, shift=b"shifted")
+    stats1 = store.store(io.BytesIO(first), manifest1)
+    stats2 = store.store(io.BytesIO(second), manifest2)
+    assert stats1["size"] == len(first)
+    assert stats1["chunks"] > 16
+    assert None in chunks(manifest1)
+    # Only the chunks around the shift, the seed and the tail are new for
+    # the second dump.
+    assert 3 <= stats2["new_chunks"] <= 6
+
+    out = io.BytesIO()
+    store.restore(manifest2, out)
+    assert out.getvalue() == second
+
+    # Restore to a regular file uses seeks for the zero chunks.
+    path = os.path.join(tmp, "restored")
+    with open(path, "wb") as fp:
+        store.restore(manifest1, fp)
+    with open(path, "rb") as fp:
+        assert fp.read() == first
+
+    unused = set(chunks(manifest1)) - set(chunks(manifest2))
+    os.remove(manifest1)
+    assert store.gc([manifest2]) == len(unused)
+    out = io.BytesIO()
+    store.restore(manifest2, out)
+    assert out.getvalue() == second
+
+def test_commands():
+    tmp = tempfile.mkdtemp()
+    store_path = os.path.join(tmp, "store")
+    manifest = os.path.join(tmp, "memory.manifest")
+    data = dump(3) * 20
+
+    subprocess.run(
+        store_command(store_path, manifest), shell=True, input=data,
+        check=True
+    )
+    out = subprocess.run(
+        cat_command(store_path, manifest), shell=True,
+        stdout=subprocess.PIPE, check=True
+    ).stdout
+    assert out == data
+
+def test_gc_waits_for_store():
+    tmp = tempfile.mkdtemp()
+    store = MemoryStore(os.path.join(tmp, "store"), chunk_size=CHUNK)
+    data = dump(1)
+    store.store(io.BytesIO(data), os.path.join(tmp, "1.manifest"))
+    os.remove(os.path.join(tmp, "1.manifest"))
+
+    # A store that reuses all chunks of the removed snapshot is running.
+    gc_done = threading.Event()
+
+    def gc():
+        store.gc(lambda: [os.path.join(tmp, "2.manifest")])
+        gc_done.set()
+
+    with store.lock():
+        t = threading.Thread(target=gc)
+        t.start()
+        assert not gc_done.wait(0.2)
+        store._store(io.BytesIO(data), os.path.join(tmp, "2.manifest"))
+    t.join()
+
+    assert store.gc([os.path.join(tmp, "2.manifest")]) == 0
+    out = io.BytesIO()
+    store.restore(os.path.join(tmp, "2.manifest"), out)
+    assert out.getvalue() == data
@@ -0,0 +1,99 @@
+# Copyright (C) 2026 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import os
+import socket
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from vmcloak import mirrors
+from vmcloak.mirrors import HostStats, order_urls, url_host
+
+class _MirrorHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.server.heads += 1
+        time.sleep(self.server.delay)
+        if not self.server.allow_head:
+            self.send_response(405)
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+def _mirror(delay=0, allow_head=True):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _MirrorHandler)
+    server.delay = delay
+    server.allow_head = allow_head
+    server.heads = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/setup.exe"
+
+def _dead_url():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return f"http://127.0.0.1:{port}/setup.exe"
+
+def test_order_urls():
+    stats = HostStats(os.path.join(tempfile.mkdtemp(), "hoststats.json"))
+    slow, slow_url = _mirror(delay=0.3)
+    fast, fast_url = _mirror(allow_head=False)
+    dead_url = _dead_url()
+
+    urls = [dead_url, slow_url, fast_url]
+    assert order_urls(urls, stats) == [fast_url, slow_url, dead_url]
+    assert stats.get(url_host(fast_url))["latency"] < 0.3
+    assert stats.get(url_host(dead_url))["failures"] == 1
+
+    # The stats are kept across runs and a dead host is skipped.
+    stats = HostStats(stats.path)
+    for _ in range(mirrors.DEAD_FAILURES - 1):
+        stats.record(url_host(dead_url), failed=True)
+    heads = slow.heads
+    assert order_urls(urls, stats) == [fast_url, slow_url]
+    assert slow.heads == heads + 1
+    assert order_urls([dead_url], stats) == [dead_url]
+
+    # A success makes a host alive again.
+    stats.record(url_host(dead_url))
+    assert not stats.is_dead(url_host(dead_url))
+    slow.shutdown()
+    fast.shutdown()
+
+def test_record_once_per_attempt():
+    stats = HostStats(os.path.join(tempfile.mkdtemp(), "hoststats.json"))
+    dead_url = _dead_url()
+    host = url_host(dead_url)
+
+    # The failed download after the failed probe is the same attempt.
+    assert order_urls([dead_url, _dead_url()], stats)[0] == dead_url
+    stats.record(host, failed=True)
+    assert stats.get(host)["failures"] == 1
+    stats.record(host, failed=True)
+    assert stats.get(host)["failures"] == 2
+
+def test_record_merges_processes():
+    path = os.path.join(tempfile.mkdtemp(), "hoststats.json")
+    first, second = HostStats(path), HostStats(path)
+    first.record("a.example", latency=1)
+    second.record("b.example", failed=True)
+    first.record("a.example", latency=2)
+
+    stats = HostStats(path)
+    assert stats.get("a.example")["successes"] == 2
+    assert stats.get("b.example")["failures"] == 1
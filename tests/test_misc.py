@@ -0,0 +1,251 @@
+# Copyright (C) 2026 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import hashlib
+import os
+import socket
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from vmcloak import misc
+from vmcloak.misc import (
+    port_open, wait_for_reboot, wait_for_agent, wait_for_agents,
+    _probe_interval, download_file
+)
+
+class PingAgent(object):
+    def __init__(self, ipaddr, port):
+        self.ipaddr = ipaddr
+        self.port = port
+        self.pings = 0
+
+    def ping(self):
+        self.pings += 1
+
+def listen(port=0):
+    server = socket.socket()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(("127.0.0.1", port))
+    server.listen(5)
+    return server
+
+def closed_port():
+    s = listen()
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def test_wait_for_reboot_port_closes():
+    server = listen()
+    a = PingAgent(*server.getsockname())
+    assert port_open(a.ipaddr, a.port)
+
+    # The agent port closes and opens again when the guest has rebooted.
+    rebooted = []
+    threading.Timer(0.5, server.close).start()
+    threading.Timer(1, lambda: rebooted.append(listen(a.port))).start()
+    start = time.time()
+    wait_for_reboot(a, timeout=10, down_timeout=5)
+    assert 0.9 < time.time() - start < 5
+    assert a.pings == 1
+    rebooted[0].close()
+
+def test_wait_for_reboot_reset_event():
+    server = listen()
+    a = PingAgent(*server.getsockname())
+    resets = []
+
+    def went_down(timeout):
+        resets.append(timeout)
+        return True
+
+    wait_for_reboot(a, went_down, timeout=10, down_timeout=3)
+    assert resets == [3]
+    assert a.pings == 1
+    server.close()
+
+def test_wait_for_agents():
+    servers = [listen(), listen()]
+    up = [PingAgent(*s.getsockname()) for s in servers]
+    down = PingAgent("127.0.0.1", closed_port())
+
+    ready = wait_for_agents(up + [down], timeout=1)
+    assert all(ready[a] is not None and ready[a] < 1 for a in up)
+    assert ready[down] is None
+    assert [a.pings for a in up] == [1, 1]
+    assert down.pings == 0
+
+    with pytest.raises(IOError):
+        wait_for_agent(down, timeout=0.5)
+    for s in servers:
+        s.close()
+
+def test_open_ports_bad_address():
+    server = listen()
+    addrs = [
+        ("host.invalid", 8000), server.getsockname(),
+        ("256.0.0.1", 8000),
+    ]
+    assert misc._open_ports(addrs, timeout=1) == {1}
+    server.close()
+
+def test_probe_interval():
+    assert _probe_interval(0, None, 0) == 0.1
+    assert _probe_interval(5, None, 10) == 1.0
+    # Rare probes long before the expected ready time, often around it.
+    assert _probe_interval(0, 60, 0) == 2.0
+    assert _probe_interval(44, 60, 20) == 1.0
+    assert _probe_interval(50, 60, 20) == 0.2
+    assert _probe_interval(100, 60, 20) == 1.0
+
+class _RangeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(self.server.data)))
+        self.send_header("ETag", self.server.etag)
+        if self.server.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+
+    def do_GET(self):
+        srv = self.server
+        srv.requests.append(dict(self.headers))
+        data = srv.data
+        start, end = 0, len(data) - 1
+        rng = self.headers.get("Range")
+        partial = rng and srv.ranges and \
+            self.headers.get("If-Range") == srv.etag
+        if partial:
+            start, end = rng.split("=")[1].split("-")
+            start, end = int(start), int(end or len(data) - 1)
+
+        self.send_response(206 if partial else 200)
+        self.send_header("Content-Length", str(end + 1 - start))
+        self.send_header("ETag", srv.etag)
+        if srv.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        if partial:
+            self.send_header(
+                "Content-Range", f"bytes {start}-{end}/{len(data)}"
+            )
+        self.end_headers()
+
+        body = data[start:end + 1]
+        if srv.drop_after:
+            # Send part of the body and then drop the connection.
+            body, srv.drop_after = body[:srv.drop_after], 0
+            self.close_connection = True
+        self.wfile.write(body)
+        srv.served += len(body)
+
+def _range_server(data, ranges=True):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _RangeHandler)
+    server.data = data
+    server.etag = '"v1"'
+    server.ranges = ranges
+    server.drop_after = 0
+    server.served = 0
+    server.requests = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/setup.exe"
+
+def test_download_resumes(monkeypatch):
+    monkeypatch.setattr(misc, "DOWNLOAD_RETRY_DELAY", 0)
+    # Chunks that end exactly where the server drops the connection.
+    monkeypatch.setattr(misc, "DOWNLOAD_CHUNK_SIZE", 64 * 1024)
+    data = os.urandom(5 * 1024 * 1024 + 3)
+    server, url = _range_server(data)
+    path = os.path.join(tempfile.mkdtemp(), "setup.exe")
+
+    server.drop_after = 3 * 1024 * 1024
+    assert download_file(url, path) == (True, hashlib.sha1(data).hexdigest())
+    with open(path, "rb") as fp:
+        assert fp.read() == data
+    assert server.requests[1]["Range"] == f"bytes={3 * 1024 * 1024}-"
+    assert server.requests[1]["If-Range"] == '"v1"'
+    assert server.served == len(data)
+    assert sorted(os.listdir(os.path.dirname(path))) == ["setup.exe"]
+
+    # A part of an earlier run is continued, unless the file changed.
+    os.remove(path)
+    server.drop_after = 1024 * 1024
+    assert download_file(url, path, retries=0) == (False, None)
+    assert os.path.getsize(path + ".part") == 1024 * 1024
+    served = server.served
+    assert download_file(url, path)[1] == hashlib.sha1(data).hexdigest()
+    assert server.served - served == len(data) - 1024 * 1024
+
+    os.remove(path)
+    server.drop_after = 1024 * 1024
+    assert download_file(url, path, retries=0) == (False, None)
+    server.data, server.etag = data[::-1], '"v2"'
+    assert download_file(url, path)[1] == hashlib.sha1(data[::-1]).hexdigest()
+    server.shutdown()
+
+def test_download_without_ranges(monkeypatch):
+    monkeypatch.setattr(misc, "DOWNLOAD_RETRY_DELAY", 0)
+    data = os.urandom(3 * 1024 * 1024)
+    server, url = _range_server(data, ranges=False)
+    path = os.path.join(tempfile.mkdtemp(), "setup.exe")
+
+    server.drop_after = 1024 * 1024
+    assert download_file(url, path)[1] == hashlib.sha1(data).hexdigest()
+    assert "Range" not in server.requests[1]
+    server.shutdown()
+
+def test_download_segmented(monkeypatch):
+    monkeypatch.setattr(misc, "DOWNLOAD_RETRY_DELAY", 0)
+    monkeypatch.setattr(misc, "DOWNLOAD_CHUNK_SIZE", 64 * 1024)
+    monkeypatch.setattr(misc, "SEGMENT_MIN_SIZE", 1024 * 1024)
+    data = os.urandom(5 * 1024 * 1024 + 7)
+    server, url = _range_server(data)
+    path = os.path.join(tempfile.mkdtemp(), "win10.iso")
+
+    # One segment is interrupted and continued.
+    server.drop_after = 512 * 1024
+    assert download_file(url, path, segments=4) == \
+        (True, hashlib.sha1(data).hexdigest())
+    with open(path, "rb") as fp:
+        assert fp.read() == data
+    ranges = sorted(r["Range"] for r in server.requests)
+    assert len(ranges) == 5
+    assert "bytes=0-1310721" in ranges
+    assert server.served == len(data)
+    assert os.listdir(os.path.dirname(path)) == ["win10.iso"]
+
+    # A failed download keeps its part and continues every segment.
+    os.remove(path)
+    server.requests = []
+    server.drop_after = 512 * 1024
+    assert download_file(url, path, segments=4, retries=0) == (False, None)
+    assert os.path.getsize(path + ".part") == len(data)
+    assert os.path.isfile(path + ".part.json")
+    server.requests = []
+    assert download_file(url, path, segments=4) == \
+        (True, hashlib.sha1(data).hexdigest())
+    with open(path, "rb") as fp:
+        assert fp.read() == data
+    starts = [int(r["Range"][6:].split("-")[0]) for r in server.requests]
+    assert not set(starts) <= {0, 1310722, 2621444, 3932166}
+    assert os.listdir(os.path.dirname(path)) == ["win10.iso"]
+
+    # Small files and servers without ranges use a single connection.
+    server.requests = []
+    assert misc.download_segmented(url, path, segments=4) is not None
+    server.data = data[:1024]
+    assert misc.download_segmented(url, path, segments=4) is None
+    server.data, server.ranges = data, False
+    server.requests = []
+    assert download_file(url, path, segments=4)[0]
+    assert len(server.requests) == 1 and "Range" not in server.requests[0]
+    server.shutdown()
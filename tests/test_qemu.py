@@ -0,0 +1,334 @@
+# Copyright (C) 2026 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import io
+import json
+import os
+import socket
+import subprocess
+import tempfile
+import threading
+
+import pytest
+
+from vmcloak.exceptions import QMPError
+from vmcloak.memstore import MemoryStore
+from vmcloak.platforms.qemu import QMP
+
+def fake_qmp_server(path, handler):
+    """Accept a single QMP client on the unix socket at path and answer its
+    commands using handler(command) -> list of messages to send."""
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+
+    def serve():
+        conn, _ = server.accept()
+        fp = conn.makefile("rwb")
+        fp.write(b'{"QMP": {"version": {}, "capabilities": []}}\n')
+        fp.flush()
+        for line in fp:
+            for msg in handler(json.loads(line)):
+                fp.write(json.dumps(msg).encode() + b"\n")
+                fp.flush()
+        conn.close()
+        server.close()
+
+    threading.Thread(target=serve, daemon=True).start()
+
+def connect(handler):
+    path = os.path.join(tempfile.mkdtemp(), "qmp.sock")
+    fake_qmp_server(path, handler)
+    qmp = QMP(path)
+    qmp.connect(timeout=5)
+    return qmp
+
+def test_command_and_events():
+    def handler(cmd):
+        if cmd["execute"] == "stop":
+            return [
+                {"event": "STOP", "data": {}},
+                {"return": {}, "id": cmd["id"]},
+            ]
+        if cmd["execute"] == "query-status":
+            return [{"return": {"status": "paused"}, "id": cmd["id"]}]
+        if cmd["execute"] == "bogus":
+            return [{"error": {"desc": "not found"}, "id": cmd["id"]}]
+        return [{"return": {}, "id": cmd["id"]}]
+
+    qmp = connect(handler)
+    mark = qmp.event_mark()
+    assert qmp.command("stop") == {}
+    assert qmp.wait_event("STOP", timeout=5, after=mark)["event"] == "STOP"
+    assert qmp.wait_event("STOP", timeout=0.1, after=qmp.event_mark()) is None
+    assert qmp.command("query-status") == {"status": "paused"}
+
+    with pytest.raises(QMPError):
+        qmp.command("bogus")
+    qmp.close()
+
+def test_events_dropped():
+    def handler(cmd):
+        if cmd["execute"] != "stop":
+            return [{"return": {}, "id": cmd["id"]}]
+        return [
+            {"event": "STOP", "data": {}}, {"return": {}, "id": cmd["id"]},
+        ]
+
+    qmp = connect(handler)
+    qmp.command("stop")
+    held = qmp.event_mark()
+    qmp.command("stop")
+    mark = qmp.event_mark()
+    qmp.command("stop")
+    assert qmp.wait_event("STOP", timeout=5, after=mark)
+    # The held mark still needs the events after it.
+    assert [seq for seq, _ in qmp._events] == [2, 3]
+    assert qmp.wait_event("STOP", timeout=5, after=held)
+    assert qmp.wait_event("STOP", timeout=0.1, after=qmp.event_mark()) is None
+    assert qmp._events == []
+    qmp.close()
+
+def test_event_filter_and_close():
+    def handler(cmd):
+        if cmd["execute"] == "migrate":
+            return [
+                {"return": {}, "id": cmd["id"]},
+                {"event": "MIGRATION", "data": {"status": "active"}},
+                {"event": "MIGRATION", "data": {"status": "completed"}},
+            ]
+        return [{"return": {}, "id": cmd["id"]}]
+
+    qmp = connect(handler)
+    qmp.command("migrate", {"uri": "exec:cat > /dev/null"})
+    event = qmp.wait_event(
+        "MIGRATION", timeout=5,
+        where=lambda data: data["status"] == "completed"
+    )
+    assert event["data"]["status"] == "completed"
+    qmp.close()
+    assert qmp.wait_event("SHUTDOWN", timeout=5) is None
+
+def test_compressor_roundtrip():
+    from vmcloak.platforms import qemu
+
+    assert qemu.pick_compressor() in qemu.available_compressors()
+    with pytest.raises(KeyError):
+        qemu.pick_compressor("bogus")
+
+    path = os.path.join(tempfile.mkdtemp(), "memory.snapshot")
+    data = b"vmcloak" * 4096
+    subprocess.run(
+        qemu.compress_command("gzip", path, level=1), shell=True,
+        input=data, check=True
+    )
+    out = subprocess.run(
+        qemu.decompress_command("gzip", path), shell=True,
+        stdout=subprocess.PIPE, check=True
+    ).stdout
+    assert out == data
+
+def test_benchmark_compressors(monkeypatch):
+    from vmcloak.platforms import qemu
+
+    monkeypatch.setattr(qemu, "_bench_threads", lambda: [1, 2])
+    tmpdir = tempfile.mkdtemp()
+    sample = os.path.join(tmpdir, "sample.raw")
+    with open(sample, "wb") as fp:
+        fp.write(os.urandom(64 * 1024) + b"\x00" * 1024 * 1024)
+
+    names = [n for n in ("gzip", "zstd", "none")
+             if n in qemu.available_compressors()]
+    results = qemu.benchmark_compressors(sample, tmpdir, names=names)
+    tried = [(r["compressor"], r["level"], r["threads"]) for r in results]
+    expected = {
+        "gzip": [("gzip", 1, None), ("gzip", 3, None), ("gzip", 6, None)],
+        "zstd": [
+            ("zstd", level, threads)
+            for level in (1, 3, 6) for threads in (1, 2)
+        ],
+        "none": [("none", None, None)],
+    }
+    assert tried == [t for n in names for t in expected[n]]
+    assert all(r["input"] == 1088 * 1024 for r in results)
+    assert os.listdir(tmpdir) == ["sample.raw"]
+
+def test_create_fork_vm(monkeypatch):
+    from vmcloak.platforms import qemu
+
+    def handler(cmd):
+        if cmd["execute"] == "query-status":
+            return [
+                {"return": {"status": "inmigrate"}, "id": cmd["id"]},
+                {"event": "RESUME", "data": {}},
+            ]
+        return [{"return": {}, "id": cmd["id"]}]
+
+    started = {}
+    def fake_create_vm(name, attr, iso_path=None, is_snapshot=False,
+                       incoming=None, paused=False):
+        started["incoming"] = incoming
+        started["paused"] = paused
+        qemu.monitors[name] = connect(handler)
+
+    monkeypatch.setattr(qemu, "_create_vm", fake_create_vm)
+    tmpdir = tempfile.mkdtemp()
+    with open(os.path.join(tmpdir, "template.qcow2"), "wb") as fp:
+        fp.write(b"disk")
+
+    qemu.fork_templates["template"] = {
+        "disk": os.path.join(tmpdir, "template.qcow2"),
+        "memory": os.path.join(tmpdir, "memory.snapshot"),
+        "compressor": "gzip",
+    }
+    attr = {"path": os.path.join(tmpdir, "disk.qcow2")}
+    qemu.create_fork_vm("template", "fork1", attr, timeout=5)
+
+    with open(attr["path"], "rb") as fp:
+        assert fp.read() == b"disk"
+    assert started["incoming"].startswith("exec:")
+    assert "memory.snapshot" in started["incoming"]
+    assert not started["paused"]
+    with pytest.raises(ValueError):
+        qemu.create_fork_vm("template", "fork1", attr, timeout=5)
+    qemu.monitors.pop("fork1").close()
+
+    # Without network, the VM is started once the memory has been loaded.
+    status = iter(["inmigrate", "inmigrate", "paused"])
+    commands = []
+
+    def handler(cmd):
+        commands.append((cmd["execute"], cmd.get("arguments")))
+        if cmd["execute"] == "query-status":
+            return [{"return": {"status": next(status)}, "id": cmd["id"]}]
+        return [{"return": {}, "id": cmd["id"]}]
+
+    attr = {"path": os.path.join(tmpdir, "disk2.qcow2")}
+    qemu.create_fork_vm("template", "fork2", attr, timeout=5, link_down=True)
+    assert started["paused"]
+    assert commands[-2:] == [
+        ("set_link", {"name": "net0", "up": False}), ("cont", None),
+    ]
+
+    qemu.monitors.pop("fork2").close()
+    qemu.fork_templates.pop("template")
+
+def test_pick_dump_backend(monkeypatch):
+    from pkg_resources import parse_version
+    from vmcloak.platforms import qemu
+
+    monkeypatch.setattr(qemu, "version", lambda: parse_version("8.2.0"))
+    assert qemu.pick_dump_backend("auto") == "exec"
+    assert qemu.pick_dump_backend("exec") == "exec"
+    with pytest.raises(KeyError):
+        qemu.pick_dump_backend("file")
+
+    monkeypatch.setattr(qemu, "version", lambda: parse_version("9.1.0"))
+    assert qemu.pick_dump_backend() == "file"
+    with pytest.raises(KeyError):
+        qemu.pick_dump_backend("bogus")
+
+class FakeConfDump:
+    def __init__(self):
+        self.fields = {}
+
+    def add_machine_field(self, key, value):
+        self.fields[key] = value
+
+class FakeProcess:
+    def wait(self, timeout=None):
+        return 0
+
+def test_file_snapshot(monkeypatch):
+    from vmcloak.platforms import qemu
+
+    tmpdir = tempfile.mkdtemp()
+    monkeypatch.setattr(qemu, "_get_vm_dir", lambda name: tmpdir)
+    monkeypatch.setattr(
+        qemu, "memstore_path", os.path.join(tmpdir, "memstore")
+    )
+    commands = []
+
+    def handler(cmd):
+        if cmd["execute"] != "qmp_capabilities":
+            commands.append(cmd)
+        if cmd["execute"] == "migrate":
+            path = cmd["arguments"]["uri"].split(":", 1)[1]
+            with open(path, "wb") as fp:
+                fp.write(b"page" * 4096)
+            return [
+                {"return": {}, "id": cmd["id"]},
+                {"event": "MIGRATION", "data": {"status": "completed"}},
+            ]
+        return [{"return": {}, "id": cmd["id"]}]
+
+    qemu.monitors["vm1"] = connect(handler)
+    qemu.machines["vm1"] = FakeProcess()
+    qemu.confdumps["vm1"] = FakeConfDump()
+    qemu.snapshot_options["vm1"] = {
+        "backend": "file", "channels": 4
+    }
+    qemu.create_snapshot("vm1")
+
+    names = [c["execute"] for c in commands]
+    assert names[:4] == [
+        "stop", "migrate-set-capabilities", "migrate-set-parameters",
+        "migrate"
+    ]
+    capabilities = [
+        c["capability"] for c in commands[1]["arguments"]["capabilities"]
+    ]
+    assert capabilities == ["events", "mapped-ram", "multifd"]
+    assert commands[2]["arguments"]["multifd-channels"] == 4
+
+    fields = qemu.confdumps.pop("vm1").fields
+    assert fields["memory_snapshot_migration"]["transport"] == "file"
+    assert fields["memory_snapshot"] == "memory.snapshot"
+
+    qemu.monitors.pop("vm1").close()
+    qemu.machines.pop("vm1")
+
+def test_memstore_snapshot(monkeypatch):
+    from vmcloak.platforms import qemu
+
+    tmpdir = tempfile.mkdtemp()
+    monkeypatch.setattr(qemu, "_get_vm_dir", lambda name: tmpdir)
+    monkeypatch.setattr(
+        qemu, "memstore_path", os.path.join(tmpdir, "memstore")
+    )
+    data = b"page" * 4096 + bytes(65536)
+
+    def handler(cmd):
+        if cmd["execute"] == "migrate":
+            uri = cmd["arguments"]["uri"]
+            assert uri.startswith("exec:")
+            subprocess.run(
+                uri.split(":", 1)[1], shell=True, input=data, check=True
+            )
+            return [
+                {"return": {}, "id": cmd["id"]},
+                {"event": "MIGRATION", "data": {"status": "completed"}},
+            ]
+        return [{"return": {}, "id": cmd["id"]}]
+
+    qemu.monitors["vm1"] = connect(handler)
+    qemu.machines["vm1"] = FakeProcess()
+    qemu.confdumps["vm1"] = FakeConfDump()
+    # The stream is stored as it arrives, whatever the dump backend.
+    qemu.snapshot_options["vm1"] = {"backend": "file", "dedup": True}
+    qemu.create_snapshot("vm1")
+
+    fields = qemu.confdumps.pop("vm1").fields
+    assert fields["memory_snapshot_migration"]["transport"] == "exec"
+    assert fields["memory_snapshot"] == "memory.manifest"
+    assert not os.path.exists(os.path.join(tmpdir, "memory.snapshot"))
+
+    out = io.BytesIO()
+    MemoryStore(qemu.memstore_path).restore(
+        os.path.join(tmpdir, "memory.manifest"), out
+    )
+    assert out.getvalue() == data
+
+    qemu.monitors.pop("vm1").close()
+    qemu.machines.pop("vm1")
@@ -0,0 +1,87 @@
+# Copyright (C) 2026 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import threading
+from types import SimpleNamespace
+
+from vmcloak import main, timing
+
+class FakePlatform(object):
+    """Boots VMs without network and tracks who owns the image IP."""
+
+    def __init__(self, booting):
+        self.booting = booting
+        self.lock = threading.Lock()
+        self.image_ip_owner = None
+        self.conflicts = 0
+        self.snapshots = []
+
+    def create_snapshot_vm(self, image, name, attr, link_down=False):
+        assert link_down
+        # Both VMs must boot at the same time for this to return.
+        self.booting.wait(timeout=5)
+
+    def set_link(self, name, up):
+        with self.lock:
+            if self.image_ip_owner:
+                self.conflicts += 1
+            self.image_ip_owner = name
+
+    def reset_waiter(self, name):
+        return None
+
+    def create_snapshot(self, name):
+        self.snapshots.append(name)
+
+    def create_machineinfo_dump(self, name, image):
+        pass
+
+    def remove_vm_data(self, name):
+        pass
+
+class FakeAgent(object):
+    def __init__(self, platform, ipaddr, port):
+        self.platform = platform
+
+    def static_ip(self, ipaddr, netmask, gateway, interface, mac=None):
+        with self.platform.lock:
+            self.platform.image_ip_owner = None
+
+    def hostname(self, hostname, live=False):
+        pass
+
+    def reboot(self):
+        pass
+
+    def kill(self):
+        pass
+
+    def remove(self, path):
+        pass
+
+def test_parallel_boots(monkeypatch):
+    p = FakePlatform(threading.Barrier(2))
+    image = SimpleNamespace(
+        id=1, platform=p, osversion="win10x64", ipaddr="192.168.30.2",
+        port=8000
+    )
+    monkeypatch.setattr(main, "Agent", lambda *args: FakeAgent(p, *args))
+    monkeypatch.setattr(main, "wait_for_agent", lambda *args, **kw: None)
+    monkeypatch.setattr(main, "wait_for_reboot", lambda *args, **kw: None)
+    monkeypatch.setattr(timing, "record", lambda span: None)
+    monkeypatch.setattr(timing, "expected", lambda phase: None)
+    added = []
+    monkeypatch.setattr(main, "_add_snapshot", added.append)
+
+    jobs = [
+        (f"vm{i}", {
+            "ip": f"192.168.30.{10 + i}", "netmask": "255.255.255.0",
+            "gateway": "192.168.30.1", "port": 8000, "hostname": f"host{i}",
+        })
+        for i in range(2)
+    ]
+    assert main._snapshot_parallel(image, jobs, 2, 2, 1) == 0
+    assert sorted(p.snapshots) == ["vm0", "vm1"]
+    assert len(added) == 2
+    assert p.conflicts == 0
@@ -0,0 +1,55 @@
+# Copyright (C) 2026 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+import pytest
+
+from vmcloak import timing
+from vmcloak.repository import Timing
+
+def test_percentile():
+    assert timing.percentile([], 50) is None
+    assert timing.percentile([5], 99) == 5
+    assert timing.percentile([4, 1, 3, 2], 50) == 2.5
+    assert timing.percentile(list(range(101)), 90) == 90
+    assert timing.percentile([1, 2], 100) == 2
+
+def test_span(monkeypatch):
+    recorded = []
+    monkeypatch.setattr(timing, "record", recorded.append)
+
+    with timing.span("memory_dump", "vm1") as s:
+        s.size = 1024
+
+    with pytest.raises(ValueError):
+        with timing.span("reboot", "vm1"):
+            raise ValueError("timeout")
+
+    assert [(s.phase, s.size, s.success) for s in recorded] == [
+        ("memory_dump", 1024, True), ("reboot", None, False)
+    ]
+    assert all(s.duration >= 0 for s in recorded)
+
+def test_summarize():
+    timings = [
+        Timing(phase="boot", duration=10, success=True),
+        Timing(phase="boot", duration=20, success=True),
+        Timing(phase="boot", duration=99, success=False),
+        Timing(phase="dependency", detail="java:7u80", duration=5,
+               success=True),
+        Timing(phase="memory_dump", duration=30, size=3 * 1024**2,
+               success=True),
+        Timing(phase="memory_dump", duration=40, size=None, success=True),
+    ]
+    rows = timing.summarize(timings)
+    assert [r["name"] for r in rows] == ["boot", "dependency", "memory_dump"]
+    assert rows[0]["count"] == 3
+    assert rows[0]["failed"] == 1
+    assert rows[0]["p50"] == 15
+    assert rows[0]["max"] == 20
+    assert rows[0]["total"] == 30
+    assert rows[0]["size_p50"] is None
+    assert rows[2]["size_p50"] == 3 * 1024**2
+
+    rows = timing.summarize(timings[3:4], key=lambda t: t.detail)
+    assert rows[0]["name"] == "java:7u80"
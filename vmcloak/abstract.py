@@ -3,20 +3,24 @@
 # This file is part of VMCloak - http://www.vmcloak.org/.
 # See the file 'docs/LICENSE.txt' for copying permission.
 
+import base64
 import logging
 import os.path
 import re
 import shutil
+import stat
 import subprocess
 import tempfile
 import time
 from ipaddress import ip_network
 
 from vmcloak.constants import VMCLOAK_ROOT
-from vmcloak.exceptions import DependencyError
+from vmcloak.depcache import artifact_cache, file_sha1, hash_index
+from vmcloak.exceptions import CommandError, DependencyError
+from vmcloak.mirrors import host_stats, order_urls, url_host
 from vmcloak.misc import (
-    copytreelower, copytreeinto, sha1_file, ini_read, filename_from_url,
-    download_file
+    copytreeinto, find_nocase, ini_read, iso_graft_points, write_path_list,
+    filename_from_url, download_file, DOWNLOAD_SEGMENTS
 )
 from vmcloak.paths import get_path
 from vmcloak.repository import deps_path
@@ -25,6 +29,39 @@ from vmcloak.rand import random_string
 
 log = logging.getLogger(__name__)
 
+# Waits in the guest until a process with the given name runs or until none
+# runs anymore. Exits with 3 if the timeout (0 is none) is reached first, so
+# a timeout can be told apart from PowerShell itself failing.
+_WAIT_TIMEOUT_EXIT_CODE = 3
+
+_WAIT_APPEAR_PS1 = """
+$sw = [Diagnostics.Stopwatch]::StartNew()
+while (-not (Get-Process -Name '%(name)s' -ErrorAction SilentlyContinue)) {
+    if (%(timeout)s -gt 0 -and $sw.Elapsed.TotalSeconds -ge %(timeout)s) {
+        exit 3
+    }
+    Start-Sleep -Milliseconds 250
+}
+exit 0
+"""
+
+_WAIT_EXIT_PS1 = """
+$sw = [Diagnostics.Stopwatch]::StartNew()
+while (Get-Process -Name '%(name)s' -ErrorAction SilentlyContinue) {
+    if (%(timeout)s -gt 0) {
+        $left = [int][Math]::Ceiling(%(timeout)s - $sw.Elapsed.TotalSeconds)
+        if ($left -le 0) {
+            exit 3
+        }
+        Wait-Process -Name '%(name)s' -Timeout $left `
+            -ErrorAction SilentlyContinue
+    } else {
+        Wait-Process -Name '%(name)s' -ErrorAction SilentlyContinue
+    }
+}
+exit 0
+"""
+
 GENISOIMAGE_WARNINGS = [
     b"Warning: creating filesystem that does not conform to ISO-9660.",
     b"Warning: creating filesystem that does not conform to ISO-9660. "
@@ -65,6 +102,10 @@ class OperatingSystem(object):
     # Additional arguments for genisoimage.
     genisoargs = []
 
+    # Files of the original ISO, as lowercase paths, that isofiles() reads or
+    # changes. Only these are copied; the rest is read from the mount.
+    iso_edit_files = []
+
     def __init__(self):
         self.data_path = os.path.join(VMCLOAK_ROOT, "data")
         self.path = os.path.join(self.data_path, self.name)
@@ -121,18 +162,10 @@ class OperatingSystem(object):
             if mount and os.path.isdir(mount) and os.listdir(mount):
                 return mount
 
-    def buildiso(self, mount, newiso, bootstrap, tmp_dir=None, env_vars={}):
-        """Builds an ISO file containing all our modifications."""
-        isocreate = get_path("genisoimage")
-        if not isocreate:
-            log.error("Either genisoimage or mkisofs is required!")
-            return False
-
-        outdir = tempfile.mkdtemp(dir=tmp_dir)
-        # Copy all files to our temporary directory as mounted iso files are
-        # read-only and we need lowercase (aka case-insensitive) filepaths.
-        copytreelower(mount, outdir)
-
+    def _write_outdir(self, outdir, bootstrap, tmp_dir, env_vars):
+        """Write the boot image, the files of the OS handler and the
+        bootstrap files to outdir. The edit files must already be there.
+        Returns False if there is no agent for this OS."""
         # Copy the boot image.
         shutil.copy(os.path.join(self.path, "boot.img"), outdir)
 
@@ -156,7 +189,6 @@ class OperatingSystem(object):
                 f"Failed to find agent file for OS {self.os_name} with "
                 f"architecture: {self.arch}. {e}"
             )
-            shutil.rmtree(outdir)
             return False
 
         # Copy the agent binary to the tmp bootstrap folder with the extension
@@ -172,10 +204,53 @@ class OperatingSystem(object):
                 f.write(f"set {key}={value}\n".encode())
 
         copytreeinto(bootstrap, os.path.join(outdir, self.osdir))
+        return True
+
+    def buildiso(self, mount, newiso, bootstrap, tmp_dir=None, env_vars={}):
+        """Builds an ISO file containing all our modifications."""
+        isocreate = get_path("genisoimage")
+        if not isocreate:
+            log.error("Either genisoimage or mkisofs is required!")
+            return False
+
+        outdir = tempfile.mkdtemp(dir=tmp_dir)
+        # The mounted iso files are read-only and we need lowercase (aka
+        # case-insensitive) filepaths. Rather than copying the whole tree,
+        # genisoimage reads the files from the mount under lowercase names.
+        # Only the files the OS handler changes are copied to outdir.
+        for target in self.iso_edit_files:
+            source = find_nocase(mount, target)
+            if not source or not os.path.isfile(source):
+                continue
+
+            filepath = os.path.join(outdir, target)
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            shutil.copyfile(source, filepath)
+            os.chmod(filepath, stat.S_IRUSR | stat.S_IWUSR)
+
+        if not self._write_outdir(outdir, bootstrap, tmp_dir, env_vars):
+            shutil.rmtree(outdir)
+            return False
+
+        # Files in outdir take the place of those of the original ISO.
+        replaced = []
+        for dirpath, dirnames, filenames in os.walk(outdir):
+            reldir = os.path.relpath(dirpath, outdir)
+            replaced.extend(
+                os.path.normpath(os.path.join(reldir, fname))
+                for fname in filenames
+            )
+        grafts = iso_graft_points(mount, exclude=replaced)
+
+        fd, path_list = tempfile.mkstemp(suffix=".lst", dir=tmp_dir)
+        os.close(fd)
+        write_path_list(path_list, grafts)
 
         args = [
             isocreate, "-quiet", "-b", "boot.img", "-o", newiso,
-        ] + self.genisoargs + [outdir]
+        ] + self.genisoargs + [
+            "-graft-points", "-path-list", path_list, outdir,
+        ]
 
         log.debug("Executing genisoimage: %s", " ".join(args))
         p = subprocess.Popen(
@@ -189,11 +264,34 @@ class OperatingSystem(object):
                 p.wait(), out, err
             )
             shutil.rmtree(outdir)
+            os.remove(path_list)
             return False
 
         shutil.rmtree(outdir)
+        os.remove(path_list)
         return True
 
+    def buildiso_image(self, iso, newiso, bootstrap, tmp_dir=None,
+                       env_vars={}):
+        """Builds an ISO file from the IsoImage iso with all our
+        modifications. The files are read from the UDF tree of the image if
+        it has one, and the new ISO file gets one too through genisoargs.
+        genisoimage needs real files, so the files are extracted first. The
+        kernel copies their extents with copy_file_range(), which shares the
+        data instead on file systems that support it."""
+        if not get_path("genisoimage"):
+            log.error("Either genisoimage or mkisofs is required!")
+            return False
+
+        srcdir = tempfile.mkdtemp(dir=tmp_dir)
+        try:
+            iso.extract_tree(srcdir)
+            return self.buildiso(
+                srcdir, newiso, bootstrap, tmp_dir, env_vars=env_vars
+            )
+        finally:
+            shutil.rmtree(srcdir)
+
 class WindowsAutounattended(OperatingSystem):
     """Abstract wrapper around Windows-based Operating Systems that use the
     autounattend.xml file for automated installation, i.e., Windows 7+."""
@@ -201,6 +299,7 @@ class WindowsAutounattended(OperatingSystem):
     os_name = "windows"
     nictype = "82540EM"
     osdir = os.path.join("sources", "$oem$", "$1")
+    iso_edit_files = [os.path.join("sources", "product.ini")]
     dummy_serial_key = None
     genisoargs = [
         "-no-emul-boot", "-iso-level", "2", "-udf", "-J", "-l", "-D", "-N",
@@ -285,6 +384,75 @@ class WindowsAutounattended(OperatingSystem):
         self.serial_key = serial_key or self.dummy_serial_key
         return True
 
+def missing_downloadables(downloadables, verify=False):
+    """Return the downloadables that are not in the deps folder yet or of
+    which the file does not have the expected hash. Files are only hashed
+    if they changed since they were last hashed, or with verify."""
+    missing = []
+    for downloadable in downloadables:
+        filepath, _, expected_sha1sum, version = downloadable
+        # Skip check if we need the latest version. We cannot know what
+        # the download file version is since we never know the hash of the
+        # latest version.
+        if version == "latest":
+            missing.append(downloadable)
+            continue
+
+        if not os.path.exists(filepath):
+            missing.append(downloadable)
+            continue
+
+        if expected_sha1sum and \
+                expected_sha1sum != file_sha1(filepath, verify):
+            missing.append(downloadable)
+
+    return missing
+
+def fetch_downloadable(downloadable):
+    """Download a file from the first of its URLs that gives the expected
+    hash. The URLs are tried from the fastest to the slowest host. Files
+    with a known hash are taken from the artifact cache if it has them, and
+    are published to it after they are downloaded."""
+    filepath, urllist, expected_sha1, _ = downloadable
+    index = hash_index(os.path.dirname(filepath))
+    cache = artifact_cache() if expected_sha1 else None
+    if cache and cache.fetch(expected_sha1, filepath):
+        log.debug(f"Using {os.path.basename(filepath)} from {cache}")
+        index.update(filepath, expected_sha1)
+        return
+
+    stats = host_stats()
+    for url in order_urls(urllist, stats):
+        success, sha1hash = download_file(
+            url, filepath, segments=DOWNLOAD_SEGMENTS
+        )
+        stats.record(url_host(url), failed=not success)
+        if not success:
+            log.warning(f"Failed to download file from: {url}")
+            continue
+
+        if expected_sha1 and sha1hash != expected_sha1:
+            log.warning(
+                f"Calculated sha1 hash '{sha1hash}' of downloaded "
+                f"file {filepath} did not match expected hash "
+                f"'{expected_sha1}'. File source: {url}"
+            )
+            os.remove(filepath)
+            continue
+
+        # No issues with the download, do not download more. The hash was
+        # calculated while downloading, so remember it.
+        index.update(filepath, sha1hash)
+        if cache:
+            cache.publish(expected_sha1, filepath)
+        break
+
+    if not os.path.isfile(filepath) or os.path.getsize(filepath) == 0:
+        raise DependencyError(
+            f"No valid file was downloaded from any of the sources: "
+            f"{', '.join(urllist)}"
+        )
+
 class Dependency(object):
     """Dependency instance. Each software has its own dependency class which
     informs VMCloak on how to install that particular piece of software."""
@@ -330,21 +498,9 @@ class Dependency(object):
                 setattr(self, key, value)
 
         # Locate the matching installer.
-        for exe in self.exes:
-            if "target" in exe and exe["target"] != i.osversion:
-                continue
-
-            if "arch" in exe and exe["arch"] != self.arch:
-                continue
-
-            if "version" in exe and self.version and \
-                    exe["version"] != self.version:
-                continue
-
-            self.exe = exe
-            break
-        else:
-            if self.exes and self.i.osversion not in self.no_exe:
+        if self.exes:
+            self.exe = self.find_exe(self.version, i.osversion, self.arch)
+            if not self.exe and self.i.osversion not in self.no_exe:
                 log.error(
                     f"Could not find the correct installer"
                     f" {self.name} ({self.version or ''}) for "
@@ -361,8 +517,30 @@ class Dependency(object):
         if self.check() is False:
             raise DependencyError("Check failed")
 
+    @classmethod
+    def find_exe(cls, version, osversion, arch):
+        """Return the exes entry for the version, OS version and
+        architecture, or None."""
+        for exe in cls.exes:
+            if "target" in exe and exe["target"] != osversion:
+                continue
+
+            if "arch" in exe and exe["arch"] != arch:
+                continue
+
+            if "version" in exe and version and exe["version"] != version:
+                continue
+
+            return exe
+
+        return None
+
     @classmethod
     def get_dependencies(cls, image):
+        return cls.dependencies_for(image.osversion)
+
+    @classmethod
+    def dependencies_for(cls, osversion):
         if cls.depends:
             if isinstance(cls.depends, str):
                 return [cls.depends]
@@ -370,39 +548,18 @@ class Dependency(object):
             return cls.depends
 
         if cls.os_depends:
-            deps = cls.os_depends.get(image.osversion, [])
+            deps = cls.os_depends.get(osversion, [])
             if isinstance(deps, str):
                 return [deps]
 
             return deps
 
     def _do_downloads(self, filepaths_urllist_sha1_v):
-        for filepath, urllist, expected_sha1, _, in filepaths_urllist_sha1_v:
-            for url in urllist:
-                success, sha1hash = download_file(url, filepath)
-                if not success:
-                    log.warning(f"Failed to download file from: {url}")
-                    continue
-
-                if expected_sha1 and sha1hash != expected_sha1:
-                    log.warning(
-                        f"Calculated sha1 hash '{sha1hash}' of downloaded "
-                        f"file {filepath} did not match expected hash "
-                        f"'{expected_sha1}'. File source: {url}"
-                    )
-                    os.remove(filepath)
-                    continue
-
-                # No issues with the download, do not download more.
-                break
+        for downloadable in filepaths_urllist_sha1_v:
+            fetch_downloadable(downloadable)
 
-            if not os.path.isfile(filepath) or os.path.getsize(filepath) == 0:
-                raise DependencyError(
-                    f"No valid file was downloaded from any of the sources: "
-                    f"{', '.join(urllist)}"
-                )
-
-    def _find_downloadable_files(self, download_dictlist):
+    @classmethod
+    def _find_downloadable_files(cls, download_dictlist):
         downloadables = []
         for downloadable_file in download_dictlist:
             all_urls = []
@@ -436,6 +593,22 @@ class Dependency(object):
 
         return downloadables
 
+    @classmethod
+    def downloadables(cls, version=None, osversion=None, arch=None):
+        """Return the (filepath, urls, sha1, version) of the files this
+        dependency downloads for the version, OS version and architecture,
+        without creating an instance."""
+        exe = None
+        if cls.exes:
+            exe = cls.find_exe(version or cls.default, osversion, arch)
+
+        try:
+            return cls._find_downloadable_files(
+                ([exe] if exe else []) + list(cls.files)
+            )
+        except KeyError as e:
+            raise DependencyError(f"Unable to get resource. {e}")
+
     def download(self):
         downloadables = []
         try:
@@ -452,25 +625,7 @@ class Dependency(object):
         except KeyError as e:
             raise DependencyError(f"Unable to get resource. {e}")
 
-        # Check which of the downloadable files already exist.
-        for downloadable in downloadables[:]:
-            filepath, _, expected_sha1sum, version = downloadable
-            # Skip check if we need the latest version. We cannot know what
-            # the download file version is since we never know the hash of the
-            # latest version.
-            if version == "latest":
-                continue
-
-            if not os.path.exists(filepath):
-                continue
-
-            if expected_sha1sum and expected_sha1sum != sha1_file(filepath):
-                continue
-
-            # Remove downloadable file from download list because it exists
-            # and it is the expected hash or there was no expected hash.
-            downloadables.remove(downloadable)
-
+        downloadables = missing_downloadables(downloadables)
         if downloadables:
             log.debug(
                 f"Downloading (installation) files for dependency "
@@ -502,23 +657,77 @@ class Dependency(object):
 
     def upload_file(self, filepath, to_machine_filepath):
         """Upload the specified filepath to the specified machine filepath"""
-        self.a.upload(to_machine_filepath, open(filepath, "rb"))
+        self.a.upload_from(to_machine_filepath, filepath)
 
     def upload_dependency(self, filepath):
         """Upload this dependency to the specified filepath."""
         self.upload_file(self.filepath, filepath)
 
-    def wait_process_appear(self, process_name):
+    def _wait_process_guest(self, script, process_name, timeout):
+        """Run a process wait script in the guest. The wait and its timeout
+        happen in the guest, so this takes a single Agent call. Returns
+        True if the wait finished before the timeout. Raises CommandError
+        if the wait script itself failed."""
+        name = process_name
+        if name.lower().endswith(".exe"):
+            name = name[:-4]
+        res = self.run_powershell_encoded(
+            script % {"name": name.replace("'", "''"), "timeout": timeout or 0}
+        )
+        exit_code = res.get("exit_code")
+        if exit_code == 0:
+            return True
+        if exit_code == _WAIT_TIMEOUT_EXIT_CODE:
+            return False
+
+        raise CommandError(
+            f"Waiting for process '{process_name}' failed with exit code "
+            f"{exit_code}: {res.get('stderr') or res.get('error')}"
+        )
+
+    def wait_process_appear(self, process_name, timeout=None):
         """Wait for a process to appear."""
+        # Windows XP does not come with PowerShell.
+        if self.h.name == "winxp":
+            return self._poll_process_appear(process_name, timeout)
+
+        if not self._wait_process_guest(
+                _WAIT_APPEAR_PS1, process_name, timeout):
+            raise TimeoutError(
+                f"Process '{process_name}' did not appear after {timeout} "
+                f"seconds."
+            )
+
+    def wait_process_exit(self, process_name, timeout=None):
+        """Wait for a process to exit."""
+        if self.h.name == "winxp":
+            return self._poll_process_exit(process_name, timeout)
+
+        log.debug("Waiting for %s to finish..", process_name)
+        if not self._wait_process_guest(
+                _WAIT_EXIT_PS1, process_name, timeout):
+            raise TimeoutError(
+                f"Process '{process_name}' did not exit after {timeout} "
+                f"seconds."
+            )
+
+    def _poll_process_appear(self, process_name, timeout=None):
+        waited = 0
         while True:
             time.sleep(1)
+            waited += 1
 
             for line in self.a.execute("tasklist")["stdout"].split("\n"):
                 if line.lower().startswith(process_name.lower()):
                     return
 
-    def wait_process_exit(self, process_name, timeout=None):
-        """Wait for a process to exit."""
+            if timeout and waited >= timeout:
+                raise TimeoutError(
+                    f"Process '{process_name}' did not appear after "
+                    f"{waited} seconds."
+                )
+
+    def _poll_process_exit(self, process_name, timeout=None):
         waited = 0
         cmd = f"tasklist /FO TABLE /NH /FI \"IMAGENAME eq {process_name}\""
         while True:
@@ -543,6 +752,15 @@ class Dependency(object):
             f'powershell -ExecutionPolicy bypass "{command}"'
         )
 
+    def run_powershell_encoded(self, script):
+        """Run a PowerShell script passed on the command line. This needs no
+        upload and no quoting, at the cost of a limited script size."""
+        encoded = base64.b64encode(script.encode("utf-16-le")).decode()
+        return self.a.execute(
+            f"powershell -NoProfile -NonInteractive -ExecutionPolicy bypass "
+            f"-EncodedCommand {encoded}"
+        )
+
     def run_powershell_strings(self, powershell_strings):
         script_winpath = f"c:\\{random_string(6, 10)}.ps1"
         self.a.upload(script_winpath, powershell_strings)
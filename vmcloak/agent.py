@@ -2,58 +2,347 @@
 # This file is part of VMCloak - http://www.vmcloak.org/.
 # See the file 'docs/LICENSE.txt' for copying permission.
 
+import hashlib
 import io
 import logging
+import os
+import shutil
+import tempfile
+import time
+import uuid
+import zipfile
+
 import requests
 
 from vmcloak.misc import wait_for_agent
+from vmcloak.rand import random_string
 
 log = logging.getLogger(__name__)
 
+# Windows reads the hostname from these values. The wmic rename only changes
+# the values that are used after a reboot.
+_ACTIVE_HOSTNAME_KEYS = (
+    ("HKLM\\SYSTEM\\CurrentControlSet\\Control\\ComputerName\\"
+     "ActiveComputerName", "ComputerName"),
+    ("HKLM\\SYSTEM\\CurrentControlSet\\Services\\Tcpip\\Parameters",
+     "Hostname"),
+)
+
+# Sets the NetworkAddress value of the adapter and restarts it so the new MAC
+# is used. The IP is set afterwards, as the restart drops the connection.
+_CHANGE_MAC_PS1 = """
+$nic = Get-WmiObject Win32_NetworkAdapter | Where-Object {
+    $_.NetConnectionID -eq "%(interface)s"
+}
+$class = "HKLM:\\SYSTEM\\CurrentControlSet\\Control\\Class\\" +
+    "{4D36E972-E325-11CE-BFC1-08002BE10318}"
+Get-ChildItem $class -ErrorAction SilentlyContinue | ForEach-Object {
+    $props = Get-ItemProperty $_.PSPath -ErrorAction SilentlyContinue
+    if ($props.NetCfgInstanceId -eq $nic.GUID) {
+        Set-ItemProperty $_.PSPath -Name NetworkAddress -Value "%(mac)s"
+    }
+}
+$nic.Disable() | Out-Null
+$nic.Enable() | Out-Null
+%(netsh)s
+"""
+
+TRANSFER_CHUNK_SIZE = 1024 * 1024
+
+# Bundles are built in memory up to this size and spill to disk beyond it.
+BUNDLE_SPOOL_SIZE = 64 * 1024 * 1024
+
+# Files with these extensions are already compressed and are stored in
+# bundles as is. Other files are deflated.
+STORED_EXTENSIONS = (
+    ".7z", ".cab", ".exe", ".gz", ".jpg", ".msi", ".msp", ".msu", ".png",
+    ".rar", ".zip",
+)
+
+class _Progress(object):
+    """Calls the progress callback with (transferred, total) after each chunk
+    and logs the throughput when the transfer is done."""
+
+    def __init__(self, what, total, callback=None):
+        self.what = what
+        self.total = total
+        self.callback = callback
+        self.done = 0
+        self.start = time.monotonic()
+
+    def update(self, amount):
+        self.done += amount
+        if self.callback:
+            self.callback(self.done, self.total)
+
+    def finish(self):
+        elapsed = max(time.monotonic() - self.start, 0.001)
+        log.debug(
+            "%s: %.1fMB in %.1fs (%.1fMB/s)", self.what, self.done / 1024**2,
+            elapsed, self.done / 1024**2 / elapsed
+        )
+
+class _MultipartUpload(object):
+    """A multipart/form-data body for the /store and /extract calls of the
+    Agent that reads the file in chunks while it is being sent, instead of
+    building the whole body in memory. The SHA-1 of the file is calculated
+    on the fly."""
+
+    def __init__(self, fp, size, fields, field="file", progress=None):
+        self.fp = fp
+        self.size = size
+        self.progress = progress
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+        self._head = "".join(
+            f"--{self.boundary}\r\n"
+            f"Content-Disposition: form-data; name=\"{name}\"\r\n\r\n"
+            f"{value}\r\n"
+            for name, value in fields.items()
+        ).encode() + (
+            f"--{self.boundary}\r\n"
+            f"Content-Disposition: form-data; name=\"{field}\"; "
+            f"filename=\"{field}\"\r\n"
+            f"Content-Type: application/octet-stream\r\n\r\n"
+        ).encode()
+        self._tail = f"\r\n--{self.boundary}--\r\n".encode()
+        self._offset = fp.tell()
+        self.seek(0)
+
+    def __len__(self):
+        return len(self._head) + self.size + len(self._tail)
+
+    def __iter__(self):
+        while True:
+            buf = self.read(TRANSFER_CHUNK_SIZE)
+            if not buf:
+                return
+            yield buf
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset):
+        """Only rewinding to the start is supported, for retries."""
+        if offset != 0:
+            raise ValueError("Can only seek to the start of an upload")
+
+        self.fp.seek(self._offset)
+        self.sha1 = hashlib.sha1()
+        self._pos = 0
+        self._parts = [self._head, None, self._tail]
+
+    def read(self, size=-1):
+        while self._parts:
+            part = self._parts[0]
+            if part is None:
+                buf = self.fp.read(TRANSFER_CHUNK_SIZE if size < 0 else size)
+                if buf:
+                    self.sha1.update(buf)
+                    if self.progress:
+                        self.progress.update(len(buf))
+                    self._pos += len(buf)
+                    return buf
+            elif part:
+                buf, self._parts[0] = (
+                    (part, b"") if size < 0 else (part[:size], part[size:])
+                )
+                self._pos += len(buf)
+                return buf
+
+            self._parts.pop(0)
+
+        return b""
+
+_BATCH_MARKER = "@@vmcloak-batch@@"
+
+def _batch_script(commands, stop_on_error=False):
+    """Return the batch file that runs the commands for execute_many."""
+    lines = ["@echo off"]
+    for i, command in enumerate(commands):
+        lines.extend([
+            f"echo {_BATCH_MARKER} begin {i}",
+            f"({command.replace('%', '%%')}) 2>&1",
+            f"echo {_BATCH_MARKER} end {i} %ERRORLEVEL%",
+        ])
+        if stop_on_error:
+            lines.append('if not "%ERRORLEVEL%"=="0" goto done')
+
+    # Leave the batch file before deleting it, or cmd fails to read the
+    # next line of the deleted file.
+    lines.extend([":done", '(goto) 2>nul & del "%~f0"'])
+    return "\r\n".join(lines) + "\r\n"
+
+def _parse_batch_output(commands, stdout):
+    """Split the output of an execute_many batch file per command, using
+    the markers echoed around each command."""
+    results = [
+        {"command": command, "exit_code": None, "output": ""}
+        for command in commands
+    ]
+    current = None
+    output = []
+    for line in stdout.splitlines():
+        # Output without a trailing newline ends up in front of the marker.
+        before, marker, after = line.partition(_BATCH_MARKER)
+        if current is not None and (before or not marker):
+            output.append(before)
+        if not marker:
+            continue
+
+        fields = after.split()
+        if fields[0] == "begin":
+            current = int(fields[1])
+            output = []
+        elif fields[0] == "end" and current is not None:
+            try:
+                results[current]["exit_code"] = int(fields[2])
+            except (IndexError, ValueError):
+                pass
+            results[current]["output"] = "\n".join(output)
+            current = None
+
+    return results
+
+def _parse_sha1(stdout):
+    """Return the SHA-1 in the output of certutil -hashfile, or None."""
+    for line in (stdout or "").splitlines():
+        line = line.replace(" ", "").strip().lower()
+        if len(line) == 40 and all(c in "0123456789abcdef" for c in line):
+            return line
+    return None
+
+def _remaining_size(fp):
+    # Seeking instead of fstat, as fileno() makes a SpooledTemporaryFile
+    # write itself to disk.
+    pos = fp.tell()
+    size = fp.seek(0, os.SEEK_END) - pos
+    fp.seek(pos)
+    return size
+
+def _bundle_add(bundle, name, source):
+    """Add the local file or file object 'source' to the zip 'bundle'."""
+    info = zipfile.ZipInfo(name, time.localtime()[:6])
+    if name.lower().endswith(STORED_EXTENSIONS):
+        info.compress_type = zipfile.ZIP_STORED
+    else:
+        info.compress_type = zipfile.ZIP_DEFLATED
+
+    if isinstance(source, str):
+        with open(source, "rb") as fp:
+            return _bundle_add(bundle, name, fp)
+
+    info.external_attr = 0o644 << 16
+    large = _remaining_size(source) >= zipfile.ZIP64_LIMIT
+    with bundle.open(info, "w", force_zip64=large) as dst:
+        shutil.copyfileobj(source, dst, TRANSFER_CHUNK_SIZE)
+
 class Agent(object):
-    def __init__(self, ipaddr, port):
-        self.ipaddr = ipaddr
+    def __init__(self, ipaddr, port, connect_timeout=10, read_timeout=None,
+                 retries=3, backoff=0.5, session=None):
+        # No read timeout by default, as /execute only returns when the
+        # command has finished. Installers may run for a long time.
+        self._ipaddr = ipaddr
         self.port = port
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        # A session given by the caller may be shared with other Agents, so
+        # it is never closed by this Agent.
+        self._session = session
+        self._shared_session = session is not None
+        self._environ = None
 
-    def get(self, method, *args, **kwargs):
-        """Wrapper around GET requests."""
-        url = "http://%s:%s%s" % (self.ipaddr, self.port, method)
-        session = requests.Session()
-        session.trust_env = False
-        session.proxies = None
-        return session.get(url, *args, **kwargs)
+    @property
+    def ipaddr(self):
+        return self._ipaddr
 
-    def post(self, method, **kwargs):
-        """Wrapper around POST requests."""
+    @ipaddr.setter
+    def ipaddr(self, ipaddr):
+        # Pooled connections are bound to the old address.
+        if ipaddr != self._ipaddr:
+            self.close()
+        self._ipaddr = ipaddr
+
+    @property
+    def session(self):
+        """The keep-alive session used for all requests to the Agent."""
+        if not self._session:
+            self._session = requests.Session()
+            self._session.trust_env = False
+            self._session.proxies = None
+        return self._session
+
+    def close(self):
+        """Close the pooled connections to the Agent. The cached environment
+        is dropped too, as the next connection may be to a restarted
+        Agent."""
+        self._environ = None
+        if self._session and not self._shared_session:
+            self._session.close()
+            self._session = None
+
+    def request(self, verb, method, idempotent=False, **kwargs):
+        """Send a request to the Agent. Idempotent requests are retried with
+        an exponential backoff if the connection fails or times out."""
         url = "http://%s:%s%s" % (self.ipaddr, self.port, method)
-        session = requests.Session()
-        session.trust_env = False
-        session.proxies = None
+        kwargs.setdefault("timeout", self.timeout)
+        attempts = self.retries + 1 if idempotent else 1
+        # Uploaded files must be sent from the start again on a retry.
+        bodies = list((kwargs.get("files") or {}).values())
+        bodies.append(kwargs.get("data"))
+        rewind = [(f, f.tell()) for f in bodies if hasattr(f, "seek")]
+        for attempt in range(attempts):
+            for f, offset in rewind:
+                f.seek(offset)
+            try:
+                return self.session.request(verb, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt + 1 >= attempts:
+                    raise
+
+                delay = self.backoff * 2 ** attempt
+                log.debug(
+                    "Request %s to %s failed, retrying in %.1fs: %s",
+                    method, self.ipaddr, delay, e
+                )
+                # Do not reuse a connection that may be broken.
+                self.close()
+                time.sleep(delay)
 
+    def get(self, method, idempotent=True, **kwargs):
+        """Wrapper around GET requests."""
+        return self.request("GET", method, idempotent=idempotent, **kwargs)
+
+    def post(self, method, idempotent=False, **kwargs):
+        """Wrapper around POST requests."""
         # agent on the vm will only accept async as an argument
         # for async execution
         if "cucksync" in kwargs:
             del kwargs["cucksync"]
             kwargs["async"] = "true"
 
-        return session.post(url, data=kwargs)
+        return self.request("POST", method, idempotent=idempotent, data=kwargs)
 
-    def postfile(self, method, files, **kwargs):
+    def postfile(self, method, files, idempotent=False, **kwargs):
         """Wrapper around POST requests with attached files."""
-        url = "http://%s:%s%s" % (self.ipaddr, self.port, method)
-        session = requests.Session()
-        session.trust_env = False
-        session.proxies = None
-        return session.post(url, files=files, data=kwargs)
+        return self.request(
+            "POST", method, idempotent=idempotent, files=files, data=kwargs
+        )
 
     def ping(self):
         """Ping the machine."""
-        return self.get("/", timeout=5)
+        return self.get("/", idempotent=False, timeout=5)
 
     def environ(self, value=None, default=None):
-        """Obtain one or all environment variable(s)."""
-        environ = self.get("/environ").json()["environ"]
-        return environ if value is None else environ.get(value, default)
+        """Obtain one or all environment variable(s). The environment of the
+        Agent process does not change while it runs, so it is fetched once
+        and cached until the Agent is rebooted, killed or reconnected."""
+        if self._environ is None:
+            self._environ = self.get("/environ").json()["environ"]
+        if value is None:
+            return dict(self._environ)
+        return self._environ.get(value, default)
 
     def execute(self, command, cucksync=False):
         """Execute a command."""
@@ -67,6 +356,27 @@ class Agent(object):
                 "stdout": resp.get("stdout"), "stderr": resp.get("stderr")
             }
 
+    def execute_many(self, commands, stop_on_error=False):
+        """Execute a list of commands using a single batch file and a single
+        /execute request. The batch file removes itself. Returns a dict with
+        the exit_code and output (stdout and stderr) of each command, in
+        order. With stop_on_error, the commands after the first failing one
+        are not run. Their exit_code is None.
+
+        Percent signs are passed literally, so environment variables in the
+        commands are not expanded."""
+        if not commands:
+            return []
+
+        script_path = f"C:\\vmcloak_batch_{random_string(8)}.bat"
+        log.debug(
+            "Executing %s commands in VM using %s", len(commands), script_path
+        )
+        self.upload(script_path, _batch_script(commands, stop_on_error))
+        resp = self.post("/execute", command=f"cmd /c {script_path}")
+        stdout = resp.json().get("stdout") or ""
+        return _parse_batch_output(commands, stdout)
+
     def execpy(self, filepath, cucksync=False):
         """Execute a Python file."""
         if cucksync:
@@ -76,28 +386,64 @@ class Agent(object):
 
     def remove(self, path):
         """Remove a file or entire directory."""
-        self.post("/remove", path=path)
+        self.post("/remove", idempotent=True, path=path)
+
+    def extract(self, dirpath, zipfile, progress=None):
+        """Extract a zip file to folder. The zip file is a local path or a
+        file object and is streamed to the Agent."""
+        if isinstance(zipfile, str):
+            with open(zipfile, "rb") as fp:
+                return self.extract(dirpath, fp, progress)
 
-    def extract(self, dirpath, zipfile):
-        """Extract a zip file to folder."""
-        zipfile = open(zipfile, "rb")
-        self.postfile("/extract", {"zipfile": zipfile}, dirpath=dirpath)
+        size = _remaining_size(zipfile)
+        p = _Progress(f"Extracted zip to {dirpath}", size, progress)
+        body = _MultipartUpload(
+            zipfile, size, {"dirpath": dirpath}, "zipfile", p
+        )
+        self.request(
+            "POST", "/extract", idempotent=True, data=body,
+            headers={"Content-Type": body.content_type}
+        )
+        p.finish()
+
+    def upload_bundle(self, dirpath, files, progress=None):
+        """Upload several files to the folder dirpath in a single request.
+        'files' maps the name of each file in dirpath to a local path or a
+        file object. The files are packed in a zip that the Agent extracts.
+        Already compressed files are stored, others are deflated. Returns
+        the paths of the files on the machine, in the order of 'files'."""
+        root = dirpath.rstrip("\\")
+        paths = []
+        with tempfile.SpooledTemporaryFile(BUNDLE_SPOOL_SIZE) as fp:
+            with zipfile.ZipFile(fp, "w", allowZip64=True) as bundle:
+                for name, source in files.items():
+                    name = name.replace("\\", "/")
+                    _bundle_add(bundle, name, source)
+                    paths.append(root + "\\" + name.replace("/", "\\"))
+
+            fp.seek(0)
+            self.extract(dirpath, fp, progress)
+
+        return paths
 
     def shutdown(self):
         """Power off the machine."""
         # Use 1 second timer with cucksync to prevent the machine from shutting
         # down while a response is being sent or before it is sent.
         self.execute("shutdown -s -t 1", cucksync=True)
+        self.close()
 
     def reboot(self):
         """Reboot the machine."""
         # Use 1 second timer with cucksync to prevent the machine from shutting
         # down while a response is being sent or before it is sent.
         self.execute("shutdown -r -t 1", cucksync=True)
+        self.close()
 
     def kill(self):
         """Kill the Agent."""
-        self.get("/kill")
+        self.get("/kill", idempotent=False)
+        self.close()
 
     def killprocess(self, process_name, force=True):
         """Terminate a process."""
@@ -106,30 +452,53 @@ class Agent(object):
             cmd += " /F"
         self.execute(cmd)
 
-    def hostname(self, hostname):
-        """Assign a new hostname."""
+    def hostname(self, hostname, live=False):
+        """Assign a new hostname. The rename takes effect after a reboot.
+        With live, the active hostname is also changed right away. Running
+        processes, including the Agent and everything it starts, keep the
+        old COMPUTERNAME and USERDOMAIN environment variables."""
         cmdline = "wmic computersystem where name=\"%(oldname)s\" " \
             "call rename name=\"%(newname)s\""
         args = dict(oldname=self.environ("COMPUTERNAME"), newname=hostname)
 
         # self.execute(cmdline % args, shell=True)
         self.execute(cmdline % args)
+        if not live:
+            return
+
+        for key, value in _ACTIVE_HOSTNAME_KEYS:
+            self.execute(
+                f"reg add \"{key}\" /v \"{value}\" /t REG_SZ "
+                f"/d {hostname} /f"
+            )
 
-    def static_ip(self, ipaddr, netmask, gateway, interface):
-        """Change the IP address of this machine."""
+    def static_ip(self, ipaddr, netmask, gateway, interface, mac=None):
+        """Change the IP address of this machine. If mac is given, the MAC
+        address of the interface is changed first. This is needed when the
+        NIC of a running VM was given a new MAC address. Raises IOError if
+        the interface does not use the new MAC address afterwards."""
         command = (
             "netsh interface ip set address name=\"%s\" static %s %s %s 1"
         ) % (interface, ipaddr, netmask, gateway)
+        script_path = None
+        if mac:
+            script_path = "C:\\vmcloak_mac.ps1"
+            self.upload(script_path, _CHANGE_MAC_PS1 % {
+                "interface": interface,
+                "mac": mac.replace(":", "").upper(),
+                "netsh": command
+            })
+            command = (
+                "powershell -NoProfile -ExecutionPolicy bypass "
+                f"-File {script_path}"
+            )
+
         log.debug("Executing command in VM: %s", command)
         try:
-            session = requests.Session()
-            session.trust_env = False
-            session.proxies = None
-            session.post(
-                "http://%s:%s/execute" % (self.ipaddr, self.port),
-                data={"command": command}, timeout=5
+            self.request(
+                "POST", "/execute", data={"command": command}, timeout=5
             )
-        except requests.exceptions.ConnectionError:
+        except (requests.ConnectionError, requests.Timeout):
             pass
 
         # Now wait until the Agent is reachable on the new IP address.
@@ -138,6 +507,25 @@ class Agent(object):
             f"Waiting for agent to be reachable on: {self.ipaddr}:{self.port}"
         )
         wait_for_agent(self)
+        if not script_path:
+            return
+
+        self.remove(script_path)
+        current = self.mac_address(interface)
+        if current != mac.lower():
+            raise IOError(
+                f"MAC address of {interface} is {current} instead of {mac}"
+            )
+
+    def mac_address(self, interface):
+        """Return the MAC address of the interface in lowercase with colons,
+        or None if the interface is not found."""
+        stdout = self.execute("getmac /v /fo csv /nh")["stdout"] or ""
+        for line in stdout.splitlines():
+            fields = [f.strip('"') for f in line.strip().split('","')]
+            if len(fields) >= 3 and fields[0] == interface:
+                return fields[2].replace("-", ":").lower()
+        return None
 
     def dns_server(self, ipaddr):
         """Set the IP address of the DNS server."""
@@ -147,14 +535,86 @@ class Agent(object):
         self.execute(command)
 
     def upload(self, filepath, contents):
-        """Upload a file to the Agent."""
+        """Upload a file to the Agent. File objects are streamed."""
         if isinstance(contents, str):
-            contents = io.BytesIO(contents.encode())
-        self.postfile("/store", {"file": contents}, filepath=filepath)
+            contents = contents.encode()
+        if not isinstance(contents, bytes):
+            return self.upload_from(filepath, contents)
+
+        self.postfile(
+            "/store", {"file": io.BytesIO(contents)}, idempotent=True,
+            filepath=filepath
+        )
+
+    def upload_from(self, filepath, source, progress=None, verify=False):
+        """Stream the local file at path 'source', or the file object
+        'source', to filepath on the machine. Calls progress(transferred,
+        total) while uploading. Returns the SHA-1 of the uploaded data. With
+        verify, the SHA-1 of the file on the machine is compared to it."""
+        if isinstance(source, str):
+            with open(source, "rb") as fp:
+                return self.upload_from(filepath, fp, progress, verify)
+
+        size = _remaining_size(source)
+        p = _Progress(f"Uploaded {filepath}", size, progress)
+        body = _MultipartUpload(
+            source, size, {"filepath": filepath}, "file", p
+        )
+        self.request(
+            "POST", "/store", idempotent=True, data=body,
+            headers={"Content-Type": body.content_type}
+        )
+        p.finish()
+
+        sha1 = body.sha1.hexdigest()
+        if verify:
+            remote = self.sha1(filepath)
+            if remote != sha1:
+                raise IOError(
+                    f"Upload of {filepath} is corrupt. SHA-1 is {remote}, "
+                    f"expected {sha1}"
+                )
+        return sha1
+
+    def sha1(self, filepath):
+        """Calculate the SHA-1 of a file on the machine."""
+        out = self.execute(f"certutil -hashfile \"{filepath}\" SHA1")
+        return _parse_sha1(out["stdout"])
 
     def retrieve(self, filepath):
         """Retrieve a file from the Agent."""
-        return self.post("/retrieve", filepath=filepath).content
+        buf = io.BytesIO()
+        self.retrieve_to(filepath, buf)
+        return buf.getvalue()
+
+    def retrieve_to(self, filepath, target, progress=None):
+        """Stream a file from the Agent to the local path or file object
+        'target'. Calls progress(transferred, total) while downloading.
+        Returns the size and SHA-1 of the file."""
+        if isinstance(target, str):
+            with open(target, "wb") as fp:
+                return self.retrieve_to(filepath, fp, progress)
+
+        resp = self.request(
+            "POST", "/retrieve", idempotent=True, data={"filepath": filepath},
+            stream=True
+        )
+        with resp:
+            if resp.status_code != 200:
+                raise IOError(
+                    f"Could not retrieve {filepath}: HTTP {resp.status_code}"
+                )
+
+            total = int(resp.headers.get("Content-Length") or 0) or None
+            p = _Progress(f"Retrieved {filepath}", total, progress)
+            sha1 = hashlib.sha1()
+            for buf in resp.iter_content(TRANSFER_CHUNK_SIZE):
+                target.write(buf)
+                sha1.update(buf)
+                p.update(len(buf))
+
+        p.finish()
+        return p.done, sha1.hexdigest()
 
     def click(self, window_title, button_name):
         """Identify a window by its title and click one of its buttons."""
@@ -0,0 +1,521 @@
+# Copyright (C) 2026 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+"""asyncio counterpart of the Agent client, to drive many VMs from a single
+process.
+
+Requests are sent over asyncio streams, so a command that runs in the guest
+for a long time does not hold a thread. Each AsyncAgent keeps its idle
+keep-alive connections and opens another one if a request is made while all
+of them are busy, up to max_connections. The Agent only queues a few
+connections that it has not accepted yet. Like the Agent, there is no read
+timeout by default, as /execute only returns once the command has finished.
+
+Waiting for agents only uses TCP connects until the port of an agent is
+open, with the same probe intervals as vmcloak.misc.wait_for_agents, so
+hundreds of agents can be waited on at once."""
+
+import asyncio
+import hashlib
+import io
+import json
+import logging
+import urllib.parse
+
+from vmcloak.agent import (
+    TRANSFER_CHUNK_SIZE, _MultipartUpload, _Progress, _batch_script,
+    _parse_batch_output, _parse_sha1, _remaining_size
+)
+from vmcloak.misc import _probe_interval
+from vmcloak.rand import random_string
+
+log = logging.getLogger(__name__)
+
+# The default maximum amount of connections to a single Agent.
+MAX_CONNECTIONS = 4
+
+_RETRY_ERRORS = (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError)
+
+class _Connection(object):
+    """A keep-alive HTTP/1.1 connection to the Agent."""
+
+    def __init__(self, addr, reader, writer, read_timeout=None):
+        self.addr = addr
+        self.reader = reader
+        self.writer = writer
+        self.read_timeout = read_timeout
+        self.reusable = False
+
+    @property
+    def closed(self):
+        return self.reader.at_eof() or self.writer.is_closing()
+
+    def close(self):
+        self.writer.close()
+
+    async def _read(self, aw):
+        if self.read_timeout is None:
+            return await aw
+        return await asyncio.wait_for(aw, self.read_timeout)
+
+    async def send(self, verb, method, headers, body=None):
+        lines = [f"{verb} {method} HTTP/1.1", f"Host: {self.addr[0]}"]
+        lines.extend(f"{k}: {v}" for k, v in headers.items())
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode())
+        if isinstance(body, bytes):
+            self.writer.write(body)
+        elif body is not None:
+            while True:
+                buf = body.read(TRANSFER_CHUNK_SIZE)
+                if not buf:
+                    break
+                self.writer.write(buf)
+                await self.writer.drain()
+        await self.writer.drain()
+
+    async def read_head(self):
+        """Read the status line and headers of the response."""
+        line = await self._read(self.reader.readline())
+        if not line:
+            raise ConnectionResetError("Connection closed by the Agent")
+
+        version, status = line.decode("latin-1").split(None, 2)[:2]
+        headers = {}
+        while True:
+            line = await self._read(self.reader.readline())
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        self.reusable = version == "HTTP/1.1" and \
+            headers.get("connection", "").lower() != "close"
+        return int(status), headers
+
+    async def read_body(self, headers):
+        """Yield the body of the response in chunks."""
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                line = await self._read(self.reader.readline())
+                size = int(line.split(b";")[0], 16)
+                if not size:
+                    while await self._read(self.reader.readline()) \
+                            not in (b"\r\n", b"\n", b""):
+                        pass
+                    return
+                yield await self._read(self.reader.readexactly(size))
+                await self._read(self.reader.readexactly(2))
+        elif "content-length" in headers:
+            remaining = int(headers["content-length"])
+            while remaining:
+                buf = await self._read(
+                    self.reader.read(min(remaining, TRANSFER_CHUNK_SIZE))
+                )
+                if not buf:
+                    raise ConnectionResetError(
+                        "Connection closed before the response was complete"
+                    )
+                remaining -= len(buf)
+                yield buf
+        else:
+            # The body ends when the Agent closes the connection.
+            self.reusable = False
+            while True:
+                buf = await self._read(self.reader.read(TRANSFER_CHUNK_SIZE))
+                if not buf:
+                    return
+                yield buf
+
+class AgentResponse(object):
+    """The response to an AsyncAgent request. The body is read already,
+    unless the request was streamed. Then chunks() must be consumed."""
+
+    def __init__(self, agent, conn, status_code, headers):
+        self._agent = agent
+        self._conn = conn
+        self.status_code = status_code
+        self.headers = headers
+        self.content = None
+
+    async def chunks(self):
+        try:
+            async for buf in self._conn.read_body(self.headers):
+                yield buf
+        except BaseException:
+            self._conn.reusable = False
+            self._agent._release(self._conn)
+            raise
+        self._agent._release(self._conn)
+
+    async def read(self):
+        bufs = []
+        async for buf in self.chunks():
+            bufs.append(buf)
+        self.content = b"".join(bufs)
+        return self.content
+
+    def json(self):
+        return json.loads(self.content)
+
+class AsyncAgent(object):
+    def __init__(self, ipaddr, port, connect_timeout=10, read_timeout=None,
+                 retries=3, backoff=0.5, max_connections=MAX_CONNECTIONS):
+        self._ipaddr = ipaddr
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_connections = max_connections
+        self._slots = None
+        self._idle = []
+        self._environ = None
+
+    @property
+    def ipaddr(self):
+        return self._ipaddr
+
+    @ipaddr.setter
+    def ipaddr(self, ipaddr):
+        # Idle connections are bound to the old address.
+        if ipaddr != self._ipaddr:
+            self.close()
+        self._ipaddr = ipaddr
+
+    def close(self):
+        """Close the idle connections to the Agent. The cached environment
+        is dropped too, as the next connection may be to a restarted
+        Agent."""
+        self._environ = None
+        while self._idle:
+            self._idle.pop().close()
+
+    async def _connect(self, read_timeout):
+        # Created here, so it belongs to the running event loop.
+        if not self._slots:
+            self._slots = asyncio.Semaphore(self.max_connections)
+        await self._slots.acquire()
+        try:
+            return await self._open(read_timeout)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    async def _open(self, read_timeout):
+        # The Agent may have closed an idle connection in the meantime.
+        while self._idle:
+            conn = self._idle.pop()
+            if not conn.closed:
+                conn.read_timeout = read_timeout
+                return conn
+            conn.close()
+
+        addr = (self.ipaddr, self.port)
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(*addr), self.connect_timeout
+        )
+        return _Connection(addr, reader, writer, read_timeout)
+
+    def _release(self, conn):
+        self._slots.release()
+        if conn.reusable and conn.addr == (self.ipaddr, self.port):
+            self._idle.append(conn)
+        else:
+            conn.close()
+
+    async def request(self, verb, method, idempotent=False, data=None,
+                      timeout=None, stream=False):
+        """Send a request to the Agent. 'data' is a dict of form fields or a
+        _MultipartUpload. 'timeout' is the read timeout and defaults to the
+        one of the AsyncAgent. Idempotent requests are retried with an
+        exponential backoff if the connection fails or times out."""
+        if timeout is None:
+            timeout = self.read_timeout
+
+        headers = {"Content-Length": "0"}
+        body = None
+        if isinstance(data, dict):
+            body = urllib.parse.urlencode(data).encode()
+            headers = {
+                "Content-Type": "application/x-www-form-urlencoded",
+                "Content-Length": str(len(body)),
+            }
+        elif data is not None:
+            body = data
+            headers = {
+                "Content-Type": data.content_type,
+                "Content-Length": str(len(data)),
+            }
+
+        attempts = self.retries + 1 if idempotent else 1
+        for attempt in range(attempts):
+            # Uploaded files must be sent from the start again on a retry.
+            if hasattr(body, "seek"):
+                body.seek(0)
+            conn = None
+            try:
+                conn = await self._connect(timeout)
+                await conn.send(verb, method, headers, body)
+                status, resp_headers = await conn.read_head()
+                break
+            except BaseException as e:
+                if conn:
+                    conn.reusable = False
+                    self._release(conn)
+                if not isinstance(e, _RETRY_ERRORS) or \
+                        attempt + 1 >= attempts:
+                    raise
+
+                delay = self.backoff * 2 ** attempt
+                log.debug(
+                    "Request %s to %s failed, retrying in %.1fs: %r",
+                    method, self.ipaddr, delay, e
+                )
+                # Do not reuse a connection that may be broken.
+                self.close()
+                await asyncio.sleep(delay)
+
+        resp = AgentResponse(self, conn, status, resp_headers)
+        if not stream:
+            await resp.read()
+        return resp
+
+    async def get(self, method, idempotent=True, **kwargs):
+        """Wrapper around GET requests."""
+        return await self.request(
+            "GET", method, idempotent=idempotent, **kwargs
+        )
+
+    async def post(self, method, idempotent=False, **kwargs):
+        """Wrapper around POST requests."""
+        # agent on the vm will only accept async as an argument
+        # for async execution
+        if "cucksync" in kwargs:
+            del kwargs["cucksync"]
+            kwargs["async"] = "true"
+
+        return await self.request(
+            "POST", method, idempotent=idempotent, data=kwargs
+        )
+
+    async def ping(self):
+        """Ping the machine."""
+        return await self.get("/", idempotent=False, timeout=5)
+
+    async def environ(self, value=None, default=None):
+        """Obtain one or all environment variable(s). Cached like the
+        environment of the Agent."""
+        if self._environ is None:
+            self._environ = (await self.get("/environ")).json()["environ"]
+        if value is None:
+            return dict(self._environ)
+        return self._environ.get(value, default)
+
+    async def execute(self, command, cucksync=False):
+        """Execute a command."""
+        log.debug("Executing command in VM: %s", command)
+        if cucksync:
+            return await self.post(
+                "/execute", command=command, cucksync="true"
+            )
+
+        resp = (await self.post("/execute", command=command)).json()
+        return {
+            "exit_code": resp.get("exit_code"), "error": resp.get("error"),
+            "stdout": resp.get("stdout"), "stderr": resp.get("stderr")
+        }
+
+    async def execute_many(self, commands, stop_on_error=False):
+        """Execute a list of commands using a single batch file. See
+        Agent.execute_many."""
+        if not commands:
+            return []
+
+        script_path = f"C:\\vmcloak_batch_{random_string(8)}.bat"
+        log.debug(
+            "Executing %s commands in VM using %s", len(commands), script_path
+        )
+        await self.upload(script_path, _batch_script(commands, stop_on_error))
+        resp = await self.post("/execute", command=f"cmd /c {script_path}")
+        stdout = resp.json().get("stdout") or ""
+        return _parse_batch_output(commands, stdout)
+
+    async def upload(self, filepath, contents):
+        """Upload a file to the Agent. File objects are streamed."""
+        if isinstance(contents, str):
+            contents = contents.encode()
+        if isinstance(contents, bytes):
+            contents = io.BytesIO(contents)
+        await self.upload_from(filepath, contents)
+
+    async def upload_from(self, filepath, source, progress=None,
+                          verify=False):
+        """Stream the local file at path 'source', or the file object
+        'source', to filepath on the machine. See Agent.upload_from."""
+        if isinstance(source, str):
+            with open(source, "rb") as fp:
+                return await self.upload_from(filepath, fp, progress, verify)
+
+        size = _remaining_size(source)
+        p = _Progress(f"Uploaded {filepath}", size, progress)
+        body = _MultipartUpload(
+            source, size, {"filepath": filepath}, "file", p
+        )
+        await self.request("POST", "/store", idempotent=True, data=body)
+        p.finish()
+
+        sha1 = body.sha1.hexdigest()
+        if verify:
+            remote = await self.sha1(filepath)
+            if remote != sha1:
+                raise IOError(
+                    f"Upload of {filepath} is corrupt. SHA-1 is {remote}, "
+                    f"expected {sha1}"
+                )
+        return sha1
+
+    async def sha1(self, filepath):
+        """Calculate the SHA-1 of a file on the machine."""
+        out = await self.execute(f"certutil -hashfile \"{filepath}\" SHA1")
+        return _parse_sha1(out["stdout"])
+
+    async def retrieve(self, filepath):
+        """Retrieve a file from the Agent."""
+        buf = io.BytesIO()
+        await self.retrieve_to(filepath, buf)
+        return buf.getvalue()
+
+    async def retrieve_to(self, filepath, target, progress=None):
+        """Stream a file from the Agent to the local path or file object
+        'target'. Returns the size and SHA-1 of the file."""
+        if isinstance(target, str):
+            with open(target, "wb") as fp:
+                return await self.retrieve_to(filepath, fp, progress)
+
+        resp = await self.request(
+            "POST", "/retrieve", idempotent=True, data={"filepath": filepath},
+            stream=True
+        )
+        if resp.status_code != 200:
+            await resp.read()
+            raise IOError(
+                f"Could not retrieve {filepath}: HTTP {resp.status_code}"
+            )
+
+        total = int(resp.headers.get("content-length") or 0)
+        p = _Progress(f"Retrieved {filepath}", total, progress)
+        sha1 = hashlib.sha1()
+        async for buf in resp.chunks():
+            target.write(buf)
+            sha1.update(buf)
+            p.update(len(buf))
+        p.finish()
+        return p.done, sha1.hexdigest()
+
+    async def remove(self, path):
+        """Remove a file or entire directory."""
+        await self.post("/remove", idempotent=True, path=path)
+
+    async def extract(self, dirpath, zipfile, progress=None):
+        """Extract a zip file to folder. The zip file is a local path or a
+        file object and is streamed to the Agent."""
+        if isinstance(zipfile, str):
+            with open(zipfile, "rb") as fp:
+                return await self.extract(dirpath, fp, progress)
+
+        size = _remaining_size(zipfile)
+        p = _Progress(f"Extracted zip to {dirpath}", size, progress)
+        body = _MultipartUpload(
+            zipfile, size, {"dirpath": dirpath}, "zipfile", p
+        )
+        await self.request("POST", "/extract", idempotent=True, data=body)
+        p.finish()
+
+    async def shutdown(self):
+        """Power off the machine."""
+        await self.execute("shutdown -s -t 1", cucksync=True)
+        self.close()
+
+    async def reboot(self):
+        """Reboot the machine."""
+        await self.execute("shutdown -r -t 1", cucksync=True)
+        self.close()
+
+    async def kill(self):
+        """Kill the Agent."""
+        await self.get("/kill", idempotent=False)
+        self.close()
+
+async def port_open(ipaddr, port, timeout=1):
+    """Return True if a TCP connection to ipaddr:port can be made."""
+    try:
+        _, writer = await asyncio.wait_for(
+            asyncio.open_connection(ipaddr, port), timeout
+        )
+    except (OSError, asyncio.TimeoutError):
+        return False
+
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return True
+
+async def _ping(a):
+    try:
+        await a.ping()
+        return True
+    except Exception as e:
+        log.debug(f"No response from agent on {a.ipaddr}:{a.port}: {e}")
+        return False
+
+async def wait_for_agents(agents, timeout=180, expected=None):
+    """Wait for the AsyncAgents to come up. Returns a dict with the seconds
+    each agent took to come up, or None for the agents that did not come up
+    within timeout. See vmcloak.misc.wait_for_agents."""
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    pending = list(agents)
+    ready = {}
+    attempt = 0
+    while pending:
+        elapsed = loop.time() - start
+        if elapsed >= timeout:
+            break
+
+        opened = await asyncio.gather(*(
+            port_open(a.ipaddr, a.port, min(1, timeout - elapsed))
+            for a in pending
+        ))
+        candidates = [a for a, is_open in zip(pending, opened) if is_open]
+        pinged = await asyncio.gather(*(_ping(a) for a in candidates))
+        for a, up in zip(candidates, pinged):
+            if not up:
+                continue
+            ready[a] = loop.time() - start
+            log.debug(
+                f"Agent on {a.ipaddr}:{a.port} ready after {ready[a]:.1f}s"
+            )
+            pending.remove(a)
+
+        if pending:
+            elapsed = loop.time() - start
+            await asyncio.sleep(min(
+                _probe_interval(elapsed, expected, attempt),
+                max(0, timeout - elapsed)
+            ))
+            attempt += 1
+
+    for a in pending:
+        ready[a] = None
+    return ready
+
+async def wait_for_agent(a, timeout=180, expected=None):
+    """Wait for the AsyncAgent to come up. Returns the amount of seconds it
+    took. See wait_for_agents."""
+    ready = (await wait_for_agents([a], timeout, expected))[a]
+    if ready is None:
+        raise IOError("Agent not online within %s second(s)" % timeout)
+    return ready
@@ -0,0 +1,36 @@
+# Copyright (C) 2026 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+"""Add timing table
+
+Revision ID: 8e3f2a6b1c47
+Revises: d6c5bf858df1
+Create Date: 2026-10-18 09:00:58.172905
+
+"""
+
+# Revision identifiers, used by Alembic.
+revision = '8e3f2a6b1c47'
+down_revision = 'd6c5bf858df1'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'timing',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('phase', sa.String(length=32), nullable=False),
+        sa.Column('subject', sa.String(length=64), nullable=True),
+        sa.Column('detail', sa.String(length=64), nullable=True),
+        sa.Column('started', sa.Float(), nullable=False),
+        sa.Column('duration', sa.Float(), nullable=False),
+        sa.Column('size', sa.Integer(), nullable=True),
+        sa.Column('success', sa.Boolean(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+def downgrade():
+    op.drop_table('timing')
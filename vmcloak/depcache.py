@@ -0,0 +1,297 @@
+# Copyright (C) 2026 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+"""Bookkeeping of the downloaded dependency files in the deps folder.
+
+Checking whether a cached installer is still valid means hashing it. The
+SHA-1 of every verified file is stored in an index file in the folder,
+together with the size, mtime and inode of the file at that time. As long
+as these do not change, the stored hash is used instead of reading the
+file again.
+
+Build hosts can share their downloads through an artifact cache, a folder
+or HTTP server in which files are stored by their SHA-1.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import socket
+import threading
+
+import requests
+
+from vmcloak.misc import sha1_file, DOWNLOAD_TIMEOUT
+
+log = logging.getLogger(__name__)
+
+INDEX_NAME = ".sha1index.json"
+
+class HashIndex(object):
+    """The SHA-1 index of the files in a folder."""
+
+    def __init__(self, dirpath):
+        self.path = os.path.join(dirpath, INDEX_NAME)
+        self._entries = None
+        self._lock = threading.RLock()
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            try:
+                with open(self.path, "r") as fp:
+                    self._entries = json.load(fp)
+            except FileNotFoundError:
+                self._entries = {}
+            except (OSError, ValueError) as e:
+                log.warning(f"Ignoring unreadable hash index {self.path}. {e}")
+                self._entries = {}
+        return self._entries
+
+    def _save(self):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w") as fp:
+                json.dump(self.entries, fp, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            log.warning(f"Could not write hash index {self.path}. {e}")
+
+    @staticmethod
+    def _key(filepath):
+        return os.path.abspath(filepath)
+
+    @staticmethod
+    def _stat(filepath):
+        st = os.stat(filepath)
+        return {
+            "size": st.st_size, "mtime": st.st_mtime_ns, "inode": st.st_ino
+        }
+
+    def cached(self, filepath):
+        """Return the stored SHA-1 of the file if the file did not change
+        since it was hashed. Returns None if it is unknown or changed, or if
+        the file does not exist."""
+        try:
+            stat = self._stat(filepath)
+        except FileNotFoundError:
+            return None
+
+        with self._lock:
+            entry = self.entries.get(self._key(filepath))
+        if not entry or any(entry.get(k) != v for k, v in stat.items()):
+            return None
+        return entry["sha1"]
+
+    def update(self, filepath, sha1):
+        """Store the SHA-1 of a file that was just hashed, such as a file
+        that was hashed while it was downloaded."""
+        entry = self._stat(filepath)
+        entry["sha1"] = sha1
+        with self._lock:
+            self.entries[self._key(filepath)] = entry
+            self._save()
+
+    def remove(self, filepath):
+        with self._lock:
+            if self.entries.pop(self._key(filepath), None):
+                self._save()
+
+    def sha1(self, filepath, verify=False):
+        """Return the SHA-1 of the file. It is only calculated if the file
+        changed since it was last hashed, or with verify."""
+        if not verify:
+            sha1 = self.cached(filepath)
+            if sha1:
+                return sha1
+
+        sha1 = sha1_file(filepath)
+        self.update(filepath, sha1)
+        return sha1
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def hash_index(dirpath):
+    """Return the shared HashIndex of a folder."""
+    dirpath = os.path.abspath(dirpath)
+    with _indexes_lock:
+        if dirpath not in _indexes:
+            _indexes[dirpath] = HashIndex(dirpath)
+        return _indexes[dirpath]
+
+def file_sha1(filepath, verify=False):
+    """Return the SHA-1 of a file using the index of its folder."""
+    return hash_index(os.path.dirname(filepath)).sha1(filepath, verify)
+
+def file_status(filepath, expected_sha1=None, verify=False):
+    """Return the cache status of a downloaded file: 'missing', 'unverified'
+    (changed or never hashed), 'ok' or 'corrupt' (unexpected hash). With
+    verify, the file is hashed again instead of trusting the index."""
+    if not os.path.isfile(filepath):
+        return "missing"
+    if not expected_sha1:
+        return "ok"
+
+    index = hash_index(os.path.dirname(filepath))
+    sha1 = index.sha1(filepath, verify=True) if verify else \
+        index.cached(filepath)
+    if not sha1:
+        return "unverified"
+    if sha1 != expected_sha1:
+        return "corrupt"
+    return "ok"
+
+# A shared directory or HTTP server with dependency files, keyed by SHA-1.
+ARTIFACT_CACHE_ENV = "VMCLOAK_ARTIFACT_CACHE"
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+
+def _remove_tmp(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        log.debug(f"Could not remove {path}. {e}")
+
+def _copy_verified(chunks, filepath, sha1):
+    """Write the data of the chunks iterable to filepath if its SHA-1 is
+    sha1. Returns True if it was written. The temporary file is removed if
+    reading the chunks fails."""
+    tmp_path = f"{filepath}.cache.tmp"
+    h = hashlib.sha1()
+    try:
+        with open(tmp_path, "wb") as fp:
+            for buf in chunks:
+                fp.write(buf)
+                h.update(buf)
+
+        if h.hexdigest() != sha1:
+            log.warning(f"Ignoring corrupt cached artifact {sha1}")
+            return False
+
+        os.replace(tmp_path, filepath)
+        return True
+    finally:
+        _remove_tmp(tmp_path)
+
+class ArtifactCache(object):
+    """Dependency files shared between build hosts, stored by SHA-1. Files
+    are checked here before they are downloaded from their URLs and are
+    published here after a verified download."""
+
+    def fetch(self, sha1, filepath):
+        """Store the file with this SHA-1 at filepath. Returns False if it
+        is not in the cache."""
+        raise NotImplementedError
+
+    def publish(self, sha1, filepath):
+        """Add the file, which has this SHA-1, to the cache."""
+        raise NotImplementedError
+
+class DirectoryCache(ArtifactCache):
+    """A cache in a (network) folder, as <folder>/<sha1[:2]>/<sha1>."""
+
+    def __init__(self, dirpath):
+        self.dirpath = dirpath
+
+    def __repr__(self):
+        return f"<DirectoryCache {self.dirpath}>"
+
+    def path(self, sha1):
+        return os.path.join(self.dirpath, sha1[:2], sha1)
+
+    def fetch(self, sha1, filepath):
+        try:
+            with open(self.path(sha1), "rb") as fp:
+                return _copy_verified(
+                    iter(lambda: fp.read(COPY_CHUNK_SIZE), b""), filepath,
+                    sha1
+                )
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            log.warning(f"Could not fetch {sha1} from {self.dirpath}. {e}")
+            return False
+
+    def publish(self, sha1, filepath):
+        path = self.path(sha1)
+        if os.path.exists(path):
+            return
+
+        # Other hosts may publish the same file at the same time. Only a
+        # complete file is renamed into place.
+        tmp_path = f"{path}.{socket.gethostname()}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            shutil.copyfile(filepath, tmp_path)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            log.warning(f"Could not publish {sha1} to {self.dirpath}. {e}")
+            _remove_tmp(tmp_path)
+
+class HTTPCache(ArtifactCache):
+    """A cache on a plain HTTP server, as <url>/<sha1[:2]>/<sha1>. Files are
+    published with PUT, which the server must allow for this to work, for
+    example with WebDAV."""
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+
+    def __repr__(self):
+        return f"<HTTPCache {self.url}>"
+
+    def path(self, sha1):
+        return f"{self.url}/{sha1[:2]}/{sha1}"
+
+    def fetch(self, sha1, filepath):
+        try:
+            with requests.get(self.path(sha1), stream=True,
+                              timeout=DOWNLOAD_TIMEOUT) as resp:
+                if resp.status_code != 200:
+                    return False
+                return _copy_verified(
+                    resp.iter_content(COPY_CHUNK_SIZE), filepath, sha1
+                )
+        except (requests.RequestException, OSError) as e:
+            log.warning(f"Could not fetch {sha1} from {self.url}. {e}")
+            return False
+
+    def publish(self, sha1, filepath):
+        url = self.path(sha1)
+        try:
+            if requests.head(url, timeout=DOWNLOAD_TIMEOUT).status_code == 200:
+                return
+            with open(filepath, "rb") as fp:
+                requests.put(
+                    url, data=fp, timeout=DOWNLOAD_TIMEOUT
+                ).raise_for_status()
+        except requests.RequestException as e:
+            log.warning(f"Could not publish {sha1} to {self.url}. {e}")
+
+def open_artifact_cache(spec):
+    """Return the ArtifactCache for a folder or http(s) URL."""
+    if spec.startswith(("http://", "https://")):
+        return HTTPCache(spec)
+    if spec.startswith("file://"):
+        spec = spec[len("file://"):]
+    return DirectoryCache(spec)
+
+_artifact_cache = None
+
+def set_artifact_cache(spec):
+    """Use the artifact cache at spec, a folder or URL. None uses the
+    VMCLOAK_ARTIFACT_CACHE environment variable."""
+    global _artifact_cache
+    _artifact_cache = open_artifact_cache(spec) if spec else None
+
+def artifact_cache():
+    """Return the configured ArtifactCache, or None if there is none."""
+    if _artifact_cache:
+        return _artifact_cache
+
+    spec = os.environ.get(ARTIFACT_CACHE_ENV)
+    return open_artifact_cache(spec) if spec else None
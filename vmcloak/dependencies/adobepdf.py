@@ -3,6 +3,7 @@
 # See the file 'docs/LICENSE.txt' for copying permission.
 
 import logging
+import os
 import time
 
 from vmcloak.abstract import Dependency
@@ -228,22 +229,23 @@ class AdobePdf(Dependency):
                 raise DependencyError
 
             self.download()
-
-            self.upload_dependency("C:\\%s" % self.filename)
-            self.a.execute(
-                "C:\\%s -nos_oC:\\AdobeFiles -nos_ne" % self.filename
-            )
-            self.a.remove("C:\\%s" % self.filename)
+            base = self.filepath
 
             self.exe = orig_exe
             self.download()
-            self.upload_dependency("C:\\%s" % self.filename)
+
+            # Upload the installer and the upgrade package at once.
+            installer, update = self.a.upload_bundle("C:\\vmcloak\\adobe", {
+                os.path.basename(base): base,
+                self.filename: self.filepath,
+            })
+            self.a.execute(f"{installer} -nos_oC:\\AdobeFiles -nos_ne")
             self.a.execute(
                 "msiexec /i C:\\AdobeFiles\\AcroRead.msi "
-                "/update C:\\%s /norestart /passive "
-                "ALLUSERS=1 EULA_ACCEPT=YES" % self.filename
+                f"/update {update} /norestart /passive "
+                "ALLUSERS=1 EULA_ACCEPT=YES"
             )
-            self.a.remove("C:\\%s" % self.filename)
+            self.a.remove("C:\\vmcloak\\adobe")
             self.a.remove("C:\\AdobeFiles")
         else:
             self.upload_dependency("C:\\%s" % self.filename)
@@ -34,12 +34,14 @@ class CaRootCert(Dependency):
     ]
 
     def run(self):
-        for ca_cert in self.files:
-            ca_cert_path = Path(self.deps_path, ca_cert["filename"])
-            winpath = f"c:\\{ca_cert_path.name}"
-
-            self.upload_file(ca_cert_path, winpath)
-            try:
+        # Stage all certificates with a single upload.
+        winpaths = self.a.upload_bundle("C:\\vmcloak\\certs", {
+            ca_cert["filename"]: str(Path(self.deps_path, ca_cert["filename"]))
+            for ca_cert in self.files
+        })
+        try:
+            for ca_cert, winpath in zip(self.files, winpaths):
+                ca_cert_path = Path(self.deps_path, ca_cert["filename"])
                 log.debug(
                     f"Adding {ca_cert_path.name} to certificate store. "
                     f"{ca_cert.get('description')}"
@@ -56,5 +58,5 @@ class CaRootCert(Dependency):
                         f"Certutil: stdout={res.get('stdout')}. "
                         f"Stderr={res.get('stderr')}"
                     )
-            finally:
-                self.a.remove(winpath)
+        finally:
+            self.a.remove("C:\\vmcloak\\certs")
@@ -958,31 +958,28 @@ class Java(Dependency):
             self.a.remove("C:\\config.cfg")
 
         if self.i.osversion == "winxp" or self.i.osversion == "win7x86":
-            self.a.execute("reg add \"HKEY_LOCAL_MACHINE\\SOFTWARE\\JavaSoft\\Java Update\\Policy\" /v EnableJavaUpdate /t REG_DWORD /d 0 /f")
+            commands = [
+                "reg add \"HKEY_LOCAL_MACHINE\\SOFTWARE\\JavaSoft\\Java Update\\Policy\" /v EnableJavaUpdate /t REG_DWORD /d 0 /f"
+            ]
         else:
-            self.a.execute(
+            commands = [
                 "reg add \"HKEY_LOCAL_MACHINE\\SOFTWARE\\Wow6432Node\\JavaSoft"
-                "\\Java Update\\Policy\" /v EnableJavaUpdate /t REG_DWORD /d 0 /f"
-            )
-            self.a.execute(
+                "\\Java Update\\Policy\" /v EnableJavaUpdate /t REG_DWORD /d 0 /f",
                 "reg add \"HKEY_LOCAL_MACHINE\\SOFTWARE\\Wow6432Node\\"
                 "JavaSoft\\Java Update\\Policy\" /v EnableAutoUpdateCheck "
-                "/t REG_DWORD /d 0 /f"
-            )
-            self.a.execute(
+                "/t REG_DWORD /d 0 /f",
                 "reg add \"HKEY_LOCAL_MACHINE\\SOFTWARE\\Wow6432Node\\JavaSoft"
-                "\\Java Update\\Policy\" /v NotifyDownload /t REG_DWORD /d 0 /f"
-            )
+                "\\Java Update\\Policy\" /v NotifyDownload /t REG_DWORD /d 0 /f",
+            ]
 
-        self.a.execute(
+        commands.extend([
             "reg delete \"HKEY_LOCAL_MACHINE\\SOFTWARE\\Microsoft\\Windows"
-            "\\CurrentVersion\\Run\" /v SunJavaUpdateSched /f"
-        )
-        self.a.execute(
+            "\\CurrentVersion\\Run\" /v SunJavaUpdateSched /f",
             "reg delete \"HKEY_LOCAL_MACHINE\\SOFTWARE\\Wow6432Node\\"
             "Microsoft\\Windows\\CurrentVersion\\Run\" "
-            "/v SunJavaUpdateSched /f"
-        )
+            "/v SunJavaUpdateSched /f",
+        ])
+        self.a.execute_many(commands)
 
 class Java7(Java, Dependency):
     """Backwards compatibility."""
@@ -209,5 +209,6 @@ class KB(Dependency):
         finally:
             self.a.remove("C:\\setup.msu")
 
-            self.a.execute("sc config wuauserv start= disabled")
-            self.a.execute("net stop wuauserv")
+            self.a.execute_many([
+                "sc config wuauserv start= disabled", "net stop wuauserv"
+            ])
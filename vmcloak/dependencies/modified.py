@@ -22,7 +22,7 @@ class Modified(Dependency):
         port = self.version or self.bind_port
 
         agent = os.path.join(VMCLOAK_ROOT, "data", "modified_agent.py")
-        self.a.upload("C:\\modified_agent.py", open(agent, "rb").read())
+        self.a.upload_from("C:\\modified_agent.py", agent)
 
         # Determine what OS we're running as sysnative only exists on 64bit Vista onwards, all 32bit Windows do not have sysnative.
         if self.i.osversion == "winxp" or self.i.osversion == "win7x86" or self.i.osversion == "win81x86" or self.i.osversion == "win10x86":
@@ -71,8 +71,9 @@ class Office(Dependency):
 
         self.a.remove("C:\\config.xml")
 
+        commands = []
         # disable first use popup
-        self.a.execute(
+        commands.append(
             "REG ADD \"HKEY_CURRENT_USER\\Software\\"
             "Microsoft\\Office\\%s\\Common\\General\" "
             "/v ShownFirstRunOptin /t REG_DWORD /d 1 /f" %
@@ -81,7 +82,7 @@ class Office(Dependency):
 
         # dont report office binary files (pub/doc/xls/etc) to MS if validation failed
         # https://blogs.technet.microsoft.com/office2010/2009/12/16/office-2010-file-validation/
-        self.a.execute(
+        commands.append(
             "REG ADD \"HKEY_CURRENT_USER\\Software\\"
             "Microsoft\\Office\\%s\\Common\\Security\\FileValidation\" "
             "/v DisableReporting /t REG_DWORD /d 1 /f" %
@@ -92,44 +93,44 @@ class Office(Dependency):
         # https://social.technet.microsoft.com/Forums/office/en-US/0db3e246-04b6-4948-a98c-4459fb65b1f9/privacy-options-in-access-2010?forum=officeitproprevious
         # https://msdn.microsoft.com/en-us/library/office/aa205294(v=office.11).aspx
         # https://www.stigviewer.com/stig/microsoft_office_system_2007/2014-01-07/finding/V-17740
-        self.a.execute(
+        commands.append(
             "REG ADD \"HKEY_CURRENT_USER\\Software\\"
             "Microsoft\\Office\\%s\\Common\\Internet\" "
             "/v UseOnlineContent /t REG_DWORD /d 0 /f" %
             officever[self.version]
         )
-        self.a.execute(
+        commands.append(
             "REG ADD \"HKEY_CURRENT_USER\\Software\\"
             "Microsoft\\Office\\%s\\Common\\Internet\" "
             "/v UseOnlineAppDetect /t REG_DWORD /d 0 /f" %
             officever[self.version]
         )
-        self.a.execute(
+        commands.append(
             "REG ADD \"HKEY_CURRENT_USER\\Software\\"
             "Microsoft\\Office\\%s\\Common\\Internet\" "
             "/v IDN_AlertOff /t REG_DWORD /d 1 /f" %
             officever[self.version]
         )
-        self.a.execute(
+        commands.append(
             "REG ADD \"HKEY_CURRENT_USER\\Software\\"
             "Microsoft\\Office\\%s\\Common\\Research\\Options\" "
             "/v NoDiscovery /t REG_DWORD /d 1 /f" %
             officever[self.version]
         )
-        self.a.execute(
+        commands.append(
             "REG ADD \"HKEY_CURRENT_USER\\Software\\"
             "Microsoft\\Office\\%s\\Common\\Research\\Options\" "
             "/v DiscoveryNeedOptIn /t REG_DWORD /d 1 /f" %
             officever[self.version]
         )
         # dont use online dictionaries
-        self.a.execute(
+        commands.append(
             "REG ADD \"HKEY_CURRENT_USER\\Software\\"
             "Microsoft\\Office\\%s\\Common\\Research\\Translation\" "
             "/v UseOnline /t REG_DWORD /d 0 /f" %
             officever[self.version]
         )
-        self.a.execute(
+        commands.append(
             "REG ADD \"HKEY_CURRENT_USER\\Software\\"
             "Microsoft\\Office\\%s\\Common\" "
             "/v UpdateReliabilityData /t REG_DWORD /d 0 /f" %
@@ -138,12 +139,12 @@ class Office(Dependency):
 
         # disable activeX warnings, disable AX safe mode
         # https://www.greyhathacker.net/?p=948
-        self.a.execute(
+        commands.append(
             "REG ADD \"HKEY_CURRENT_USER\\Software\\"
             "Microsoft\\Office\\Common\\Security\" "
             "/v DisableAllActiveX /t REG_DWORD /d 0 /f"
         )
-        self.a.execute(
+        commands.append(
             "REG ADD \"HKEY_CURRENT_USER\\Software\\"
             "Microsoft\\Office\\Common\\Security\" "
             "/v UFIControls /t REG_DWORD /d 1 /f"
@@ -151,19 +152,19 @@ class Office(Dependency):
 
         # disable Protected View for all office products files
         for product in ["Access", "Excel", "Outlook", "PowerPoint", "Publisher", "Word"]:
-            self.a.execute(
+            commands.append(
                 "REG ADD \"HKEY_CURRENT_USER\\Software\\"
                 "Microsoft\\Office\\%s\\%s\\Security\\ProtectedView\" "
                 "/v DisableAttachmentsInPV /t REG_DWORD /d 1 /f" %
                 (officever[self.version], product)
             )
-            self.a.execute(
+            commands.append(
                 "REG ADD \"HKEY_CURRENT_USER\\Software\\"
                 "Microsoft\\Office\\%s\\%s\\Security\\ProtectedView\" "
                 "/v DisableInternetFilesInPV /t REG_DWORD /d 1 /f" %
                 (officever[self.version], product)
             )
-            self.a.execute(
+            commands.append(
                 "REG ADD \"HKEY_CURRENT_USER\\Software\\"
                 "Microsoft\\Office\\%s\\%s\\Security\\ProtectedView\" "
                 "/v DisableUnsafeLocationsInPV /t REG_DWORD /d 1 /f" %
@@ -172,19 +173,19 @@ class Office(Dependency):
 
         for product in ["Excel", "Powerpoint", "Word"]:
             # disable DEP and macro warnings
-            self.a.execute(
+            commands.append(
                 "REG ADD \"HKEY_CURRENT_USER\\Software\\"
                 "Microsoft\\Office\\%s\\%s\\Security\" "
                 "/v EnableDEP /t REG_DWORD /d 0 /f" %
                 (officever[self.version], product)
             )
-            self.a.execute(
+            commands.append(
                 "REG ADD \"HKEY_CURRENT_USER\\Software\\"
                 "Microsoft\\Office\\%s\\%s\\Security\" "
                 "/v VBAWarnings /t REG_DWORD /d 1 /f" %
                 (officever[self.version], product)
             )
-            self.a.execute(
+            commands.append(
                 "REG ADD \"HKEY_CURRENT_USER\\Software\\"
                 "Microsoft\\Office\\%s\\%s\\Security\" "
                 "/v AccessVBOM /t REG_DWORD /d 1 /f" %
@@ -192,7 +193,7 @@ class Office(Dependency):
             )
 
             # Dont show warnings for files from the network
-            self.a.execute(
+            commands.append(
                 "REG ADD \"HKEY_CURRENT_USER\\Software\\"
                 "Microsoft\\Office\\%s\\%s\\Security\\Trusted Locations\" "
                 "/v AllowNetworkLocations /t REG_DWORD /d 1 /f" %
@@ -200,25 +201,25 @@ class Office(Dependency):
             )
 
         # Dont block older Word documents
-        self.a.execute(
+        commands.append(
             "REG ADD \"HKEY_CURRENT_USER\\Software\\"
             "Microsoft\\Office\\%s\\Word\\Security\\FileBlock\" "
             "/v OpenInProtectedView /t REG_DWORD /d 2 /f" %
             officever[self.version]
         )
-        self.a.execute(
+        commands.append(
             "REG ADD \"HKEY_CURRENT_USER\\Software\\"
             "Microsoft\\Office\\%s\\Word\\Security\\FileBlock\" "
             "/v Word2Files /t REG_DWORD /d 0 /f" %
             officever[self.version]
         )
-        self.a.execute(
+        commands.append(
             "REG ADD \"HKEY_CURRENT_USER\\Software\\"
             "Microsoft\\Office\\%s\\Word\\Security\\FileBlock\" "
             "/v Word60Files /t REG_DWORD /d 0 /f" %
             officever[self.version]
         )
-        self.a.execute(
+        commands.append(
             "REG ADD \"HKEY_CURRENT_USER\\Software\\"
             "Microsoft\\Office\\%s\\Word\\Security\\FileBlock\" "
             "/v Word95Files /t REG_DWORD /d 0 /f" %
@@ -226,49 +227,49 @@ class Office(Dependency):
         )
 
         # Dont block older Excel documents
-        self.a.execute(
+        commands.append(
             "REG ADD \"HKEY_CURRENT_USER\\Software\\"
             "Microsoft\\Office\\%s\\Excel\\Security\\FileBlock\" "
             "/v OpenInProtectedView /t REG_DWORD /d 2 /f" %
             officever[self.version]
         )
-        self.a.execute(
+        commands.append(
             "REG ADD \"HKEY_CURRENT_USER\\Software\\"
             "Microsoft\\Office\\%s\\Word\\Security\\FileBlock\" "
             "/v XL2Macros /t REG_DWORD /d 0 /f" %
             officever[self.version]
         )
-        self.a.execute(
+        commands.append(
             "REG ADD \"HKEY_CURRENT_USER\\Software\\"
             "Microsoft\\Office\\%s\\Word\\Security\\FileBlock\" "
             "/v XL2Worksheets /t REG_DWORD /d 0 /f" %
             officever[self.version]
         )
-        self.a.execute(
+        commands.append(
             "REG ADD \"HKEY_CURRENT_USER\\Software\\"
             "Microsoft\\Office\\%s\\Word\\Security\\FileBlock\" "
             "/v XL3Macros /t REG_DWORD /d 0 /f" %
             officever[self.version]
         )
-        self.a.execute(
+        commands.append(
             "REG ADD \"HKEY_CURRENT_USER\\Software\\"
             "Microsoft\\Office\\%s\\Word\\Security\\FileBlock\" "
             "/v XL3Worksheets /t REG_DWORD /d 0 /f" %
             officever[self.version]
         )
-        self.a.execute(
+        commands.append(
             "REG ADD \"HKEY_CURRENT_USER\\Software\\"
             "Microsoft\\Office\\%s\\Word\\Security\\FileBlock\" "
             "/v XL4Macros /t REG_DWORD /d 0 /f" %
             officever[self.version]
         )
-        self.a.execute(
+        commands.append(
             "REG ADD \"HKEY_CURRENT_USER\\Software\\"
             "Microsoft\\Office\\%s\\Word\\Security\\FileBlock\" "
             "/v XL4Workbooks /t REG_DWORD /d 0 /f" %
             officever[self.version]
         )
-        self.a.execute(
+        commands.append(
             "REG ADD \"HKEY_CURRENT_USER\\Software\\"
             "Microsoft\\Office\\%s\\Word\\Security\\FileBlock\" "
             "/v XL4Worksheets /t REG_DWORD /d 0 /f" %
@@ -277,7 +278,7 @@ class Office(Dependency):
 
         # Allow data connections without warnings in Excel
         # https://www.experts-exchange.com/questions/28247804/Enable-Data-Connections-for-all-users.html
-        self.a.execute(
+        commands.append(
             "REG ADD \"HKEY_CURRENT_USER\\Software\\"
             "Microsoft\\Office\\%s\\Excel\\Security\" "
             "/v DataConnectionWarnings /t REG_DWORD /d 0 /f" %
@@ -286,7 +287,7 @@ class Office(Dependency):
 
         # auto update workbook links
         # https://support.microsoft.com/en-us/help/826921/how-to-control-the-startup-message-about-updating-linked-workbooks-in-excel
-        self.a.execute(
+        commands.append(
             "REG ADD \"HKEY_CURRENT_USER\\Software\\"
             "Microsoft\\Office\\%s\\Excel\\Security\" "
             "/v WorkbookLinkWarnings /t REG_DWORD /d 0 /f" %
@@ -294,7 +295,7 @@ class Office(Dependency):
         )
 
         # Enable macros in Outlook
-        self.a.execute(
+        commands.append(
             "REG ADD \"HKEY_CURRENT_USER\\Software\\"
             "Microsoft\\Office\\%s\\Outlook\\Security\" "
             "/v Level /t REG_DWORD /d 1 /f" %
@@ -303,13 +304,15 @@ class Office(Dependency):
 
         # disable AV Notification in outlook
         # https://www.slipstick.com/developer/change-programmatic-access-options/
-        self.a.execute(
+        commands.append(
             "REG ADD \"HKEY_LOCAL_MACHINE\\SOFTWARE\\"
             "Wow6432Node\\Microsoft\\Office\\%s\\Outlook\\Security\" "
             "/v ObjectModelGuard /t REG_DWORD /d 2 /f" %
             officever[self.version]
         )
 
+        self.a.execute_many(commands)
+
         self.m.detach_iso()
 
 class Office2007(Office, Dependency):
@@ -10,3 +10,9 @@ class DependencyError(Exception):
 
 class SwarmError(Exception):
     pass
+
+class QMPError(Exception):
+    pass
+
+class IsoImageError(Exception):
+    pass
@@ -2,12 +2,15 @@
 # This file is part of VMCloak - http://www.vmcloak.org/.
 # See the file 'docs/LICENSE.txt' for copying permission.
 import logging
-import time
+import os.path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import vmcloak.dependencies
+from vmcloak import timing
+from vmcloak.abstract import missing_downloadables, fetch_downloadable
 from vmcloak.agent import Agent
 from vmcloak.exceptions import DependencyError
-from vmcloak.misc import wait_for_agent
+from vmcloak.misc import reset_waiter, wait_for_agent, wait_for_reboot
 from vmcloak.ostype import get_os
 from vmcloak.repository import Session, Image
 
@@ -16,6 +19,9 @@ log = logging.getLogger(__name__)
 class InstallError(Exception):
     pass
 
+# The amount of dependency files that are downloaded at the same time.
+PREFETCH_PARALLEL = 4
+
 _recipes = {
     "win10x64": ["ie11", "dotnet:4.7.2", "java:7u80", "vcredist:2013",
                  "vcredist:2019", "edge", "carootcert", "adobepdf",
@@ -87,9 +93,81 @@ def _raise_for_non_existing(deps_versions):
             f"{', '.join(non_existing)}"
         )
 
+def resolve_dependencies(deps_versions, osversion):
+    """Return the (dependency class, version) of the given dependencies and
+    of all dependencies they depend on for the OS version, dependencies of
+    a dependency first."""
+    resolved = []
+
+    def _add(name, version):
+        dep_class = vmcloak.dependencies.names[name]
+        for dep_dep in dep_class.dependencies_for(osversion) or []:
+            _add(*_split_dep_version(dep_dep))
+
+        if (dep_class, version) not in resolved:
+            resolved.append((dep_class, version))
+
+    for name, version in deps_versions:
+        _add(name, version)
+
+    return resolved
+
+def prefetch(deps_versions, osversion, parallel=PREFETCH_PARALLEL,
+             verify=False, installed=None):
+    """Download the missing files of the dependencies, and of the
+    dependencies they depend on, before a VM is started. At most 'parallel'
+    files are downloaded at the same time. With verify, files that are
+    already downloaded are hashed again. installed is an optional function
+    that is called with the name and version of a dependency and returns
+    True if it is installed already. Its files are not downloaded. Returns
+    the amount of files that could not be downloaded."""
+    _raise_for_non_existing(deps_versions)
+    arch = get_os(osversion).arch
+    downloadables = {}
+    for dep_class, version in resolve_dependencies(deps_versions, osversion):
+        if installed and installed(dep_class.name, version):
+            log.debug(f"Not prefetching installed '{dep_class.name}'")
+            continue
+
+        try:
+            found = dep_class.downloadables(version, osversion, arch)
+        except DependencyError as e:
+            log.warning(f"Cannot prefetch '{dep_class.name}'. {e}")
+            continue
+
+        for downloadable in found:
+            # Files of the latest version are downloaded again on install.
+            if downloadable[3] != "latest":
+                downloadables.setdefault(downloadable[0], downloadable)
+
+    missing = missing_downloadables(list(downloadables.values()), verify)
+    if not missing:
+        log.debug("All dependency files are already downloaded")
+        return 0
+
+    log.info(f"Downloading {len(missing)} dependency file(s)")
+    failed = 0
+    with timing.span("prefetch", osversion) as s:
+        with ThreadPoolExecutor(max_workers=max(1, parallel)) as pool:
+            futures = {
+                pool.submit(fetch_downloadable, d): d for d in missing
+            }
+            for future in as_completed(futures):
+                filepath = futures[future][0]
+                try:
+                    future.result()
+                except (DependencyError, OSError) as e:
+                    log.error(f"Failed to prefetch {filepath}. {e}")
+                    failed += 1
+                    continue
+
+                s.size = (s.size or 0) + os.path.getsize(filepath)
+
+    return failed
+
 def _wait_for_agent(agent, timeout=1200):
     # wrap func just to change default argument.
-    wait_for_agent(agent, timeout=timeout)
+    wait_for_agent(agent, timeout=timeout, expected=timing.expected("boot"))
 
 class _Installable:
 
@@ -110,7 +188,11 @@ class _Installable:
             self.dependency = self.dependency_class(
                installer=self.installer, **self.class_args
             )
-            self.dependency.run()
+            with timing.span(
+                "dependency", self.installer.image.name,
+                detail=f"{self.name}:{self.dependency.version or ''}"
+            ):
+                self.dependency.run()
         except DependencyError as e:
             raise InstallError(
                 f"Dependency '{self.dependency_class.name}' "
@@ -154,6 +236,15 @@ class DependencyInstaller:
         self._prepared = False
         self._no_machine_start = False
 
+    def prefetch(self, parallel=PREFETCH_PARALLEL, verify=False,
+                 skip_installed=True):
+        """Download the files of all dependencies to install. Returns the
+        amount of files that could not be downloaded."""
+        return prefetch(
+            self.install_queue, self.image.osversion, parallel, verify,
+            installed=self._is_installed if skip_installed else None
+        )
+
     def _find_in_queue(self, dep):
         for item in self.install_queue:
             if item[0] == dep:
@@ -211,17 +302,21 @@ class DependencyInstaller:
             self._discover_subdependencies(dep_installer)
 
     def do_reboot(self):
+        went_down = reset_waiter(self.platform, self.image.name)
+
         try:
             # Ignore timeout/socket etc errors as machine will
             # shut down.
             self.agent.reboot()
-            # Wait a bit, so machine can actually shut down.
-            time.sleep(10)
         except (IOError, OSError):
             pass
 
         # Long timeout as a boot may take long after windows/system updates.
-        _wait_for_agent(self.agent, timeout=1200)
+        with timing.span("reboot", self.image.name):
+            wait_for_reboot(
+                self.agent, went_down, timeout=1200,
+                expected=timing.expected("reboot")
+            )
 
     def prepare(self, timeout=1200, no_machine_start=False):
         """Compile list of all dependencies to install and starts a vm for the
@@ -230,12 +325,13 @@ class DependencyInstaller:
         log.debug("Find all dependencies of the chosen dependencies")
         self._populate_dep_dependencies()
 
-        if not no_machine_start:
-            self.platform.start_image_vm(self.image, self.attrs)
-        else:
-            self._no_machine_start = no_machine_start
+        with timing.span("boot", self.image.name):
+            if not no_machine_start:
+                self.platform.start_image_vm(self.image, self.attrs)
+            else:
+                self._no_machine_start = no_machine_start
 
-        _wait_for_agent(self.agent, timeout=timeout)
+            _wait_for_agent(self.agent, timeout=timeout)
         self._prepared = True
 
     def _is_installed(self, depname, version=None):
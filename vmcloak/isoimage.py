@@ -0,0 +1,465 @@
+# Copyright (C) 2026 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+"""Reading the files of an installer ISO image without mounting it.
+
+Windows 7 and newer installer images are UDF file systems with an ISO 9660
+bridge, which on recent images only holds a README. Windows XP images are
+ISO 9660 with Joliet names. The directory tree is read from the UDF file
+system if there is one, from the Joliet or primary ISO 9660 tree if not.
+
+Files are not read through the reader. Their extents, ranges of bytes in
+the image, are copied straight from the image file to the destination with
+copy_file_range(), which lets the kernel copy the data or share it between
+the files on file systems that support it.
+
+    with IsoImage("win10x64.iso") as iso:
+        print(iso.read("sources/product.ini"))
+        iso.extract_tree("/tmp/win10x64")
+"""
+
+import logging
+import os
+import stat
+import struct
+
+from vmcloak.exceptions import IsoImageError
+
+log = logging.getLogger(__name__)
+
+SECTOR_SIZE = 2048
+# The first sector of the volume descriptors.
+VOLUME_DESCRIPTORS = 16
+# The UDF Anchor Volume Descriptor Pointer is at sector 256.
+UDF_ANCHOR = 256
+# Bytes copied per copy_file_range() call.
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+
+# UDF descriptor tag identifiers.
+TAG_ANCHOR = 2
+TAG_PARTITION = 5
+TAG_LOGICAL_VOLUME = 6
+TAG_TERMINATING = 8
+TAG_FILE_SET = 256
+TAG_FILE_IDENTIFIER = 257
+TAG_FILE_ENTRY = 261
+TAG_EXTENDED_FILE_ENTRY = 266
+
+VOLUME_IDENTIFIERS = (
+    b"CD001", b"BEA01", b"NSR02", b"NSR03", b"TEA01", b"BOOT2", b"CDW02",
+)
+JOLIET_ESCAPES = (b"%/@", b"%/C", b"%/E")
+
+class IsoEntry(object):
+    """A file or directory in the image. Extents are (offset, length) pairs
+    of bytes in the image file. An offset of None is a range of zeroes."""
+
+    def __init__(self, name, is_dir, size, extents):
+        self.name = name
+        self.is_dir = is_dir
+        self.size = size
+        self.extents = extents
+        self.children = {}
+
+    def __repr__(self):
+        return f"<IsoEntry {self.name!r} size={self.size}>"
+
+    def add(self, entry):
+        self.children[entry.name.lower()] = entry
+
+def _udf_name(data):
+    """Decode an OSTA compressed unicode file identifier."""
+    if not data:
+        return ""
+    if data[0] == 8:
+        return data[1:].decode("latin1")
+    if data[0] == 16:
+        return data[1:].decode("utf-16-be")
+    raise IsoImageError(f"Unknown UDF name compression {data[0]}")
+
+def _iso_name(data, joliet):
+    if data in (b"\x00", b"\x01"):
+        # The directory itself and its parent.
+        return ""
+    if joliet:
+        name = data.decode("utf-16-be")
+    else:
+        name = data.decode("latin1")
+    name = name.split(";", 1)[0]
+    if not joliet and name.endswith("."):
+        name = name[:-1]
+    return name
+
+class IsoImage(object):
+    """The directory tree of an ISO image file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.fp = open(path, "rb")
+        self.fd = self.fp.fileno()
+        self.block_size = SECTOR_SIZE
+        self.partitions = {}
+        try:
+            if self._has_udf():
+                self.format = "udf"
+                self.root = self._read_udf()
+            else:
+                self.root = self._read_iso9660()
+        except (struct.error, ValueError, IndexError) as e:
+            self.close()
+            raise IsoImageError(f"Corrupt ISO image {path}: {e}")
+        except IsoImageError:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.fp.close()
+
+    def _pread(self, offset, length):
+        buf = os.pread(self.fd, length, offset)
+        if len(buf) != length:
+            raise IsoImageError(
+                f"ISO image {self.path} is truncated at offset {offset}"
+            )
+        return buf
+
+    def _sector(self, sector):
+        return self._pread(sector * SECTOR_SIZE, SECTOR_SIZE)
+
+    def _read_extents(self, extents):
+        return b"".join(
+            b"\x00" * length if offset is None else
+            self._pread(offset, length)
+            for offset, length in extents
+        )
+
+    def _volume_descriptors(self):
+        """Yield the ISO 9660 volume descriptors and the UDF volume
+        recognition sequence that follows them."""
+        for sector in range(VOLUME_DESCRIPTORS, UDF_ANCHOR):
+            try:
+                buf = self._sector(sector)
+            except IsoImageError:
+                return
+            if buf[1:6] not in VOLUME_IDENTIFIERS:
+                return
+            yield buf
+            if buf[1:6] == b"TEA01":
+                return
+
+    def _has_udf(self):
+        return any(
+            buf[1:6] in (b"NSR02", b"NSR03")
+            for buf in self._volume_descriptors()
+        )
+
+    # ISO 9660.
+
+    def _read_iso9660(self):
+        primary = joliet = None
+        for buf in self._volume_descriptors():
+            if buf[1:6] != b"CD001":
+                continue
+            if buf[0] == 1 and not primary:
+                primary = buf
+            elif buf[0] == 2 and buf[88:91] in JOLIET_ESCAPES:
+                joliet = buf
+
+        descriptor = joliet or primary
+        if not descriptor:
+            raise IsoImageError(f"{self.path} is not an ISO 9660 image")
+
+        self.format = "joliet" if joliet else "iso9660"
+        self.block_size = struct.unpack("<H", descriptor[128:130])[0]
+        root = self._iso_record(descriptor[156:190], bool(joliet))
+        self._iso_directory(root, bool(joliet), set())
+        return root
+
+    def _iso_record(self, record, joliet):
+        extent, size = struct.unpack("<I4xI", record[2:14])
+        flags = record[25]
+        name = _iso_name(record[33:33 + record[32]], joliet)
+        entry = IsoEntry(name, bool(flags & 2), size, [
+            (extent * self.block_size, size)
+        ])
+        entry.multi_extent = bool(flags & 0x80)
+        return entry
+
+    def _iso_directory(self, directory, joliet, seen):
+        offset, length = directory.extents[0]
+        if offset in seen:
+            raise IsoImageError(f"Directory loop in {self.path}")
+        seen.add(offset)
+
+        data = self._pread(offset, length)
+        pos, previous = 0, None
+        while pos < len(data):
+            reclen = data[pos]
+            if not reclen:
+                # Records do not cross sectors, the rest is padding.
+                pos = (pos // self.block_size + 1) * self.block_size
+                continue
+
+            record = data[pos:pos + reclen]
+            pos += reclen
+            entry = self._iso_record(record, joliet)
+            if not entry.name:
+                continue
+
+            if previous and previous.multi_extent and \
+                    previous.name == entry.name:
+                # Files of 4GB and more consist of several records.
+                previous.extents.extend(entry.extents)
+                previous.size += entry.size
+                previous.multi_extent = entry.multi_extent
+                continue
+
+            directory.add(entry)
+            previous = entry
+            if entry.is_dir:
+                self._iso_directory(entry, joliet, seen)
+
+    # UDF.
+
+    def _tag(self, buf, expected):
+        tag = struct.unpack("<H", buf[:2])[0]
+        if tag != expected:
+            raise IsoImageError(
+                f"Expected UDF descriptor {expected}, found {tag} in "
+                f"{self.path}"
+            )
+
+    def _lb_offset(self, partition_ref, lb):
+        try:
+            start = self.partitions[partition_ref]
+        except KeyError:
+            raise IsoImageError(
+                f"Unknown UDF partition {partition_ref} in {self.path}"
+            )
+        return (start + lb) * self.block_size
+
+    def _read_udf(self):
+        anchor = self._sector(UDF_ANCHOR)
+        self._tag(anchor, TAG_ANCHOR)
+        vds_length, vds_sector = struct.unpack("<II", anchor[16:24])
+
+        partition_starts = {}
+        logical_volume = None
+        for i in range(vds_length // SECTOR_SIZE):
+            buf = self._sector(vds_sector + i)
+            tag = struct.unpack("<H", buf[:2])[0]
+            if tag == TAG_PARTITION:
+                number = struct.unpack("<H", buf[22:24])[0]
+                partition_starts[number] = \
+                    struct.unpack("<I", buf[188:192])[0]
+            elif tag == TAG_LOGICAL_VOLUME:
+                logical_volume = buf
+            elif tag == TAG_TERMINATING:
+                break
+
+        if not logical_volume:
+            raise IsoImageError(f"No UDF logical volume in {self.path}")
+
+        self.block_size = struct.unpack("<I", logical_volume[212:216])[0]
+        map_count = struct.unpack("<I", logical_volume[268:272])[0]
+        pos = 440
+        for ref in range(map_count):
+            map_type, map_length = logical_volume[pos:pos + 2]
+            if map_type != 1:
+                raise IsoImageError(
+                    f"UDF partition map type {map_type} of {self.path} is "
+                    f"not supported"
+                )
+            number = struct.unpack("<H", logical_volume[pos + 4:pos + 6])[0]
+            if number not in partition_starts:
+                raise IsoImageError(
+                    f"Missing UDF partition {number} in {self.path}"
+                )
+            self.partitions[ref] = partition_starts[number]
+            pos += map_length
+
+        # The File Set Descriptor points to the root directory.
+        fsd_lb, fsd_ref = struct.unpack("<4xIH", logical_volume[248:258])
+        fsd = self._pread(
+            self._lb_offset(fsd_ref, fsd_lb), self.block_size
+        )
+        self._tag(fsd, TAG_FILE_SET)
+        root_lb, root_ref = struct.unpack("<4xIH", fsd[400:410])
+
+        root = self._udf_entry("", root_ref, root_lb)
+        self._udf_directory(root, set())
+        return root
+
+    def _udf_entry(self, name, partition_ref, lb):
+        offset = self._lb_offset(partition_ref, lb)
+        buf = self._pread(offset, self.block_size)
+        tag = struct.unpack("<H", buf[:2])[0]
+        if tag == TAG_FILE_ENTRY:
+            header = 176
+            ea_length, ad_length = struct.unpack("<II", buf[168:176])
+        elif tag == TAG_EXTENDED_FILE_ENTRY:
+            header = 216
+            ea_length, ad_length = struct.unpack("<II", buf[208:216])
+        else:
+            raise IsoImageError(
+                f"Expected a UDF file entry for {name!r}, found {tag} in "
+                f"{self.path}"
+            )
+
+        file_type = buf[27]
+        ad_type = struct.unpack("<H", buf[34:36])[0] & 7
+        size = struct.unpack("<Q", buf[56:64])[0]
+        ads = header + ea_length
+        if ads + ad_length > len(buf):
+            raise IsoImageError(f"Corrupt UDF file entry {name!r}")
+
+        extents = []
+        if ad_type == 3:
+            # The data is embedded in the file entry itself.
+            extents.append((offset + ads, size))
+        elif ad_type in (0, 1):
+            ad_size = 8 if ad_type == 0 else 16
+            for pos in range(ads, ads + ad_length - ad_size + 1, ad_size):
+                length, location = struct.unpack("<II", buf[pos:pos + 8])
+                extent_type, length = length >> 30, length & 0x3fffffff
+                ref = partition_ref if ad_type == 0 else \
+                    struct.unpack("<H", buf[pos + 8:pos + 10])[0]
+                if not length:
+                    break
+                if extent_type == 3:
+                    raise IsoImageError(
+                        f"UDF allocation extent continuations of {name!r} "
+                        f"are not supported"
+                    )
+                if extent_type == 0:
+                    extents.append((self._lb_offset(ref, location), length))
+                else:
+                    extents.append((None, length))
+        else:
+            raise IsoImageError(
+                f"UDF allocation type {ad_type} of {name!r} is not supported"
+            )
+
+        # The last extent may be rounded up to whole blocks.
+        left = size
+        for i, (extent_offset, length) in enumerate(extents):
+            extents[i] = (extent_offset, min(length, left))
+            left -= extents[i][1]
+        extents = [extent for extent in extents if extent[1]]
+
+        entry = IsoEntry(name, file_type == 4, size, extents)
+        entry.lb = (partition_ref, lb)
+        return entry
+
+    def _udf_directory(self, directory, seen):
+        if directory.lb in seen:
+            raise IsoImageError(f"Directory loop in {self.path}")
+        seen.add(directory.lb)
+
+        data = self._read_extents(directory.extents)
+        pos = 0
+        while pos + 38 <= len(data):
+            self._tag(data[pos:pos + 2], TAG_FILE_IDENTIFIER)
+            characteristics, fi_length = data[pos + 18], data[pos + 19]
+            icb_lb, icb_ref = struct.unpack("<IH", data[pos + 24:pos + 30])
+            iu_length = struct.unpack("<H", data[pos + 36:pos + 38])[0]
+            name_start = pos + 38 + iu_length
+            name = _udf_name(data[name_start:name_start + fi_length])
+            pos += (38 + iu_length + fi_length + 3) & ~3
+
+            # Skip the parent directory and deleted files.
+            if characteristics & (4 | 8):
+                continue
+
+            entry = self._udf_entry(name, icb_ref, icb_lb)
+            directory.add(entry)
+            if entry.is_dir:
+                self._udf_directory(entry, seen)
+
+    # Reading files.
+
+    def walk(self, entry=None, path=""):
+        """Yield the path and IsoEntry of every file and directory, with
+        the original names."""
+        entry = entry or self.root
+        for child in entry.children.values():
+            child_path = f"{path}/{child.name}" if path else child.name
+            yield child_path, child
+            if child.is_dir:
+                yield from self.walk(child, child_path)
+
+    def find(self, path):
+        """Return the IsoEntry of a path, case-insensitive, or None."""
+        entry = self.root
+        for name in path.replace("\\", "/").strip("/").split("/"):
+            if not name:
+                continue
+            entry = entry.children.get(name.lower())
+            if not entry:
+                return None
+        return entry
+
+    def read(self, path):
+        """Return the contents of a file in the image, or None if it does
+        not exist."""
+        entry = self.find(path)
+        if not entry or entry.is_dir:
+            return None
+        return self._read_extents(entry.extents)
+
+    def extract(self, entry, filepath):
+        """Copy the extents of a file to filepath."""
+        with open(filepath, "wb") as fp:
+            pos = 0
+            for offset, length in entry.extents:
+                if offset is not None:
+                    _copy_range(self.fd, offset, fp.fileno(), pos, length)
+                pos += length
+            # Zero extents at the end are not written.
+            fp.truncate(entry.size)
+        os.chmod(filepath, stat.S_IRUSR | stat.S_IWUSR)
+
+    def extract_tree(self, dstdir, lowercase=True):
+        """Extract all files to dstdir. With lowercase, all directory and
+        filenames are translated to lowercase, like copytreelower()."""
+        os.makedirs(dstdir, exist_ok=True)
+        for path, entry in self.walk():
+            if lowercase:
+                path = path.lower()
+            filepath = os.path.join(dstdir, *path.split("/"))
+            if entry.is_dir:
+                os.makedirs(filepath, exist_ok=True)
+            else:
+                self.extract(entry, filepath)
+
+def _copy_range(src_fd, src_offset, dst_fd, dst_offset, length):
+    copy_file_range = getattr(os, "copy_file_range", None)
+    while length:
+        count = min(length, COPY_CHUNK_SIZE)
+        copied = 0
+        if copy_file_range:
+            try:
+                copied = copy_file_range(
+                    src_fd, dst_fd, count, src_offset, dst_offset
+                )
+            except OSError as e:
+                # Not supported between these file systems.
+                log.debug(f"copy_file_range failed, copying with read: {e}")
+                copy_file_range = None
+
+        if not copied:
+            buf = os.pread(src_fd, count, src_offset)
+            if not buf:
+                raise IsoImageError(f"Unexpected end of image at {src_offset}")
+            copied = os.pwrite(dst_fd, buf, dst_offset)
+
+        src_offset += copied
+        dst_offset += copied
+        length -= copied
@@ -4,30 +4,42 @@
 # See the file 'docs/LICENSE.txt' for copying permission.
 
 import click
+import functools
 import logging
 import os.path
 import shutil
 import subprocess
 import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from sqlalchemy.orm.session import make_transient
 
 import vmcloak.dependencies
-from vmcloak import repository
+from vmcloak import repository, timing
 from vmcloak.agent import Agent
 from vmcloak.constants import VMCLOAK_ROOT
+from vmcloak.depcache import (
+    file_status, set_artifact_cache, ARTIFACT_CACHE_ENV
+)
 from vmcloak.dependencies import Python, ThreemonPatch, Finalize
-from vmcloak.install import DependencyInstaller, InstallError, find_recipe
+from vmcloak.exceptions import IsoImageError
+from vmcloak.install import (
+    DependencyInstaller, InstallError, find_recipe, parse_dependencies_list,
+    prefetch as prefetch_dependencies, PREFETCH_PARALLEL
+)
+from vmcloak.isoimage import IsoImage
 from vmcloak.misc import (
-    wait_for_agent, drop_privileges, download_file, filename_from_url
+    wait_for_agent, wait_for_reboot, reset_waiter, drop_privileges,
+    download_file, filename_from_url, DOWNLOAD_SEGMENTS
 )
 from vmcloak.rand import random_string
 from vmcloak.repository import (
     image_path, Session, Image, Snapshot, iso_dst_path, db_migratable,
     SCHEMA_VERSION, IPNet, conf_path
 )
-from vmcloak.ostype import get_os
+from vmcloak.ostype import get_os, os_types
 
 logging.basicConfig(format="%(asctime)s %(name)s %(levelname)s: %(message)s")
 log = logging.getLogger("vmcloak")
@@ -38,10 +50,14 @@ log.setLevel(logging.INFO)
 @click.option("-u", "--user", help="Drop privileges to user.")
 @click.option("-q", "--quiet", help="Only show log warnings or higher")
 @click.option("-d", "--debug", is_flag=True, help="Enable debugging.")
+@click.option("--artifact-cache", envvar=ARTIFACT_CACHE_ENV, help="Folder or"
+              " http(s) URL of a dependency file cache shared between build"
+              f" hosts. Defaults to ${ARTIFACT_CACHE_ENV}.")
 @click.pass_context
-def main(ctx, user, quiet, debug):
+def main(ctx, user, quiet, debug, artifact_cache):
     ctx.meta["debug"] = debug
     user and drop_privileges(user)
+    set_artifact_cache(artifact_cache)
     if quiet:
         log.setLevel(logging.WARNING)
     if debug:
@@ -128,6 +144,8 @@ _iso_attributes = [
     click.option("--win10x64", is_flag=True,
                  help="This is a Windows 10 64-bit instance."),
     click.option("--iso-mount", help="Mounted ISO Windows installer image."),
+    click.option("--iso-file",
+                 help="Windows installer ISO image, read without mounting."),
     click.option("--serial-key", help="Windows Serial Key."),
     click.option("--product", help="Windows 7 product version."),
     click.option("--python-version", help="Python version to install on VM."),
@@ -209,12 +227,21 @@ def _create_iso(iso_path, attr):
 
     if not h.set_serial_key(attr["serial_key"]):
         exit(1)
-    mount = h.pickmount(attr["iso_mount"])
-    if not mount:
-        log.error("Please specify --iso-mount to a directory containing the "
-                  "mounted Windows Installer ISO image.")
-        log.info("Refer to the documentation on mounting an .iso image.")
-        exit(1)
+    iso = mount = None
+    if attr.get("iso_file"):
+        try:
+            iso = IsoImage(attr["iso_file"])
+        except (OSError, IsoImageError) as e:
+            log.error(f"Failed to read ISO file {attr['iso_file']}: {e}")
+            exit(1)
+    else:
+        mount = h.pickmount(attr["iso_mount"])
+        if not mount:
+            log.error("Please specify --iso-mount to a directory containing "
+                      "the mounted Windows Installer ISO image, or --iso-file "
+                      "to the ISO image.")
+            log.info("Refer to the documentation on mounting an .iso image.")
+            exit(1)
 
     bootstrap = tempfile.mkdtemp(prefix="vmcloak", dir=h.tempdir)
     vmcloak_dir = os.path.join(bootstrap, "vmcloak")
@@ -249,8 +276,22 @@ def _create_iso(iso_path, attr):
 
     # Now try building the ISO
     try:
-        if not h.buildiso(mount, iso_path, bootstrap, h.tempdir,
-                          env_vars=env_vars):
+        if iso:
+            # The files are read out of the image, instead of mounting it.
+            try:
+                with iso:
+                    success = h.buildiso_image(
+                        iso, iso_path, bootstrap, h.tempdir,
+                        env_vars=env_vars
+                    )
+            except (OSError, IsoImageError) as e:
+                log.error(f"Failed to read ISO file {iso.path}: {e}")
+                exit(1)
+        else:
+            success = h.buildiso(
+                mount, iso_path, bootstrap, h.tempdir, env_vars=env_vars
+            )
+        if not success:
             exit(1)
     finally:
         shutil.rmtree(bootstrap)
@@ -352,7 +393,9 @@ def init(ctx, name, adapter, iso, vm, **attr):
     h = os_from_attr(attr)
     if not iso:
         iso_path = os.path.join(attr["tempdir"], "%s.iso" % name)
-        _create_iso(iso_path, attr)
+        with timing.span("iso_build", name) as s:
+            _create_iso(iso_path, attr)
+            s.size = os.path.getsize(iso_path)
         remove_iso = True
     else:
         iso_path = iso
@@ -363,7 +406,8 @@ def init(ctx, name, adapter, iso, vm, **attr):
             image_path, "%s.%s" % (name, p.disk_format))
 
         # Create new image from ISO
-        p.create_new_image(name, os, iso_path, attr)
+        with timing.span("os_install", name):
+            p.create_new_image(name, os, iso_path, attr)
     except Exception:
         log.exception("Failed to create %r:", name)
         return
@@ -392,13 +436,23 @@ def init(ctx, name, adapter, iso, vm, **attr):
 
 
 def _do_install(image, dependencies, attrs={}, skip_installed=True,
-                no_machine_start=False):
+                no_machine_start=False, prefetch_parallel=PREFETCH_PARALLEL,
+                verify=False):
     try:
         installer = DependencyInstaller(image, dependencies, attrs)
     except InstallError as e:
         log.error(f"Install failed: {e}")
         return False
 
+    # Download everything before the VM is started. Files that fail here are
+    # tried again when the dependency is installed.
+    if prefetch_parallel:
+        failed = installer.prefetch(
+            prefetch_parallel, verify, skip_installed
+        )
+        if failed:
+            log.warning(f"Could not prefetch {failed} dependency file(s)")
+
     success = False
     try:
         installer.prepare(no_machine_start=no_machine_start)
@@ -438,9 +492,17 @@ def _do_install(image, dependencies, attrs={}, skip_installed=True,
               " recommended software and configuration changes for the OS.")
 @click.option("-d", "--debug", is_flag=True, help="Install applications in"
               " debug mode.")
+@click.option("--prefetch-parallel", type=int, default=PREFETCH_PARALLEL,
+              show_default=True, help="Amount of dependency files to"
+              " download at the same time before the VM starts. 0 disables"
+              " prefetching.")
+@click.option("--verify", is_flag=True, help="Hash the downloaded dependency"
+              " files again while prefetching, instead of trusting the hash"
+              " index.")
 @click.pass_context
 def install(ctx, name, dependencies, vm_visible, vrde, vrde_port,
-            force_reinstall, no_machine_start, recommended, debug):
+            force_reinstall, no_machine_start, recommended, debug,
+            prefetch_parallel, verify):
     """Install dependencies on an image. Dependency settings are specified
     using name.setting=value. Multiple settings per dependency can be given."""
     user_attr = {"vm_visible": vm_visible}
@@ -492,7 +554,60 @@ def install(ctx, name, dependencies, vm_visible, vrde, vrde_port,
 
     if not _do_install(image, dependencies, user_attr,
                        skip_installed=not force_reinstall,
-                       no_machine_start=no_machine_start):
+                       no_machine_start=no_machine_start,
+                       prefetch_parallel=prefetch_parallel, verify=verify):
+        exit(1)
+
+
+@main.command()
+@click.argument("dependencies", nargs=-1)
+@click.option("--image", help="Prefetch for the OS version of this image.")
+@click.option("--osversion", type=click.Choice(sorted(os_types)),
+              help="Prefetch for this OS version.")
+@click.option("-r", "--recommended", is_flag=True, help="Also prefetch the"
+              " recommended dependencies of the OS version.")
+@click.option("--parallel", type=int, default=PREFETCH_PARALLEL,
+              show_default=True, help="Amount of files to download at the"
+              " same time.")
+@click.option("--verify", is_flag=True, help="Hash the files that are already"
+              " downloaded again, instead of trusting the hash index.")
+def prefetch(dependencies, image, osversion, recommended, parallel, verify):
+    """Download the files of dependencies, and of the dependencies they
+    depend on, without starting a VM."""
+    if image:
+        found = repository.find_image(image)
+        if not found:
+            log.error("Image not found: %s", image)
+            exit(1)
+        osversion = found.osversion
+
+    if not osversion:
+        log.error("Specify an --image or --osversion")
+        exit(1)
+
+    dependencies = list(dependencies)
+    if recommended:
+        try:
+            dependencies = find_recipe(osversion) + dependencies
+        except InstallError as e:
+            log.error(f"Failed to use recommended dependencies. {e}")
+            exit(1)
+
+    if not dependencies:
+        log.error("No dependencies given to prefetch")
+        exit(1)
+
+    deps_versions, _ = parse_dependencies_list(dependencies)
+    try:
+        failed = prefetch_dependencies(
+            deps_versions, osversion, parallel, verify
+        )
+    except InstallError as e:
+        log.error(e)
+        exit(1)
+
+    if failed:
+        log.error(f"Failed to download {failed} file(s)")
         exit(1)
 
 
@@ -559,21 +674,23 @@ def modify(ctx, name, vm_visible, vrde, vrde_port, iso_path):
 def _snapshot(image, vmname, attr, interactive):
     log.info("Creating snapshot %s (%s)", vmname, attr["ip"])
     p = image.platform
-    p.create_snapshot_vm(image, vmname, attr)
-
     a = Agent(image.ipaddr, image.port)
-    wait_for_agent(a)
+    with timing.span("boot", vmname):
+        p.create_snapshot_vm(image, vmname, attr)
+        wait_for_agent(a, expected=timing.expected("boot"))
 
     # Assign a new hostname.
     hostname = attr.get("hostname") or random_string(8, 16)
     a.hostname(hostname)
+    went_down = reset_waiter(p, vmname)
     a.reboot()
     a.kill()
 
-    # Wait for the reboot to kick in.
-    time.sleep(10)
     try:
-        wait_for_agent(a, timeout=600)
+        with timing.span("reboot", vmname):
+            wait_for_reboot(
+                a, went_down, timeout=600, expected=timing.expected("reboot")
+            )
     except OSError as e:
         log.error(f"VM online wait timeout. {e}")
         exit(1)
@@ -606,6 +723,175 @@ def _snapshot(image, vmname, attr, interactive):
                     ipaddr=attr["ip"], port=attr["port"])
 
 
+class _SnapshotLimits:
+    """Host-wide limits shared by the workers of a parallel snapshot run."""
+
+    def __init__(self, max_boots, max_dumps):
+        # Every new VM boots with the IP of the image. Only one VM at a time
+        # may own that IP, until it has been moved to its own IP.
+        self.image_ip = threading.Lock()
+        self.boots = threading.BoundedSemaphore(max_boots)
+        self.dumps = threading.BoundedSemaphore(max_dumps)
+
+
+def _snapshot_worker(image, vmname, attr, limits):
+    """Create a single snapshot as part of a parallel snapshot run. Unlike
+    _snapshot, the IP of the VM is changed before the hostname reboot, so
+    the image IP is only occupied during the first boot."""
+    p = image.platform
+    h = get_os(image.osversion)
+    hostname = attr["hostname"]
+    # VMs boot without network if the platform supports it. They can then
+    # boot at the same time and only take turns owning the image IP.
+    unplugged = hasattr(p, "set_link")
+
+    try:
+        with limits.boots, timing.span("boot", vmname):
+            log.debug("Booting %s", vmname)
+            if unplugged:
+                p.create_snapshot_vm(image, vmname, attr, link_down=True)
+
+            with limits.image_ip:
+                if unplugged:
+                    p.set_link(vmname, True)
+                else:
+                    p.create_snapshot_vm(image, vmname, attr)
+                a = Agent(image.ipaddr, image.port)
+                wait_for_agent(a, expected=timing.expected("boot"))
+                a.static_ip(
+                    attr["ip"], attr["netmask"], attr["gateway"],
+                    h.interface
+                )
+
+        a.hostname(hostname)
+        with limits.boots, timing.span("reboot", vmname):
+            went_down = reset_waiter(p, vmname)
+            a.reboot()
+            a.kill()
+            wait_for_reboot(
+                a, went_down, timeout=600, expected=timing.expected("reboot")
+            )
+
+        if attr.get("resolution"):
+            width, height = attr["resolution"].split("x")
+            a.resolution(width, height)
+
+        a.remove("C:\\vmcloak")
+
+        with limits.dumps:
+            log.debug("Creating snapshot %s", vmname)
+            p.create_snapshot(vmname)
+        p.create_machineinfo_dump(vmname, image)
+    except Exception:
+        p.remove_vm_data(vmname)
+        raise
+
+    return Snapshot(image_id=image.id, vmname=vmname, hostname=hostname,
+                    ipaddr=attr["ip"], port=attr["port"])
+
+
+def _fork_template(image, attr):
+    """Boot the image once and save the running VM as the template that
+    snapshots are forked from. Returns the name of the template."""
+    p = image.platform
+    name = f"{image.name}-forktemplate"
+    # Remove the leftovers of an earlier run that was aborted.
+    p.remove_fork_template(name)
+    template_attr = dict(attr)
+    vmdir = p.prepare_snapshot(name, template_attr)
+    os.makedirs(vmdir, exist_ok=True)
+
+    log.info(f"Booting fork template '{name}'")
+    try:
+        with timing.span("boot", name):
+            p.create_fork_template(image, name, template_attr)
+            a = Agent(image.ipaddr, image.port)
+            wait_for_agent(a, expected=timing.expected("boot"))
+        if attr.get("resolution"):
+            width, height = attr["resolution"].split("x")
+            a.resolution(width, height)
+
+        a.remove("C:\\vmcloak")
+        p.save_fork_template(name)
+    except Exception:
+        p.remove_fork_template(name)
+        raise
+
+    return name
+
+
+def _snapshot_fork_worker(image, vmname, attr, limits, template):
+    """Create a single snapshot by resuming the fork template. The hostname
+    is changed without a reboot. The VM is given a new MAC and IP before
+    the memory snapshot is made."""
+    p = image.platform
+    h = get_os(image.osversion)
+    hostname = attr["hostname"]
+
+    try:
+        with limits.boots, timing.span("fork", vmname):
+            log.debug("Forking %s from %s", vmname, template)
+            p.create_fork_vm(template, vmname, attr, link_down=True)
+
+            # Forks run without network until they have their own IP.
+            with limits.image_ip:
+                p.set_link(vmname, True)
+                a = Agent(image.ipaddr, image.port)
+                wait_for_agent(a, expected=timing.expected("fork"))
+                a.hostname(hostname, live=True)
+                a.static_ip(
+                    attr["ip"], attr["netmask"], attr["gateway"],
+                    h.interface, mac=attr["mac"]
+                )
+
+        with limits.dumps:
+            log.debug("Creating snapshot %s", vmname)
+            p.create_snapshot(vmname)
+        p.create_machineinfo_dump(vmname, image)
+    except Exception:
+        p.remove_vm_data(vmname)
+        raise
+
+    return Snapshot(image_id=image.id, vmname=vmname, hostname=hostname,
+                    ipaddr=attr["ip"], port=attr["port"])
+
+
+def _add_snapshot(new_snapshot):
+    ses = Session()
+    try:
+        ses.add(new_snapshot)
+        ses.commit()
+    finally:
+        ses.close()
+
+
+def _snapshot_parallel(image, jobs, parallel, max_boots, max_dumps,
+                       worker=_snapshot_worker):
+    """Run the given (vmname, attr) snapshot jobs using a pool of 'parallel'
+    workers. Each snapshot is added to the repository as soon as its worker
+    finishes. Returns the amount of snapshots that failed."""
+    limits = _SnapshotLimits(max_boots, max_dumps)
+    failed = 0
+    with ThreadPoolExecutor(max_workers=parallel) as pool:
+        futures = {
+            pool.submit(worker, image, vmname, attr, limits): vmname
+            for vmname, attr in jobs
+        }
+        for future in as_completed(futures):
+            vmname = futures[future]
+            try:
+                new_snapshot = future.result()
+            except Exception as e:
+                log.exception(f"Failed to create snapshot '{vmname}'. {e}")
+                failed += 1
+                continue
+
+            _add_snapshot(new_snapshot)
+            log.info(f"Snapshot '{vmname}' created")
+
+    return failed
+
+
 def _if_defined(attr, k, v):
     if v is not None:
         attr[k] = v
@@ -685,7 +971,9 @@ def isodownload(win7x64, win10x64, download_to):
         iso_path = os.path.join(conf_path, filename_from_url(url))
 
     log.info(f"Downloading ISO for {name} to {iso_path}")
-    success, sha1 = download_file(url, iso_path)
+    success, sha1 = download_file(
+        url, iso_path, segments=DOWNLOAD_SEGMENTS
+    )
     if not success:
         log.error("ISO download failed")
     else:
@@ -697,6 +985,113 @@ def isodownload(win7x64, win10x64, download_to):
             )
 
 
+@main.command("bench-compress")
+@click.argument("sample")
+@click.option("--size", type=int, default=1024, show_default=True,
+              help="Amount of MB of the sample to compress.")
+@click.option("--outdir", default=repository.vms_path, show_default=True,
+              help="Directory to write the compressed output to. Should be"
+              " on the disk the memory snapshots are stored on.")
+def bench_compress(sample, size, outdir):
+    """Find the best memory snapshot compressor for this host. SAMPLE is
+    an uncompressed RAM dump, such as a memory snapshot made with
+    '--compressor none'."""
+    if not os.path.isfile(sample):
+        log.error(f"Sample {sample} does not exist")
+        exit(1)
+
+    os.makedirs(outdir, exist_ok=True)
+    p = repository.platform("qemu")
+    results = p.benchmark_compressors(sample, outdir, size * 1024**2)
+    if not results:
+        log.error("No compressor could be benchmarked")
+        exit(1)
+
+    print("Compressor", "level", "threads", "seconds", "MB/s", "ratio")
+    for r in results:
+        print(
+            r["compressor"], r["level"], r["threads"] or "-",
+            "%.2f" % r["seconds"],
+            "%.1f" % (r["input"] / 1024**2 / max(r["seconds"], 0.001)),
+            "%.2f" % (r["output"] / max(r["input"], 1)),
+        )
+
+    # The fastest compressor wins. Prefer a smaller output if it is at most
+    # 10 percent slower than the fastest.
+    fastest = min(r["seconds"] for r in results)
+    best = min(
+        (r for r in results if r["seconds"] <= fastest * 1.1),
+        key=lambda r: r["output"]
+    )
+    print()
+    print(
+        f"Recommended: --compressor {best['compressor']}"
+        + (f" --compress-level {best['level']}" if best["level"] else "")
+        + (f" --compress-threads {best['threads']}"
+           if best["threads"] else "")
+    )
+
+
+@main.command("memstore-gc")
+def memstore_gc():
+    """Remove chunks from the memory store that are no longer used by any
+    memory snapshot."""
+    from vmcloak.memstore import MemoryStore, find_manifests
+
+    manifests = []
+
+    def find():
+        manifests.extend(
+            find_manifests(os.path.join(repository.vms_path, "qemu"))
+        )
+        return manifests
+
+    removed = MemoryStore(repository.memstore_path).gc(find)
+    log.info(
+        f"Removed {removed} unused chunk(s). {len(manifests)} memory "
+        f"snapshot(s) use the store."
+    )
+
+
+def _print_timing_rows(title, rows):
+    def fmt(v):
+        return "-" if v is None else "%.1f" % v
+
+    print(
+        title, "count", "failed", "p50", "p90", "p99", "max", "total(s)",
+        "size(MB)"
+    )
+    for r in rows:
+        size = r["size_p50"] / 1024**2 if r["size_p50"] else None
+        print(
+            r["name"], r["count"], r["failed"], fmt(r["p50"]),
+            fmt(r["p90"]), fmt(r["p99"]), fmt(r["max"]), fmt(r["total"]),
+            fmt(size)
+        )
+
+
+@main.command()
+@click.option("--phase", help="Only show this phase.")
+@click.option("--days", type=int, help="Only use timings of the last amount"
+              " of days.")
+def stats(phase, days):
+    """Show how long the phases of image and snapshot creation take. The
+    durations are in seconds."""
+    since = time.time() - days * 86400 if days else None
+    timings = timing.load(phase=phase, since=since)
+    if not timings:
+        log.info("No timings recorded yet")
+        return
+
+    _print_timing_rows("Phase", timing.summarize(timings))
+    deps = [t for t in timings if t.phase == "dependency"]
+    if deps:
+        print()
+        _print_timing_rows(
+            "Dependency", timing.summarize(deps, key=lambda t: t.detail)
+        )
+
+
 @main.command()
 @click.argument("name")
 @click.option("--vm", default="qemu", help="Virtual Machinery.")
@@ -727,10 +1122,44 @@ def cleanup(name, vm):
 @click.option("--com1", is_flag=True, help="Enable COM1 for this VM.")
 @click.option("--nopatch", is_flag=True, help="Do not patch the image to be"
               " able to load threemon")
+@click.option("--parallel", type=int, default=1, show_default=True,
+              help="The amount of snapshots to create at the same time.")
+@click.option("--max-boots", type=int, default=4, show_default=True,
+              help="The maximum amount of VMs booting at the same time when"
+              " using --parallel.")
+@click.option("--max-dumps", type=int, default=2, show_default=True,
+              help="The maximum amount of memory snapshots being written at"
+              " the same time when using --parallel.")
+@click.option("--compressor", default="auto", show_default=True,
+              type=click.Choice(["auto", "zstd", "lz4", "pigz", "gzip",
+                                 "none"]),
+              help="Compressor for the memory snapshot. See"
+              " 'vmcloak bench-compress'.")
+@click.option("--compress-level", type=int, help="Compression level. Uses"
+              " the default level of the compressor if not given.")
+@click.option("--compress-threads", type=int, default=0, show_default=True,
+              help="Threads used by multi-threaded compressors. 0 uses all"
+              " CPUs.")
+@click.option("--dedup", is_flag=True, help="Store the memory snapshot as"
+              " chunks in the shared deduplicating memory store. The"
+              " migration stream is chunked as it arrives.")
+@click.option("--dump-backend", default="exec", show_default=True,
+              type=click.Choice(["auto", "exec", "file"]),
+              help="How the memory snapshot is written. 'file' lets QEMU"
+              " (9.0 or newer) write an uncompressed snapshot using multiple"
+              " channels. 'auto' uses 'file' if QEMU supports it.")
+@click.option("--dump-channels", type=int, default=0, show_default=True,
+              help="Channels used by the 'file' dump backend. 0 uses the"
+              " amount of CPUs, up to 8.")
+@click.option("--fork", is_flag=True, help="Boot the image once and create"
+              " all snapshots from that running VM, instead of booting and"
+              " rebooting a VM per snapshot.")
 @click.pass_context
 def snapshot(ctx, name, vmname, ip, resolution, ramsize, cpus, hostname,
              vm_visible, count, vrde, vrde_port, interactive,
-             com1, nopatch):
+             com1, nopatch, parallel, max_boots, max_dumps, compressor,
+             compress_level, compress_threads, dedup, dump_backend,
+             dump_channels, fork):
     """Create one or more snapshots from an image"""
     if count and hostname:
         log.error(
@@ -739,6 +1168,16 @@ def snapshot(ctx, name, vmname, ip, resolution, ramsize, cpus, hostname,
         )
         exit(1)
 
+    if parallel < 1 or max_boots < 1 or max_dumps < 1:
+        log.error("--parallel, --max-boots and --max-dumps must be 1 or more")
+        exit(1)
+
+    if interactive and (parallel > 1 or fork):
+        log.error(
+            "Interactive mode cannot be combined with --parallel or --fork"
+        )
+        exit(1)
+
     image = repository.find_image(name)
     if not image:
         log.error("Image not found: %s", name)
@@ -773,6 +1212,42 @@ def snapshot(ctx, name, vmname, ip, resolution, ramsize, cpus, hostname,
     if vrde or ctx.meta["debug"]:
         attr["vrde"] = vrde_port
 
+    p = image.platform
+    if fork and not hasattr(p, "create_fork_vm"):
+        log.error(f"Platform {p.name} does not support --fork")
+        exit(1)
+    if fork:
+        log.warning(
+            "Forked snapshots are renamed without a reboot. The Agent and the "
+            "processes it starts keep the COMPUTERNAME and USERDOMAIN "
+            "environment variables of the template."
+        )
+
+    if hasattr(p, "pick_compressor"):
+        try:
+            attr["compressor"] = p.pick_compressor(compressor)
+        except KeyError as e:
+            log.error(f"Cannot use compressor. {e}")
+            exit(1)
+        attr["compress_level"] = compress_level
+        attr["compress_threads"] = compress_threads
+        attr["dedup"] = dedup
+        if dedup and compressor != "auto":
+            log.warning("--compressor is ignored when using --dedup")
+        if dedup and dump_backend != "exec":
+            log.warning("--dump-backend is ignored when using --dedup")
+
+        try:
+            attr["dump_backend"] = p.pick_dump_backend(
+                "exec" if dedup else dump_backend
+            )
+        except KeyError as e:
+            log.error(f"Cannot use dump backend. {e}")
+            exit(1)
+        attr["dump_channels"] = dump_channels
+        if attr["dump_backend"] == "file" and compressor != "auto":
+            log.warning("--compressor is ignored by the 'file' dump backend")
+
     # Perform final changes such patching for kernel monitor and
     # disabling services that were still needed during the image
     # creation/install phase.
@@ -790,7 +1265,6 @@ def snapshot(ctx, name, vmname, ip, resolution, ramsize, cpus, hostname,
         ses.close()
 
     # Copy properties from image and replace snapshot-specific ones
-    p = image.platform
     attr["imgpath"] = attr.pop("path")
     attr["vm_visible"] = vm_visible
     _if_defined(attr, "cpus", cpus)
@@ -810,31 +1284,64 @@ def snapshot(ctx, name, vmname, ip, resolution, ramsize, cpus, hostname,
     # the old adapter (or use IPv6-LL)
     # _if_defined(attr, "adapter", adapter)
 
+    jobs = []
     for vmname, ip, port in vm_iter(count, vmname, iplist, vrde_port):
-        vmdir = p.prepare_snapshot(vmname, attr)
+        vm_attr = dict(attr)
+        vmdir = p.prepare_snapshot(vmname, vm_attr)
         if not vmdir:
             log.warning("Not creating %r because it exists", vmname)
             continue
 
-        log.info(f"Creating snapshot: '{vmname}' with IP '{ip}'")
         if not os.path.exists(vmdir):
             os.makedirs(vmdir)
-        if "vrde" in attr:
-            attr["vrde"] = port
+        if "vrde" in vm_attr:
+            vm_attr["vrde"] = port
         if com1:
-            attr["serial"] = os.path.join(vmdir, "%s.com1" % vmname)
+            vm_attr["serial"] = os.path.join(vmdir, "%s.com1" % vmname)
         if not hostname:
-            attr["hostname"] = random_string(8, 16)
-        attr["ip"] = ip
-        new_snapshot = _snapshot(image, vmname, attr, interactive)
-        ses = Session()
+            vm_attr["hostname"] = random_string(8, 16)
+        vm_attr["ip"] = ip
+
+        if parallel > 1 or fork:
+            jobs.append((vmname, vm_attr))
+            continue
+
+        log.info(f"Creating snapshot: '{vmname}' with IP '{ip}'")
+        new_snapshot = _snapshot(image, vmname, vm_attr, interactive)
+        _add_snapshot(new_snapshot)
+
+        log.info(f"Snapshot '{vmname}' created")
+
+    if jobs and fork:
         try:
-            ses.add(new_snapshot)
-            ses.commit()
+            template = _fork_template(image, attr)
+        except Exception as e:
+            log.exception(f"Failed to create fork template. {e}")
+            exit(1)
+
+        log.info(
+            f"Forking {len(jobs)} snapshot(s) using {parallel} workers"
+        )
+        try:
+            failed = _snapshot_parallel(
+                image, jobs, parallel, max_boots, max_dumps,
+                worker=functools.partial(
+                    _snapshot_fork_worker, template=template
+                )
+            )
         finally:
-            ses.close()
+            p.remove_fork_template(template)
+    elif jobs:
+        log.info(
+            f"Creating {len(jobs)} snapshot(s) using {parallel} workers"
+        )
+        failed = _snapshot_parallel(image, jobs, parallel, max_boots,
+                                    max_dumps)
 
-        log.info(f"Snapshot '{vmname}' created")
+    if jobs:
+        if failed:
+            log.error(f"Failed to create {failed} snapshot(s)")
+            exit(1)
 
     log.info("Finished creating snapshots")
 
@@ -925,8 +1432,16 @@ def list_snapshots():
         print("-", snap.vmname, snap.ipaddr)
 
 
-def list_dependencies(name_only=False):
-    print("Name", "version", "target", "sha1", "arch")
+def _dependency_cache_status(d, exe, verify):
+    try:
+        filepath, _, sha1, _ = d._find_downloadable_files([exe])[0]
+    except KeyError:
+        return "-"
+    return file_status(filepath, sha1, verify)
+
+
+def list_dependencies(name_only=False, verify=False):
+    print("Name", "version", "target", "sha1", "arch", "cache")
     print()
     for name, d in sorted(vmcloak.dependencies.names.items()):
         if d.exes:
@@ -944,7 +1459,7 @@ def list_dependencies(name_only=False):
                 name, "*" if d.default and d.default == v else "",
                 exe.get("version", "None") + " "*(versionlen - len(v)),
                 exe.get("target"), exe.get("sha1", "None"),
-                exe.get("arch", ""),
+                exe.get("arch", ""), _dependency_cache_status(d, exe, verify)
             )
         print("----"*5)
 
@@ -952,5 +1467,7 @@ def list_dependencies(name_only=False):
 @_list.command("deps")
 @click.option("--name-only", is_flag=True, help="Only list the names of"
               " existing dependencies")
-def _list_deps(name_only):
-    list_dependencies(name_only)
+@click.option("--verify", is_flag=True, help="Hash the downloaded files to"
+              " show their cache status, instead of trusting the hash index.")
+def _list_deps(name_only, verify):
+    list_dependencies(name_only, verify)
@@ -0,0 +1,278 @@
+# Copyright (C) 2026 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+"""Content-addressed chunk store for memory snapshots.
+
+Memory snapshots made from the same image are almost identical. Instead of
+storing each of them in full, a snapshot is split into chunks. Each unique
+chunk is stored once, and the snapshot itself becomes a small manifest of
+chunk hashes and lengths. Zero chunks are not stored at all.
+
+A migration stream packs zero pages into a few bytes, which shifts the data
+that follows. Chunks therefore end after an anchor byte sequence instead of
+at fixed offsets, so the chunks of two snapshots line up again right after
+the data where they differ.
+
+A chunk that already exists is not written again, so it must not be removed
+before the manifest that uses it is written. Storing takes a shared lock on
+the store and garbage collection takes an exclusive one.
+
+The module can be run to store a dump from stdin or write one to stdout.
+This lets it act as the QEMU exec migration target and source:
+
+    python -m vmcloak.memstore store --store DIR memory.manifest < dump
+    python -m vmcloak.memstore cat --store DIR memory.manifest > dump
+"""
+
+import argparse
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import sys
+import tempfile
+import zlib
+
+log = logging.getLogger(__name__)
+
+MANIFEST_NAME = "memory.manifest"
+CHUNK_SIZE = 64 * 1024
+# On random data this occurs once every 64KB on average.
+ANCHOR = b"\x9c\x5e"
+LOCK_NAME = ".lock"
+
+_RAW = b"\x00"
+_ZLIB = b"\x01"
+
+class MemoryStore(object):
+    def __init__(self, path, chunk_size=CHUNK_SIZE):
+        self.path = path
+        # A chunk is at least a quarter and at most four times chunk_size.
+        self.min_size = chunk_size // 4
+        self.max_size = chunk_size * 4
+
+    @contextlib.contextmanager
+    def lock(self, exclusive=False):
+        """Hold a shared or exclusive lock on the store."""
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, LOCK_NAME), "a") as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def chunk_path(self, digest):
+        return os.path.join(self.path, digest[:2], digest)
+
+    def put(self, buf):
+        """Store a chunk if it is not stored yet. Returns its hash and the
+        amount of bytes written, or None for a chunk of zeroes."""
+        if buf.count(0) == len(buf):
+            return None, 0
+
+        digest = hashlib.sha1(buf).hexdigest()
+        path = self.chunk_path(digest)
+        if os.path.exists(path):
+            return digest, 0
+
+        compressed = zlib.compress(buf, 1)
+        if len(compressed) < len(buf):
+            data = _ZLIB + compressed
+        else:
+            data = _RAW + buf
+
+        # Write to a temporary file first. Other snapshots may be storing the
+        # same chunk at the same time.
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(data)
+        os.replace(tmp_path, path)
+        return digest, len(data)
+
+    def get(self, digest):
+        with open(self.chunk_path(digest), "rb") as fp:
+            data = fp.read()
+
+        if data[:1] == _ZLIB:
+            return zlib.decompress(data[1:])
+        return data[1:]
+
+    def store(self, fp, manifest_path):
+        """Read a memory dump from file object fp until EOF, store its chunks
+        and write the manifest. Returns a dict with statistics."""
+        with self.lock():
+            return self._store(fp, manifest_path)
+
+    def chunks(self, fp):
+        """Split the data read from file object fp into chunks that end
+        after the first anchor past min_size, or at max_size."""
+        buf = b""
+        pos = 0
+        eof = False
+        while True:
+            if not eof and len(buf) - pos < self.max_size:
+                more = _read_full(fp, self.max_size * 16)
+                eof = len(more) < self.max_size * 16
+                buf = buf[pos:] + more
+                pos = 0
+            if pos >= len(buf):
+                return
+
+            end = buf.find(ANCHOR, pos + self.min_size, pos + self.max_size)
+            if end == -1:
+                end = min(pos + self.max_size, len(buf))
+            else:
+                end += len(ANCHOR)
+            yield buf[pos:end]
+            pos = end
+
+    def _store(self, fp, manifest_path):
+        chunks = []
+        size = written = new = 0
+        for buf in self.chunks(fp):
+            digest, chunk_written = self.put(buf)
+            chunks.append([digest, len(buf)])
+            size += len(buf)
+            written += chunk_written
+            new += bool(chunk_written)
+
+        manifest = {
+            "version": 2,
+            "size": size,
+            "written": written,
+            "chunks": chunks,
+        }
+        tmp_path = f"{manifest_path}.tmp"
+        with open(tmp_path, "w") as mp:
+            json.dump(manifest, mp)
+        os.replace(tmp_path, manifest_path)
+
+        return {
+            "size": size, "chunks": len(chunks), "new_chunks": new,
+            "written": written
+        }
+
+    def restore(self, manifest_path, out):
+        """Write the memory dump of the manifest to file object out. Zero
+        chunks are skipped with a seek if out is a regular file, leaving a
+        sparse file."""
+        manifest = read_manifest(manifest_path)
+        try:
+            seekable = out.seekable()
+        except (AttributeError, OSError):
+            seekable = False
+
+        for digest, length in manifest["chunks"]:
+            if digest:
+                out.write(self.get(digest))
+            elif seekable:
+                out.seek(length, os.SEEK_CUR)
+            else:
+                out.write(bytes(length))
+
+        if seekable:
+            out.truncate()
+
+    def gc(self, manifest_paths):
+        """Remove all chunks that are not used by any of the given manifests.
+        manifest_paths is a list of paths or a function that returns one. A
+        function is called once running stores are done, so it also sees
+        their manifests. Returns the amount of chunks removed."""
+        removed = 0
+        if not os.path.isdir(self.path):
+            return removed
+
+        # Running stores may use existing chunks in manifests that are not
+        # written yet, so wait for them.
+        with self.lock(exclusive=True):
+            if callable(manifest_paths):
+                manifest_paths = manifest_paths()
+
+            used = set()
+            for path in manifest_paths:
+                used.update(
+                    d for d, _ in read_manifest(path)["chunks"] if d
+                )
+
+            for dirpath, _, filenames in os.walk(self.path):
+                for fname in filenames:
+                    if fname in used or dirpath == self.path:
+                        continue
+                    os.remove(os.path.join(dirpath, fname))
+                    removed += 1
+
+        return removed
+
+def _read_full(fp, size):
+    """Read exactly size bytes unless EOF is reached. Pipes may return less
+    than requested."""
+    buf = fp.read(size)
+    while buf and len(buf) < size:
+        more = fp.read(size - len(buf))
+        if not more:
+            break
+        buf += more
+    return buf
+
+def read_manifest(path):
+    with open(path, "r") as fp:
+        return json.load(fp)
+
+def find_manifests(dirpath):
+    """Return the paths of all memory snapshot manifests in the VM
+    directories under dirpath."""
+    manifests = []
+    if not os.path.isdir(dirpath):
+        return manifests
+
+    for vm_name in os.listdir(dirpath):
+        path = os.path.join(dirpath, vm_name, MANIFEST_NAME)
+        if os.path.isfile(path):
+            manifests.append(path)
+
+    return manifests
+
+def store_command(store_path, manifest_path):
+    """Return the shell command that stores a dump from stdin."""
+    return (
+        f"{sys.executable} -m vmcloak.memstore store "
+        f"--store {store_path} {manifest_path}"
+    )
+
+def cat_command(store_path, manifest_path):
+    """Return the shell command that writes a stored dump to stdout."""
+    return (
+        f"{sys.executable} -m vmcloak.memstore cat "
+        f"--store {store_path} {manifest_path}"
+    )
+
+def main(args=None):
+    logging.basicConfig(
+        format="%(asctime)s %(name)s %(levelname)s: %(message)s",
+        level=logging.INFO
+    )
+    parser = argparse.ArgumentParser(prog="python -m vmcloak.memstore")
+    parser.add_argument("action", choices=["store", "cat"])
+    parser.add_argument("manifest")
+    parser.add_argument("--store", required=True, help="Chunk store path")
+    args = parser.parse_args(args)
+
+    store = MemoryStore(args.store)
+    if args.action == "store":
+        stats = store.store(sys.stdin.buffer, args.manifest)
+        log.info(
+            "Stored %s chunks, %s new (%.1fMB written of %.1fMB)",
+            stats["chunks"], stats["new_chunks"], stats["written"] / 1024**2,
+            stats["size"] / 1024**2
+        )
+    else:
+        store.restore(args.manifest, sys.stdout.buffer)
+        sys.stdout.buffer.flush()
+
+if __name__ == "__main__":
+    main()
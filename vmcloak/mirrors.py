@@ -0,0 +1,204 @@
+# Copyright (C) 2026 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+"""Choosing between the download URLs of a dependency file.
+
+All URLs are probed at the same time and tried from the fastest responder
+to the slowest. The latency and failures of each host are kept in
+hoststats.json in the VMCloak folder. Hosts that failed several times in a
+row are skipped for a while, unless no other host is left.
+"""
+
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from vmcloak.repository import conf_path
+
+log = logging.getLogger(__name__)
+
+HOST_STATS_PATH = os.path.join(conf_path, "hoststats.json")
+# Seconds a probe may take before the host counts as not responding.
+PROBE_TIMEOUT = 5
+# A host that failed this many times in a row is skipped for DEAD_PERIOD
+# seconds after its last failure.
+DEAD_FAILURES = 3
+DEAD_PERIOD = 24 * 60 * 60
+# Weight of a new latency measurement in the moving average.
+LATENCY_WEIGHT = 0.3
+
+def url_host(url):
+    return urllib.parse.urlparse(url).netloc.lower()
+
+class HostStats(object):
+    """Latency and failure counts per host, stored as JSON. Several VMCloak
+    processes may use the file at the same time, so every update re-reads
+    it under a file lock before writing it."""
+
+    def __init__(self, path=HOST_STATS_PATH):
+        self.path = path
+        self._hosts = None
+        self._lock = threading.RLock()
+        # Hosts whose last probe by this process failed.
+        self._probe_failed = set()
+
+    @property
+    def hosts(self):
+        if self._hosts is None:
+            self._hosts = self._load()
+        return self._hosts
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as fp:
+                return json.load(fp)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            log.warning(f"Ignoring unreadable host stats {self.path}. {e}")
+            return {}
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        try:
+            fp = open(f"{self.path}.lock", "a")
+        except OSError as e:
+            log.debug(f"Could not lock host stats {self.path}. {e}")
+            yield
+            return
+
+        with fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def _save(self):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w") as fp:
+                json.dump(self.hosts, fp, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            log.warning(f"Could not write host stats {self.path}. {e}")
+
+    def get(self, host):
+        with self._lock:
+            return dict(self.hosts.get(host, {}))
+
+    def record(self, host, latency=None, failed=False, probe=False):
+        """Store the outcome of a probe or download from host. Latency is
+        the amount of seconds until the host responded. A failed download
+        right after a failed probe of the same host is the same failed
+        attempt, so it is not counted again."""
+        with self._lock:
+            if probe and failed:
+                self._probe_failed.add(host)
+            elif not probe and host in self._probe_failed:
+                self._probe_failed.discard(host)
+                if failed:
+                    return
+
+            with self._file_lock():
+                # Merge with the updates of other processes.
+                self._hosts = self._load()
+                stats = self._hosts.setdefault(host, {
+                    "latency": None, "failures": 0, "successes": 0,
+                    "last_failure": None,
+                })
+                if failed:
+                    stats["failures"] += 1
+                    stats["last_failure"] = time.time()
+                else:
+                    stats["failures"] = 0
+                    stats["successes"] += 1
+
+                if latency is not None:
+                    if stats["latency"] is None:
+                        stats["latency"] = latency
+                    else:
+                        stats["latency"] += \
+                            (latency - stats["latency"]) * LATENCY_WEIGHT
+                self._save()
+
+    def is_dead(self, host):
+        """Return True if host failed DEAD_FAILURES times in a row, the last
+        time less than DEAD_PERIOD seconds ago."""
+        stats = self.get(host)
+        if stats.get("failures", 0) < DEAD_FAILURES:
+            return False
+        return time.time() - (stats.get("last_failure") or 0) < DEAD_PERIOD
+
+_host_stats = None
+_host_stats_lock = threading.Lock()
+
+def host_stats():
+    """Return the shared HostStats of this host."""
+    global _host_stats
+    with _host_stats_lock:
+        if _host_stats is None:
+            _host_stats = HostStats()
+        return _host_stats
+
+def probe(url, timeout=PROBE_TIMEOUT):
+    """Return the amount of seconds until the server of url answered a
+    request for it, or None if it did not answer successfully."""
+    headers = {"User-Agent": "Mozilla/5.0"}
+    start = time.monotonic()
+    try:
+        resp = requests.head(
+            url, headers=headers, timeout=timeout, allow_redirects=True
+        )
+        if resp.status_code in (403, 405, 501):
+            # Some servers do not allow HEAD. Only read the headers.
+            with requests.get(url, headers=headers, timeout=timeout,
+                              stream=True) as resp:
+                pass
+    except requests.RequestException as e:
+        log.debug(f"Probe of {url} failed: {e}")
+        return None
+
+    if resp.status_code >= 400:
+        log.debug(f"Probe of {url} failed: HTTP {resp.status_code}")
+        return None
+    return time.monotonic() - start
+
+def order_urls(urls, stats=None, timeout=PROBE_TIMEOUT):
+    """Return the urls in the order they should be tried. Hosts that are
+    known to be dead are skipped, the others are probed at the same time.
+    The fastest responders come first, then the urls whose probe failed.
+    If all hosts are dead, all urls are returned in their given order."""
+    stats = stats or host_stats()
+    alive = [url for url in urls if not stats.is_dead(url_host(url))]
+    skipped = [url for url in urls if url not in alive]
+    for url in skipped:
+        log.debug(f"Skipping {url}, its host failed recently")
+    if not alive:
+        return list(urls)
+    if len(alive) == 1:
+        return alive
+
+    with ThreadPoolExecutor(max_workers=len(alive)) as pool:
+        latencies = list(pool.map(lambda url: probe(url, timeout), alive))
+
+    for url, latency in zip(alive, latencies):
+        stats.record(
+            url_host(url), latency, failed=latency is None, probe=True
+        )
+
+    responded = sorted(
+        (latency, i) for i, latency in enumerate(latencies)
+        if latency is not None
+    )
+    ordered = [alive[i] for _, i in responded]
+    return ordered + [url for url in alive if url not in ordered]
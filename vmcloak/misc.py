@@ -2,17 +2,22 @@
 # This file is part of VMCloak - http://www.vmcloak.org/.
 # See the file 'docs/LICENSE.txt' for copying permission.
 
+import errno
 import hashlib
 import importlib
+import json
 import logging
 import os
+import selectors
 import shutil
 import socket
 import stat
 import struct
 import sys
+import threading
 import time
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
 
 import requests
@@ -77,6 +82,60 @@ def copytreeinto(srcdir, dstdir):
         else:
             copytreeinto(path_in, path_out)
 
+def iso_graft_points(srcdir, exclude=()):
+    """Return the graft points that put the files of the source directory
+    in the root of a new ISO file, as a dict of target to source path.
+
+    Targets are lowercase, emulating Windows case-insensitive filepaths like
+    copytreelower() does, but nothing is copied. Targets in exclude, such as
+    files that are replaced by the OS handler, are left out.
+
+    """
+    exclude = set(path.lower() for path in exclude)
+    grafts = {}
+    for dirpath, dirnames, filenames in os.walk(srcdir):
+        reldir = os.path.relpath(dirpath, srcdir)
+        reldir = "" if reldir == "." else reldir.lower()
+        if not dirnames and not filenames and reldir:
+            # Grafting an empty directory creates it in the ISO file.
+            grafts[reldir + "/"] = dirpath
+
+        for fname in filenames:
+            target = os.path.join(reldir, fname.lower())
+            if target not in exclude:
+                grafts[target] = os.path.join(dirpath, fname)
+    return grafts
+
+def find_nocase(srcdir, relpath):
+    """Return the path of relpath in srcdir, matching each path component
+    case-insensitively, or None if there is no such path."""
+    path = srcdir
+    for name in relpath.replace("\\", "/").split("/"):
+        if not name:
+            continue
+        try:
+            names = os.listdir(path)
+        except OSError:
+            return None
+        for entry in names:
+            if entry.lower() == name.lower():
+                path = os.path.join(path, entry)
+                break
+        else:
+            return None
+    return path
+
+def _escape_graft(path):
+    return path.replace("\\", "\\\\").replace("=", "\\=")
+
+def write_path_list(path, grafts):
+    """Write graft points as a genisoimage -path-list file."""
+    with open(path, "w", encoding="utf-8") as fp:
+        for target, source in sorted(grafts.items()):
+            if "\n" in target or "\n" in source:
+                raise ValueError(f"Cannot graft path with newline: {source!r}")
+            fp.write(f"{_escape_graft(target)}={_escape_graft(source)}\n")
+
 def ini_read(path):
     ret, section = {}, None
 
@@ -175,18 +234,167 @@ def sha1_file(path):
 
     return h.hexdigest()
 
-def wait_for_agent(a, timeout=180):
-    """Wait for the Agent to come up."""
-    now = time.time()
-    while (time.time() - now) < timeout:
-        try:
-            log.debug(f"Sending ping to agent on: {a.ipaddr}:{a.port}")
-            a.ping()
-            return
-        except:
-            log.debug("No response")
-            time.sleep(1)
-    raise IOError("Agent not online within %s second(s)" % timeout)
+# Probe intervals of wait_for_agent, in seconds.
+PROBE_MIN_INTERVAL = 0.1
+PROBE_MAX_INTERVAL = 1.0
+PROBE_SLOW_INTERVAL = 2.0
+
+def port_open(ipaddr, port, timeout=1):
+    """Return True if a TCP connection to ipaddr:port can be made."""
+    try:
+        with socket.create_connection((ipaddr, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+def _open_ports(addrs, timeout):
+    """Try to connect to all (ipaddr, port) addrs at the same time. Returns
+    the set of indexes of the addrs that accepted the connection within
+    timeout."""
+    sel = selectors.DefaultSelector()
+    socks = []
+    opened = set()
+    try:
+        for i, addr in enumerate(addrs):
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.setblocking(False)
+            socks.append(s)
+            # An address that cannot be resolved or routed is not open.
+            try:
+                err = s.connect_ex(addr)
+            except OSError as e:
+                log.debug("Cannot connect to %s:%s: %s", addr[0], addr[1], e)
+                continue
+            if err == 0:
+                opened.add(i)
+            elif err in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                sel.register(s, selectors.EVENT_WRITE, i)
+
+        deadline = time.monotonic() + timeout
+        while sel.get_map():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            for key, _ in sel.select(remaining):
+                sel.unregister(key.fileobj)
+                err = key.fileobj.getsockopt(
+                    socket.SOL_SOCKET, socket.SO_ERROR
+                )
+                if err == 0:
+                    opened.add(key.data)
+    finally:
+        sel.close()
+        for s in socks:
+            s.close()
+
+    return opened
+
+def _probe_interval(elapsed, expected, attempt):
+    """Return how long to wait before the next probe. Without an expected
+    ready time, the interval grows from short to PROBE_MAX_INTERVAL. With
+    one, probes are sent rarely until close to that time and often around
+    it."""
+    if expected is None:
+        return min(PROBE_MAX_INTERVAL, PROBE_MIN_INTERVAL * 2 ** attempt)
+
+    if elapsed < expected * 0.75:
+        return max(
+            PROBE_MIN_INTERVAL,
+            min(PROBE_SLOW_INTERVAL, expected * 0.75 - elapsed)
+        )
+    if elapsed < expected * 1.5:
+        return PROBE_MIN_INTERVAL * 2
+    return PROBE_MAX_INTERVAL
+
+def _ping(a):
+    try:
+        a.ping()
+        return True
+    except Exception as e:
+        log.debug(f"No response from agent on {a.ipaddr}:{a.port}: {e}")
+        return False
+
+def wait_for_agents(agents, timeout=180, expected=None):
+    """Wait for the Agents to come up. The agent ports are probed with TCP
+    connects and an agent is only pinged once its port is open. 'expected'
+    is the amount of seconds agents usually take to come up, if known.
+    Returns a dict with the seconds each agent took to come up, or None for
+    the agents that did not come up within timeout."""
+    start = time.monotonic()
+    pending = list(agents)
+    ready = {}
+    attempt = 0
+    while pending:
+        elapsed = time.monotonic() - start
+        if elapsed >= timeout:
+            break
+
+        opened = _open_ports(
+            [(a.ipaddr, a.port) for a in pending],
+            timeout=min(1, timeout - elapsed)
+        )
+        for i in sorted(opened, reverse=True):
+            a = pending[i]
+            if _ping(a):
+                ready[a] = time.monotonic() - start
+                log.debug(
+                    f"Agent on {a.ipaddr}:{a.port} ready after "
+                    f"{ready[a]:.1f}s"
+                )
+                pending.pop(i)
+
+        if pending:
+            elapsed = time.monotonic() - start
+            time.sleep(min(
+                _probe_interval(elapsed, expected, attempt),
+                max(0, timeout - elapsed)
+            ))
+            attempt += 1
+
+    for a in pending:
+        ready[a] = None
+    return ready
+
+def wait_for_agent(a, timeout=180, expected=None):
+    """Wait for the Agent to come up. Returns the amount of seconds it
+    took. See wait_for_agents."""
+    ready = wait_for_agents([a], timeout, expected)[a]
+    if ready is None:
+        raise IOError("Agent not online within %s second(s)" % timeout)
+    return ready
+
+def reset_waiter(platform, name):
+    """Return the reset waiter of the VM for wait_for_reboot, or None if
+    the platform cannot report guest resets."""
+    if hasattr(platform, "reset_waiter"):
+        return platform.reset_waiter(name)
+    return None
+
+def wait_for_reboot(a, went_down=None, timeout=600, down_timeout=60,
+                    expected=None):
+    """Wait for the guest of Agent 'a' to reboot after a reboot has been
+    requested and for the Agent to come back up. The optional 'went_down'
+    callable receives a timeout and should return True once the hypervisor
+    reports that the guest was reset. Without it, or if it does not report a
+    reset, the guest is considered down once the Agent port closes."""
+    start = time.time()
+    if went_down and went_down(down_timeout):
+        log.debug(f"Guest of {a.ipaddr}:{a.port} has been reset")
+    else:
+        while (time.time() - start) < down_timeout:
+            if not port_open(a.ipaddr, a.port, timeout=1):
+                log.debug(f"Agent port {a.ipaddr}:{a.port} closed")
+                break
+            time.sleep(0.2)
+        else:
+            log.warning(
+                f"Agent port {a.ipaddr}:{a.port} did not close within "
+                f"{down_timeout} second(s) after the reboot request"
+            )
+
+    wait_for_agent(
+        a, timeout=max(1, timeout - (time.time() - start)), expected=expected
+    )
 
 def drop_privileges(user):
     if not HAVE_PWD:
@@ -233,33 +441,400 @@ def filename_from_url(url):
     """Return the filename from a given url."""
     return os.path.basename(urllib.parse.urlparse(url).path)
 
-def download_file(url, filepath):
-    """Download the file from url and store it in the given filepath."""
-    user_agent = "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:94.0) " \
-                 "Gecko/20100101 Firefox/94.0"
-    headers = {
-        "User-Agent": user_agent,
-    }
-
+DOWNLOAD_CHUNK_SIZE = 2 * 1024 * 1024
+# Connect and read timeout. A stalled download is resumed after the latter.
+DOWNLOAD_TIMEOUT = (10, 60)
+# How often an interrupted download is resumed and the delay between tries.
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_RETRY_DELAY = 2
+# Files of at least SEGMENT_MIN_SIZE bytes are downloaded over this amount of
+# connections at the same time, if the server supports range requests.
+DOWNLOAD_SEGMENTS = 4
+SEGMENT_MIN_SIZE = 64 * 1024 * 1024
+
+_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:94.0) " \
+              "Gecko/20100101 Firefox/94.0"
+
+def _read_part_meta(meta_path):
+    try:
+        with open(meta_path, "r") as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {}
+
+def _part_validator(resp):
+    """Return the value to send as If-Range when resuming the download of
+    this response, or None if it cannot be resumed safely."""
+    if resp.headers.get("Accept-Ranges", "").lower() != "bytes" and \
+            resp.status_code != 206:
+        return None
+
+    # Weak ETags cannot be used to resume.
+    etag = resp.headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return resp.headers.get("Last-Modified")
+
+class _Segment(object):
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        # Everything before done has been written.
+        self.done = start
+
+class _SegmentedDownload(object):
+    """Downloads the byte ranges of a file over several connections into a
+    preallocated file. The SHA-1 is calculated in order while the segments
+    come in, by reading back the data that is complete so far. The progress
+    of each segment is kept in a metadata file when the download stops, so
+    a later download continues where each segment stopped."""
+
+    def __init__(self, url, part_path, size, validator, segments, retries,
+                 meta_path, meta_url):
+        self.url = url
+        self.part_path = part_path
+        self.size = size
+        self.validator = validator
+        self.retries = retries
+        self.meta_path = meta_path
+        self.meta_url = meta_url
+        self.resumed = False
+        self.segments = self._resume_segments()
+        if not self.segments:
+            step = -(-size // segments)
+            self.segments = [
+                _Segment(start, min(start + step, size))
+                for start in range(0, size, step)
+            ]
+        self.cond = threading.Condition()
+        self.abort = threading.Event()
+        self.fd = None
+
+    def _resume_segments(self):
+        """Return the segments of an earlier download of the same file, or
+        None if there is nothing to continue."""
+        meta = _read_part_meta(self.meta_path)
+        if meta.get("url") != self.meta_url or \
+                meta.get("validator") != self.validator or \
+                meta.get("size") != self.size or not meta.get("segments"):
+            return None
+        try:
+            if os.path.getsize(self.part_path) != self.size:
+                return None
+        except OSError:
+            return None
+
+        segments = []
+        for start, end, done in meta["segments"]:
+            seg = _Segment(start, end)
+            seg.done = done
+            segments.append(seg)
+
+        self.resumed = True
+        done = sum(seg.done - seg.start for seg in segments)
+        log.info(
+            "Resuming download of '%s' at %.2fMB",
+            filename_from_url(self.url), done / 1024**2
+        )
+        return segments
+
+    def _save_progress(self):
+        with open(self.meta_path, "w") as fp:
+            json.dump({
+                "url": self.meta_url, "validator": self.validator,
+                "size": self.size, "segments": [
+                    [seg.start, seg.end, seg.done] for seg in self.segments
+                ]
+            }, fp)
+
+    def _fetch(self, seg):
+        attempt = 0
+        while seg.done < seg.end and not self.abort.is_set():
+            headers = {
+                "User-Agent": _USER_AGENT,
+                "Range": f"bytes={seg.done}-{seg.end - 1}",
+                "If-Range": self.validator,
+            }
+            try:
+                with requests.get(self.url, headers=headers, stream=True,
+                                  timeout=DOWNLOAD_TIMEOUT) as resp:
+                    resp.raise_for_status()
+                    content_range = resp.headers.get("Content-Range", "")
+                    if resp.status_code != 206 or \
+                            not content_range.startswith(f"bytes {seg.done}-"):
+                        raise ValueError(
+                            f"Server did not return the requested range, "
+                            f"the file may have changed: HTTP "
+                            f"{resp.status_code} {content_range}"
+                        )
+
+                    for chunk in resp.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        if self.abort.is_set():
+                            return
+                        chunk = chunk[:seg.end - seg.done]
+                        os.pwrite(self.fd, chunk, seg.done)
+                        with self.cond:
+                            seg.done += len(chunk)
+                            self.cond.notify_all()
+                        if seg.done >= seg.end:
+                            break
+
+                if seg.done < seg.end:
+                    raise requests.ConnectionError(
+                        f"Connection closed at {seg.done} of segment "
+                        f"{seg.start}-{seg.end}"
+                    )
+            except requests.RequestException as e:
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                log.debug(
+                    "Segment %d-%d of '%s' interrupted, retrying: %s",
+                    seg.start, seg.end, filename_from_url(self.url), e
+                )
+                time.sleep(DOWNLOAD_RETRY_DELAY)
+
+    def _failed(self, futures):
+        for future in futures:
+            if future.done() and future.exception():
+                return future.exception()
+        return None
+
+    def run(self):
+        """Returns the SHA-1 of the downloaded file. Raises the error of the
+        first segment that failed."""
+        flags = os.O_RDWR | os.O_CREAT
+        if not self.resumed:
+            flags |= os.O_TRUNC
+        self.fd = os.open(self.part_path, flags)
+        try:
+            if not self.resumed:
+                try:
+                    os.posix_fallocate(self.fd, 0, self.size)
+                except (AttributeError, OSError):
+                    os.ftruncate(self.fd, self.size)
+                self._save_progress()
+
+            with ThreadPoolExecutor(max_workers=len(self.segments)) as pool:
+                futures = [
+                    pool.submit(self._fetch, seg) for seg in self.segments
+                ]
+                try:
+                    return self._hash(futures)
+                finally:
+                    self.abort.set()
+        finally:
+            os.close(self.fd)
+            # The workers have stopped, so everything before done of each
+            # segment has been written.
+            if any(seg.done < seg.end for seg in self.segments):
+                self._save_progress()
+
+    def _hash(self, futures):
+        sha1_hash = hashlib.sha1()
+        pos = 0
+        for seg in self.segments:
+            while pos < seg.end:
+                with self.cond:
+                    while seg.done <= pos:
+                        error = self._failed(futures)
+                        if error:
+                            raise error
+                        self.cond.wait(0.5)
+                    available = seg.done
+
+                while pos < available:
+                    buf = os.pread(
+                        self.fd, min(DOWNLOAD_CHUNK_SIZE, available - pos), pos
+                    )
+                    sha1_hash.update(buf)
+                    pos += len(buf)
+
+        return sha1_hash.hexdigest()
+
+def _range_support(url):
+    """Return the final url, size and If-Range validator of the file at url
+    if the server supports range requests for it, or None."""
+    try:
+        resp = requests.head(
+            url, headers={"User-Agent": _USER_AGENT}, allow_redirects=True,
+            timeout=DOWNLOAD_TIMEOUT
+        )
+    except requests.RequestException:
+        return None
+
+    size = int(resp.headers.get("Content-Length") or 0)
+    validator = _part_validator(resp)
+    if resp.status_code != 200 or not size or not validator:
+        return None
+    return resp.url, size, validator
+
+def download_segmented(url, filepath, segments=DOWNLOAD_SEGMENTS,
+                       retries=DOWNLOAD_RETRIES):
+    """Download a large file over 'segments' connections at the same time.
+    Returns if the download succeeded and the SHA-1 of the file, or None if
+    the server does not support range requests or the file is smaller than
+    SEGMENT_MIN_SIZE. Use download_file for those. A failed download keeps
+    filepath.part, and is continued when called again for the same url if
+    the server still has the same ETag or Last-Modified."""
+    found = _range_support(url)
+    if not found or found[1] < SEGMENT_MIN_SIZE:
+        return None
+
+    final_url, size, validator = found
+    part_path = f"{filepath}.part"
+    meta_path = f"{filepath}.part.json"
     start = time.time()
-    sha1_hash = hashlib.sha1()
-    written = 0
     try:
-        with requests.get(url, headers=headers, stream=True) as resp:
-            resp.raise_for_status()
-            with open(filepath, "wb") as fp:
-                for chunk in resp.iter_content(chunk_size=2*1024*1024):
-                    written += fp.write(chunk)
-                    sha1_hash.update(chunk)
-    except requests.RequestException as e:
+        sha1 = _SegmentedDownload(
+            final_url, part_path, size, validator, segments, retries,
+            meta_path, url
+        ).run()
+    except (requests.RequestException, ValueError, OSError) as e:
         log.warning("Failed to download file from '%s', got error: %s", url, e)
         return False, None
 
+    os.replace(part_path, filepath)
+    try:
+        os.remove(meta_path)
+    except FileNotFoundError:
+        pass
+    elapsed = max(time.time() - start, 0.001)
+    log.debug(
+        "Successfully downloaded file '%s' (%.2fMB) in %.2f second(s) "
+        "(%.2fMB/s) over %d connections", filename_from_url(url),
+        size / 1024**2, elapsed, size / 1024**2 / elapsed, segments
+    )
+    return True, sha1
+
+def download_file(url, filepath, retries=DOWNLOAD_RETRIES, segments=1):
+    """Download the file from url and store it in the given filepath. The
+    data is written to filepath.part first. When the connection drops, the
+    download continues where it stopped using a Range request, also when
+    download_file is called again later for the same url. The server must
+    then still have the same ETag or Last-Modified. With segments, large
+    files are downloaded over that many connections, see
+    download_segmented. Returns if the download succeeded and the SHA-1 of
+    the file."""
+    part_path = f"{filepath}.part"
+    meta_path = f"{filepath}.part.json"
+    meta = _read_part_meta(meta_path)
+
+    # A part of an earlier single connection download is continued instead.
+    segmented = bool(meta.get("segments"))
+    if segments > 1 and (meta.get("url") != url or segmented):
+        result = download_segmented(url, filepath, segments, retries)
+        if result is not None:
+            return result
+
+    # A preallocated part of a segmented download cannot be appended to.
+    sha1_hash = hashlib.sha1()
+    offset = 0
+    if meta.get("url") == url and meta.get("validator") and \
+            not segmented and os.path.isfile(part_path):
+        # Continue the hash of the data that was already downloaded.
+        with open(part_path, "rb") as fp:
+            for chunk in iter(lambda: fp.read(DOWNLOAD_CHUNK_SIZE), b""):
+                sha1_hash.update(chunk)
+                offset += len(chunk)
+        if offset:
+            log.info(
+                "Resuming download of '%s' at %.2fMB",
+                filename_from_url(url), offset / 1024**2
+            )
+
+    start = time.time()
+    written = 0
+    attempt = 0
+    responded = False
+    validator = meta.get("validator")
+    while True:
+        headers = {"User-Agent": _USER_AGENT}
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+            headers["If-Range"] = validator
+
+        try:
+            with requests.get(url, headers=headers, stream=True,
+                              timeout=DOWNLOAD_TIMEOUT) as resp:
+                responded = True
+                if offset and resp.status_code == 416:
+                    # The part does not fit the file on the server anymore.
+                    offset = 0
+                    sha1_hash = hashlib.sha1()
+                    raise requests.HTTPError(
+                        "Range not satisfiable", response=resp
+                    )
+
+                resp.raise_for_status()
+                content_range = resp.headers.get("Content-Range", "")
+                if resp.status_code == 206 and \
+                        not content_range.startswith(f"bytes {offset}-"):
+                    offset = 0
+                    sha1_hash = hashlib.sha1()
+                    raise requests.ConnectionError(
+                        f"Unexpected range in response: {content_range}"
+                    )
+
+                if resp.status_code != 206:
+                    # A new download, or the file changed on the server or
+                    # the server does not support ranges. Start over.
+                    offset = 0
+                    sha1_hash = hashlib.sha1()
+                    validator = _part_validator(resp)
+                    with open(meta_path, "w") as fp:
+                        json.dump({"url": url, "validator": validator}, fp)
+
+                length = resp.headers.get("Content-Length")
+                expected = offset + int(length) if length else None
+                with open(part_path, "ab" if offset else "wb") as fp:
+                    for chunk in resp.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        fp.write(chunk)
+                        sha1_hash.update(chunk)
+                        offset += len(chunk)
+                        written += len(chunk)
+
+                if expected is not None and offset < expected:
+                    raise requests.ConnectionError(
+                        f"Connection closed after {offset} of {expected} "
+                        f"bytes"
+                    )
+            break
+        except requests.RequestException as e:
+            attempt += 1
+            client_error = isinstance(e, requests.HTTPError) and \
+                e.response is not None and \
+                400 <= e.response.status_code < 500 and \
+                e.response.status_code != 416
+            # A server that never answered is not retried, so the caller
+            # can move on to another mirror.
+            if client_error or not responded or attempt > retries:
+                log.warning(
+                    "Failed to download file from '%s', got error: %s", url, e
+                )
+                return False, None
+
+            if not validator:
+                offset = 0
+                sha1_hash = hashlib.sha1()
+            log.info(
+                "Download of '%s' interrupted at %.2fMB, retrying: %s",
+                filename_from_url(url), offset / 1024**2, e
+            )
+            time.sleep(DOWNLOAD_RETRY_DELAY)
+
+    os.replace(part_path, filepath)
+    try:
+        os.remove(meta_path)
+    except FileNotFoundError:
+        pass
+
+    elapsed = max(time.time() - start, 0.001)
     log.debug(
         "Successfully downloaded file '{}' ({:.2f}MB)' in "
         "'{:.2f}' second(s) ({:.2f}MB/s)".format(
             filename_from_url(url), written / 1024.**2.,
-            time.time() - start, written / (time.time() - start)
+            elapsed, written / 1024.**2. / elapsed
         )
     )
     return True, sha1_hash.hexdigest()
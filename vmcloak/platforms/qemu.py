@@ -2,16 +2,24 @@
 # This file is part of VMCloak - http://www.vmcloak.org/.
 # See the file 'docs/LICENSE.txt' for copying permission.
 
+import collections
+import itertools
+import json
 import logging
 import os.path
+import socket
 import subprocess
+import tempfile
+import threading
 import time
 import shutil
 from re import search
 from pkg_resources import parse_version
 
+from vmcloak.exceptions import QMPError
 from vmcloak.platforms import Machinery
-from vmcloak.repository import vms_path, IPNet
+from vmcloak import memstore, timing
+from vmcloak.repository import vms_path, memstore_path, IPNet
 from vmcloak.rand import random_vendor_mac
 from vmcloak.machineconf import MachineConfDump
 from vmcloak.ostype import get_os
@@ -21,11 +29,191 @@ name = "QEMU"
 disk_format = "qcow2"
 
 machines = {}
+monitors = {}
 confdumps = {}
+snapshot_options = {}
+fork_templates = {}
 
 default_net = IPNet("192.168.30.0/24")
 
-QEMU_AMD64 = ["qemu-system-x86_64", "-monitor", "stdio"]
+QEMU_AMD64 = ["qemu-system-x86_64"]
+
+class QMP:
+    """Client for the QEMU Machine Protocol socket of a running VM. Command
+    replies are matched to their command by id. Events are kept so callers
+    can wait for events that arrive after a certain point (see event_mark).
+    Events at or before a mark are dropped once it has been waited on and
+    no earlier mark is still in use."""
+
+    def __init__(self, path):
+        self.path = path
+        self.closed = False
+        self._sock = None
+        self._send_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._ids = itertools.count(1)
+        self._replies = {}
+        self._events = []
+        self._seq = 0
+        # Marks handed out by event_mark that have not been waited on, and
+        # the marks of running wait_event calls.
+        self._marks = collections.Counter()
+        self._waiting = collections.Counter()
+
+    def connect(self, timeout=30):
+        """Connect to the QMP socket and negotiate capabilities. QEMU creates
+        the socket shortly after starting, so retry until it is available."""
+        end = time.monotonic() + timeout
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                sock.close()
+                if time.monotonic() > end:
+                    raise QMPError(
+                        f"QMP socket {self.path} not available within "
+                        f"{timeout} second(s)"
+                    )
+                time.sleep(0.1)
+
+        self._sock = sock
+        fp = sock.makefile("rb")
+        greeting = fp.readline()
+        try:
+            if "QMP" not in json.loads(greeting):
+                raise ValueError
+        except ValueError:
+            sock.close()
+            raise QMPError(f"Unexpected QMP greeting: {greeting!r}")
+
+        threading.Thread(
+            target=self._read_loop, args=(fp,), daemon=True
+        ).start()
+        self.command("qmp_capabilities")
+
+    def _read_loop(self, fp):
+        try:
+            for line in fp:
+                try:
+                    msg = json.loads(line)
+                except ValueError:
+                    log.warning("Invalid QMP message: %r", line)
+                    continue
+
+                with self._cond:
+                    if "event" in msg:
+                        self._seq += 1
+                        self._events.append((self._seq, msg))
+                        log.debug("QMP event: %s", msg["event"])
+                    elif "id" in msg:
+                        self._replies[msg["id"]] = msg
+                    self._cond.notify_all()
+        except OSError:
+            pass
+        finally:
+            with self._cond:
+                self.closed = True
+                self._cond.notify_all()
+
+    def command(self, name, arguments=None, timeout=None):
+        """Execute a QMP command and wait for its reply. Returns the 'return'
+        value of the reply. Raises a QMPError if the command failed."""
+        if self.closed:
+            raise QMPError(f"Cannot execute '{name}', QMP connection closed")
+
+        cmd_id = next(self._ids)
+        msg = {"execute": name, "id": cmd_id}
+        if arguments:
+            msg["arguments"] = arguments
+
+        log.debug("QMP command: %s %s", name, arguments or "")
+        try:
+            with self._send_lock:
+                self._sock.sendall(json.dumps(msg).encode() + b"\n")
+        except OSError as e:
+            raise QMPError(f"Failed to send '{name}' to QMP socket. {e}")
+
+        with self._cond:
+            if not self._cond.wait_for(
+                lambda: cmd_id in self._replies or self.closed, timeout
+            ):
+                raise QMPError(f"No reply to '{name}' within {timeout}s")
+
+            reply = self._replies.pop(cmd_id, None)
+
+        if reply is None:
+            raise QMPError(f"QMP connection closed while executing '{name}'")
+
+        if "error" in reply:
+            raise QMPError(
+                f"'{name}' failed: {reply['error'].get('desc', reply)}"
+            )
+
+        return reply.get("return")
+
+    def event_mark(self):
+        """Return a marker that can be passed to wait_event to only wait for
+        events that arrive after this call."""
+        with self._cond:
+            self._marks[self._seq] += 1
+            return self._seq
+
+    def _release(self, after):
+        """Forget a mark that has been waited on and drop the events that
+        no mark still in use can return."""
+        self._waiting[after] -= 1
+        if not self._waiting[after]:
+            del self._waiting[after]
+        if self._marks[after] > 1:
+            self._marks[after] -= 1
+        else:
+            self._marks.pop(after, None)
+
+        floor = min([after] + list(self._marks) + list(self._waiting))
+        if self._events and self._events[0][0] <= floor:
+            self._events = [
+                (seq, event) for seq, event in self._events if seq > floor
+            ]
+
+    def wait_event(self, names, timeout=None, after=0, where=None):
+        """Wait for one of the given event names to arrive after the 'after'
+        marker. 'where' can be a callable that filters on the event data.
+        Returns the event or None on timeout or a closed connection."""
+        if isinstance(names, str):
+            names = (names,)
+
+        def find():
+            for seq, event in self._events:
+                if seq <= after or event["event"] not in names:
+                    continue
+                if where and not where(event.get("data", {})):
+                    continue
+                return event
+
+        with self._cond:
+            event = None
+
+            def ready():
+                nonlocal event
+                event = find()
+                return event is not None or self.closed
+
+            self._waiting[after] += 1
+            try:
+                self._cond.wait_for(ready, timeout)
+            finally:
+                self._release(after)
+            return event
+
+    def close(self):
+        if self._sock:
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._sock.close()
 
 def _create_image_disk(path, size):
     log.info("Creating disk %s with size %s", path, size)
@@ -119,7 +307,8 @@ def _make_args(attr, disk_placeholder=False, iso=None, display=None):
     return args
 
 
-def _create_vm(name, attr, iso_path=None, is_snapshot=False):
+def _create_vm(name, attr, iso_path=None, is_snapshot=False, incoming=None,
+               paused=False):
     log.info("Create VM instance for %s", name)
     if not os.path.exists(attr["path"]):
         # We assume the caller has already checked if existing files are a
@@ -160,11 +349,37 @@ def _create_vm(name, attr, iso_path=None, is_snapshot=False):
         port = attr["vrde"]
         args.extend(["-vnc", "0.0.0.0:%s" % port])
 
+    if incoming:
+        args.extend(["-incoming", incoming])
+    if paused:
+        args.append("-S")
+
+    # The QMP socket is used to control the VM and receive its events. It is
+    # placed in a short temporary path because unix socket paths are limited
+    # in length.
+    qmp_path = os.path.join(
+        tempfile.mkdtemp(prefix="vmcloak-qmp-"), "qmp.sock"
+    )
+    args.extend(["-qmp", f"unix:{qmp_path},server=on,wait=off"])
+
     log.debug("Execute: %s", " ".join(args))
-    m = subprocess.Popen(args, stdin=subprocess.PIPE)
+    m = subprocess.Popen(args, stdin=subprocess.DEVNULL)
     machines[name] = m
+
+    qmp = QMP(qmp_path)
+    try:
+        qmp.connect()
+    except QMPError:
+        m.kill()
+        _remove_qmp_socket(qmp)
+        raise
+    monitors[name] = qmp
     return m
 
+def _remove_qmp_socket(qmp):
+    qmp.close()
+    shutil.rmtree(os.path.dirname(qmp.path), ignore_errors=True)
+
 #
 # Platform API
 #
@@ -189,56 +404,439 @@ def create_new_image(name, _, iso_path, attr):
         raise ValueError("Image %s already exists" % attr["path"])
 
     m = _create_vm(name, attr, iso_path=iso_path)
-    m.wait()
+    try:
+        m.wait()
+    finally:
+        qmp = monitors.pop(name, None)
+        if qmp:
+            _remove_qmp_socket(qmp)
     if m.returncode != 0:
         raise ValueError(m.returncode)
 
-def create_snapshot_vm(image, name, attr):
+def _set_snapshot_options(name, attr):
+    snapshot_options[name] = {
+        "compressor": attr.get("compressor"),
+        "level": attr.get("compress_level"),
+        "threads": attr.get("compress_threads"),
+        "dedup": attr.get("dedup"),
+        "backend": attr.get("dump_backend"),
+        "channels": attr.get("dump_channels"),
+    }
+
+def _start_unplugged(name):
+    """Disconnect the network of a paused VM and start it."""
+    qmp = monitors[name]
+    qmp.command("set_link", {"name": "net0", "up": False})
+    qmp.command("cont")
+
+def set_link(name, up):
+    """Connect or disconnect the network cable of a running VM."""
+    monitors[name].command("set_link", {"name": "net0", "up": up})
+
+def create_snapshot_vm(image, name, attr, link_down=False):
+    """Boot a new snapshot VM. With link_down, it boots without network
+    until set_link is called. VMs that boot with the IP of the image can
+    then boot at the same time."""
     if os.path.exists(attr["path"]):
         raise ValueError("Snapshot %s already exists" % attr["path"])
 
-    _create_vm(name, attr, is_snapshot=True)
+    _set_snapshot_options(name, attr)
+    _create_vm(name, attr, is_snapshot=True, paused=link_down)
+    if link_down:
+        _start_unplugged(name)
 
-_DECOMPRESS_BINARIES = {
-    "lz4": shutil.which("lz4"),
-    "gzip": shutil.which("gzip")
-}
+def create_fork_template(image, name, attr):
+    """Boot the VM that snapshots will be forked from. It is a regular
+    snapshot VM until save_fork_template is called."""
+    create_snapshot_vm(image, name, attr)
 
-_DECOMPRESS_COMMANDS = {
-    "lz4": "-z > %SNAPSHOT_PATH%",
-    "gzip": "-c -3 > %SNAPSHOT_PATH%"
+def save_fork_template(name):
+    """Dump the memory of the fork template VM and stop it. Its disk and
+    memory can then be used by create_fork_vm."""
+    vm_dir = _get_vm_dir(name)
+    compressor = pick_compressor()
+    memory_path = os.path.join(vm_dir, MEMORY_SNAPSHOT_NAME)
+    _dump_memory(name, f"exec:{compress_command(compressor, memory_path)}")
+    snapshot_options.pop(name, None)
+    confdumps.pop(name, None)
+    fork_templates[name] = {
+        "disk": os.path.join(vm_dir, f"disk.{disk_format}"),
+        "memory": memory_path,
+        "compressor": compressor,
+    }
+
+def create_fork_vm(template, name, attr, timeout=600, link_down=False):
+    """Create a snapshot VM by resuming the saved fork template. The disk of
+    the template is copied, so the new disk is backed by the image like any
+    other snapshot disk. Returns when the VM is running. With link_down, it
+    runs without network until set_link is called."""
+    if os.path.exists(attr["path"]):
+        raise ValueError("Snapshot %s already exists" % attr["path"])
+
+    t = fork_templates[template]
+    log.info("Creating snapshot %s from fork template %s", name, template)
+    shutil.copy(t["disk"], attr["path"])
+    _set_snapshot_options(name, attr)
+    incoming = f"exec:{decompress_command(t['compressor'], t['memory'])}"
+    _create_vm(
+        name, attr, is_snapshot=True, incoming=incoming, paused=link_down
+    )
+
+    qmp = monitors[name]
+    if link_down:
+        # The VM stays paused once the memory is loaded.
+        end = time.monotonic() + timeout
+        while qmp.command("query-status")["status"] == "inmigrate":
+            if time.monotonic() > end:
+                raise ValueError(
+                    f"VM {name} did not load fork template {template}"
+                )
+            time.sleep(0.1)
+        _start_unplugged(name)
+        return
+
+    mark = qmp.event_mark()
+    if qmp.command("query-status")["status"] == "running":
+        return
+
+    if not qmp.wait_event("RESUME", timeout, after=mark):
+        raise ValueError(
+            f"VM {name} did not resume from fork template {template}"
+        )
+
+def remove_fork_template(name):
+    remove_vm_data(name)
+    fork_templates.pop(name, None)
+    shutil.rmtree(_get_vm_dir(name), ignore_errors=True)
+
+# Compressors for memory snapshots. The compress command reads the migration
+# stream from stdin. The decompress command writes the stream to stdout.
+COMPRESSORS = {
+    "zstd": {
+        "binary": "zstd",
+        "format": "zstd",
+        "level": 3,
+        "bench_levels": (1, 3, 6),
+        "compress": "-q -T%THREADS% -%LEVEL% -c > %SNAPSHOT_PATH%",
+        "decompress": "-q -d -c %SNAPSHOT_PATH%",
+    },
+    "lz4": {
+        "binary": "lz4",
+        "format": "lz4",
+        "level": 1,
+        "bench_levels": (1, 3),
+        "compress": "-z -%LEVEL% > %SNAPSHOT_PATH%",
+        "decompress": "-d -c %SNAPSHOT_PATH%",
+    },
+    "pigz": {
+        "binary": "pigz",
+        "format": "gzip",
+        "level": 3,
+        "bench_levels": (1, 3, 6),
+        "compress": "-p %THREADS% -%LEVEL% -c > %SNAPSHOT_PATH%",
+        "decompress": "-d -c %SNAPSHOT_PATH%",
+    },
+    "gzip": {
+        "binary": "gzip",
+        "format": "gzip",
+        "level": 3,
+        "bench_levels": (1, 3, 6),
+        "compress": "-c -%LEVEL% > %SNAPSHOT_PATH%",
+        "decompress": "-d -c %SNAPSHOT_PATH%",
+    },
+    "none": {
+        "binary": "cat",
+        "format": "none",
+        "level": None,
+        "compress": "> %SNAPSHOT_PATH%",
+        "decompress": "%SNAPSHOT_PATH%",
+    },
 }
 
-def _get_exec_args(memsnapshot_path):
-    for tool in ("lz4", "gzip"):
-        binary = _DECOMPRESS_BINARIES.get(tool)
-        if binary:
-            args = _DECOMPRESS_COMMANDS[tool].replace(
-                "%SNAPSHOT_PATH%", memsnapshot_path
+# The order in which compressors are picked if none is chosen. These produce
+# the formats older snapshots were made with, so zstd must be chosen
+# explicitly.
+_DEFAULT_COMPRESSORS = ("lz4", "pigz", "gzip", "none")
+
+def available_compressors():
+    """Return the names of the compressors that are installed."""
+    return [
+        name for name, c in COMPRESSORS.items() if shutil.which(c["binary"])
+    ]
+
+def pick_compressor(name=None):
+    """Return the name of the given compressor if it is installed or of the
+    first installed default compressor if no name is given."""
+    available = available_compressors()
+    if name and name != "auto":
+        if name not in COMPRESSORS:
+            raise KeyError(f"Unknown compressor: {name}")
+        if name not in available:
+            raise KeyError(
+                f"Compressor '{name}' not found. Is "
+                f"'{COMPRESSORS[name]['binary']}' installed?"
             )
-            return f"{binary} {args}"
+        return name
+
+    for name in _DEFAULT_COMPRESSORS:
+        if name in available:
+            return name
+
+def _compressor_command(name, action, path, level=None, threads=None):
+    c = COMPRESSORS[name]
+    if level is None:
+        level = c["level"]
+    if not threads:
+        threads = os.cpu_count() or 1
+
+    args = c[action].replace("%SNAPSHOT_PATH%", path)
+    args = args.replace("%LEVEL%", str(level))
+    args = args.replace("%THREADS%", str(threads))
+    return f"{shutil.which(c['binary'])} {args}"
+
+def compress_command(name, path, level=None, threads=None):
+    """Return the shell command that compresses stdin to path."""
+    return _compressor_command(name, "compress", path, level, threads)
+
+def decompress_command(name, path):
+    """Return the shell command that writes the decompressed path to stdout.
+    """
+    return _compressor_command(name, "decompress", path)
+
+def _bench_threads():
+    """Thread counts tried for multi-threaded compressors."""
+    cpus = os.cpu_count() or 1
+    return sorted(set((1, max(1, cpus // 2), cpus)))
+
+def _benchmark_command(cmd, sample_path, out_path, size):
+    """Run a compress command on (the first size bytes of) the sample.
+    Returns the exit code, seconds, bytes read and bytes written."""
+    start = time.monotonic()
+    read = 0
+    with open(sample_path, "rb") as fp:
+        p = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE)
+        try:
+            while size is None or read < size:
+                chunk_size = 8 * 1024 * 1024
+                if size is not None:
+                    chunk_size = min(chunk_size, size - read)
+
+                buf = fp.read(chunk_size)
+                if not buf:
+                    break
+                p.stdin.write(buf)
+                read += len(buf)
+        finally:
+            p.stdin.close()
+            p.wait()
+
+    try:
+        with open(out_path, "rb") as fp:
+            os.fsync(fp.fileno())
+        elapsed = time.monotonic() - start
+        written = os.path.getsize(out_path)
+    finally:
+        if os.path.exists(out_path):
+            os.remove(out_path)
+    return p.returncode, elapsed, read, written
+
+def benchmark_compressors(sample_path, outdir, size=None, names=None,
+                          levels=None, threads=None):
+    """Compress (the first size bytes of) the sample RAM dump with each
+    installed compressor, writing the result to outdir. The output is synced
+    so the disk speed is part of the result. Every compressor is tried with
+    a few levels (or the given levels) and, if it is multi-threaded, with a
+    few thread counts (or the given counts). Returns a list of dicts with
+    the compressor name, level, threads, seconds and output size."""
+    results = []
+    for name in names or available_compressors():
+        c = COMPRESSORS[name]
+        out_path = os.path.join(outdir, f".bench-{name}.snapshot")
+        # Compressors without levels or threads are only run once.
+        bench_levels = (None,)
+        if c["level"] is not None:
+            bench_levels = levels or c["bench_levels"]
+        bench_threads = (None,)
+        if "%THREADS%" in c["compress"]:
+            bench_threads = threads or _bench_threads()
+
+        for level, thread_count in itertools.product(
+                bench_levels, bench_threads):
+            cmd = compress_command(name, out_path, level, thread_count)
+            log.debug("Benchmarking compressor: %s", cmd)
+            returncode, elapsed, read, written = _benchmark_command(
+                cmd, sample_path, out_path, size
+            )
+            if returncode != 0:
+                log.warning(f"Compressor {name} exited with {returncode}")
+                continue
 
-    return f"/bin/cat > {memsnapshot_path}"
+            results.append({
+                "compressor": name, "level": level, "threads": thread_count,
+                "seconds": elapsed, "input": read, "output": written
+            })
 
+    return results
 
 MEMORY_SNAPSHOT_NAME = "memory.snapshot"
-def create_snapshot(name):
-    m = machines[name]
-    snapshot_path = os.path.join(_get_vm_dir(name), MEMORY_SNAPSHOT_NAME)
-    confdumps[name].add_machine_field("memory_snapshot", MEMORY_SNAPSHOT_NAME)
+
+# QEMU limits the migration bandwidth to 128MiB/s by default. The VM is
+# stopped during a memory snapshot, so it should not be limited at all.
+MAX_BANDWIDTH = 1024**4
+
+# File migration with mapped-ram requires QEMU 9.0. It writes each RAM page
+# at a fixed offset, which allows multifd channels to write in parallel.
+FILE_DUMP_VERSION = "9.0"
+FILE_DUMP_CAPABILITIES = ("mapped-ram", "multifd")
+def _migration_done(data):
+    return data.get("status") in ("completed", "failed", "cancelled")
+
+def _quit(name):
+    """Ask QEMU to exit and wait for the process to end."""
+    try:
+        monitors[name].command("quit")
+    except QMPError:
+        # QEMU may close the connection before the reply is sent.
+        pass
+    machines[name].wait()
+
+def file_dump_supported():
+    """Return True if QEMU can migrate to a file with a fixed-offset
+    (mapped-ram) layout and multiple channels."""
+    try:
+        return version() >= parse_version(FILE_DUMP_VERSION)
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        return False
+
+def pick_dump_backend(name=None):
+    """Return the memory dump backend to use. 'exec' pipes a single migration
+    stream through a compressor. 'file' makes QEMU write a mapped-ram file
+    using multiple channels. 'auto' or None picks 'file' if QEMU supports it.
+    Raises KeyError if the backend is unknown or not supported."""
+    if name in (None, "auto"):
+        return "file" if file_dump_supported() else "exec"
+
+    if name not in ("exec", "file"):
+        raise KeyError(f"Unknown dump backend: {name}")
+
+    if name == "file" and not file_dump_supported():
+        raise KeyError(
+            f"Dump backend 'file' requires QEMU {FILE_DUMP_VERSION} or newer"
+        )
+
+    return name
+
+def _default_channels():
+    return min(os.cpu_count() or 1, 8)
+
+def _dump_memory(name, uri, capabilities=(), parameters=None):
+    """Stop the VM, migrate its memory to uri and quit."""
+    qmp = monitors[name]
     # Stop the machine so the memory does not change while making the
     # memory snapshot.
-    m.stdin.write(b"stop\n")
-    m.stdin.write(b"migrate_set_speed 1G\n")
-    # Send the actual memory snapshot command. The args helper tries to find
-    # lz4 of gzip binaries so we can compress the dump.
-    m.stdin.write(
-        f"migrate \"exec:{_get_exec_args(snapshot_path)}\"\n".encode()
+    qmp.command("stop")
+    qmp.command("migrate-set-capabilities", {
+        "capabilities": [
+            {"capability": capability, "state": True}
+            for capability in ("events",) + tuple(capabilities)
+        ]
+    })
+    qmp.command("migrate-set-parameters", {
+        "max-bandwidth": MAX_BANDWIDTH, **(parameters or {})
+    })
+    # Send the actual memory snapshot command. The migration stream is piped
+    # through the chosen compressor or into the chunk store, or written to a
+    # file by QEMU itself.
+    mark = qmp.event_mark()
+    qmp.command("migrate", {"uri": uri})
+    event = qmp.wait_event("MIGRATION", after=mark, where=_migration_done)
+    if not event or event["data"]["status"] != "completed":
+        _quit(name)
+        raise ValueError(
+            f"Memory snapshot of {name} failed: "
+            f"{event['data']['status'] if event else 'QEMU exited'}"
+        )
+
+    log.debug("Memory snapshot of %s completed", name)
+    _quit(name)
+
+def _add_memstore_fields(name):
+    confdumps[name].add_machine_field(
+        "memory_snapshot", memstore.MANIFEST_NAME
+    )
+    confdumps[name].add_machine_field("memory_snapshot_compression", {
+        "compressor": "memstore", "format": "memstore", "level": None
+    })
+    confdumps[name].add_machine_field("memory_snapshot_store", memstore_path)
+
+def _create_file_snapshot(name, options):
+    vm_dir = _get_vm_dir(name)
+    snapshot_path = os.path.join(vm_dir, MEMORY_SNAPSHOT_NAME)
+    channels = options.get("channels") or _default_channels()
+    # The same capabilities must be set on the restoring side.
+    confdumps[name].add_machine_field("memory_snapshot_migration", {
+        "transport": "file",
+        "capabilities": list(FILE_DUMP_CAPABILITIES),
+        "multifd-channels": channels
+    })
+    _dump_memory(
+        name, f"file:{snapshot_path}", FILE_DUMP_CAPABILITIES,
+        {"multifd-channels": channels}
+    )
+
+    confdumps[name].add_machine_field("memory_snapshot", MEMORY_SNAPSHOT_NAME)
+    confdumps[name].add_machine_field("memory_snapshot_compression", {
+        "compressor": "none", "format": "none", "level": None
+    })
+    return os.path.getsize(snapshot_path)
+
+def create_snapshot(name):
+    options = snapshot_options.pop(name, {})
+    with timing.span("memory_dump", name) as s:
+        if options.get("dedup"):
+            s.size = _create_memstore_snapshot(name)
+        elif options.get("backend") == "file":
+            s.size = _create_file_snapshot(name, options)
+        else:
+            s.size = _create_exec_snapshot(name, options)
+
+def _create_exec_snapshot(name, options):
+    confdumps[name].add_machine_field("memory_snapshot_migration", {
+        "transport": "exec", "capabilities": [], "multifd-channels": None
+    })
+    snapshot_path = os.path.join(_get_vm_dir(name), MEMORY_SNAPSHOT_NAME)
+    compressor = pick_compressor(options.get("compressor"))
+    level = options.get("level")
+    if level is None:
+        level = COMPRESSORS[compressor]["level"]
+
+    exec_args = compress_command(
+        compressor, snapshot_path, level, options.get("threads")
     )
-    m.stdin.write(b"quit\n")
-    log.debug("Flushing snapshot commands to qemu.")
-    m.stdin.flush()
-    m.wait()
+    confdumps[name].add_machine_field("memory_snapshot", MEMORY_SNAPSHOT_NAME)
+    confdumps[name].add_machine_field("memory_snapshot_compression", {
+        "compressor": compressor,
+        "format": COMPRESSORS[compressor]["format"],
+        "level": level
+    })
+
+    _dump_memory(name, f"exec:{exec_args}")
+    return os.path.getsize(snapshot_path)
+
+def _create_memstore_snapshot(name):
+    confdumps[name].add_machine_field("memory_snapshot_migration", {
+        "transport": "exec", "capabilities": [], "multifd-channels": None
+    })
+    # The migration stream is chunked and compressed by the store as it
+    # arrives, so the full dump is never written to disk.
+    manifest_path = os.path.join(_get_vm_dir(name), memstore.MANIFEST_NAME)
+    exec_args = memstore.store_command(memstore_path, manifest_path)
+    _add_memstore_fields(name)
+
+    _dump_memory(name, f"exec:{exec_args}")
+    # Only the new chunks and the manifest take up space.
+    written = memstore.read_manifest(manifest_path)["written"]
+    return written + os.path.getsize(manifest_path)
 
 def create_machineinfo_dump(name, image):
     confdump = confdumps[name]
@@ -255,6 +853,10 @@ def start_image_vm(image, user_attr=None):
 
 def remove_vm_data(name):
     """Remove VM definitions and snapshots but keep disk image intact"""
+    qmp = monitors.pop(name, None)
+    if qmp:
+        _remove_qmp_socket(qmp)
+
     m = machines.get(name)
     if m:
         log.info("Cleanup VM %s", name)
@@ -270,20 +872,41 @@ def remove_vm_data(name):
         os.remove(path)
 
 def wait_for_shutdown(name, timeout=None):
-    # TODO: timeout
     m = machines.get(name)
-    end = None
-    if timeout:
-        end = time.time() + timeout
-    while True:
-        m.poll()
-        if m.returncode is not None:
-            if m.returncode == 0:
-                return True
-            raise ValueError(f"Non-zero exit code: {m.returncode}")
-        if end and time.time() > end:
-            raise ValueError("Timeout")
-        time.sleep(1)
+    qmp = monitors.get(name)
+    end = time.monotonic() + timeout if timeout else None
+    if qmp:
+        # Returns on the SHUTDOWN event or when QEMU closes the socket.
+        event = qmp.wait_event("SHUTDOWN", timeout=timeout)
+        if event:
+            log.debug(
+                "VM %s shut down: %s", name, event["data"].get("reason")
+            )
+
+    try:
+        m.wait(timeout=max(0, end - time.monotonic()) if end else None)
+    except subprocess.TimeoutExpired:
+        raise ValueError("Timeout")
+
+    if m.returncode == 0:
+        return True
+    raise ValueError(f"Non-zero exit code: {m.returncode}")
+
+def reset_waiter(name):
+    """Return a callable that waits up to the given timeout for the guest to
+    reset or shut down after this call was made. Returns True if it did.
+    Must be called before the reboot is requested."""
+    qmp = monitors.get(name)
+    if not qmp:
+        return None
+
+    mark = qmp.event_mark()
+
+    def wait(timeout):
+        event = qmp.wait_event(("RESET", "SHUTDOWN"), timeout, after=mark)
+        return event is not None
+
+    return wait
 
 def clone_disk(image, target):
     log.info("Cloning disk %s to %s", image.path, target)
@@ -325,20 +948,21 @@ def version():
 
 class VM(Machinery):
     def attach_iso(self, iso_path):
-        m = machines.get(self.name)
-        if not m:
+        qmp = monitors.get(self.name)
+        if not qmp:
             raise KeyError(
-                "Cannot attach ISO to machine. Process handle not available."
+                "Cannot attach ISO to machine. QMP connection not available."
             )
 
-        m.stdin.write(f"change cdrom {iso_path}\n".encode())
-        m.stdin.flush()
+        qmp.command("blockdev-change-medium", {
+            "device": "cdrom", "filename": iso_path, "format": "raw"
+        })
 
     def detach_iso(self):
-        m = machines.get(self.name)
-        if not m:
+        qmp = monitors.get(self.name)
+        if not qmp:
             raise KeyError(
-                "Cannot attach ISO to machine. Process handle not available."
+                "Cannot detach ISO from machine. QMP connection not "
+                "available."
             )
-        m.stdin.write(b"eject cdrom\n")
-        m.stdin.flush()
+        qmp.command("eject", {"device": "cdrom", "force": True})
@@ -9,19 +9,20 @@ from json import load
 from os.path import join, exists
 from sys import modules
 
-from sqlalchemy import Integer, Text, String, inspect
+from sqlalchemy import Integer, Text, String, Float, Boolean, inspect
 from sqlalchemy import create_engine, Column, ForeignKey
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import sessionmaker, relationship, reconstructor
 
-SCHEMA_VERSION = "d6c5bf858df1"
+SCHEMA_VERSION = "8e3f2a6b1c47"
 
 conf_path = os.path.join(os.getenv("HOME"), ".vmcloak")
 image_path = os.path.join(conf_path, "image")
 vms_path = os.path.join(conf_path, "vms")
 deps_path = os.path.join(conf_path, "deps")
 iso_dst_path = os.path.join(conf_path, "iso")
+memstore_path = os.path.join(conf_path, "memstore")
 
 repository = join(conf_path, "repository.db")
 engine = create_engine("sqlite:///%s" % repository)
@@ -171,6 +172,22 @@ class Snapshot(Base):
     def VM(self):
         return platform(self.image.vm).VM(self.vmname)
 
+class Timing(Base):
+    """The duration of a single phase of image or snapshot creation."""
+    __tablename__ = "timing"
+
+    id = Column(Integer, primary_key=True)
+    phase = Column(String(32), nullable=False)
+    # The image or VM name.
+    subject = Column(String(64))
+    # Details such as the dependency name and version.
+    detail = Column(String(64))
+    started = Column(Float, nullable=False)
+    duration = Column(Float, nullable=False)
+    # The amount of bytes produced, such as the memory snapshot size.
+    size = Column(Integer)
+    success = Column(Boolean, nullable=False)
+
 if not os.path.isdir(conf_path):
     os.mkdir(conf_path)
 
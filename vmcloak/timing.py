@@ -0,0 +1,141 @@
+# Copyright (C) 2026 Hatching B.V.
+# This file is part of VMCloak - http://www.vmcloak.org/.
+# See the file 'docs/LICENSE.txt' for copying permission.
+
+"""Timing of the phases of image and snapshot creation.
+
+Each phase is wrapped in a span. When the span ends, its duration is stored
+in the timing table of the repository, so 'vmcloak stats' can show where the
+time goes across runs:
+
+    with span("memory_dump", vmname) as s:
+        ...
+        s.size = os.path.getsize(path)
+"""
+
+import logging
+import time
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from vmcloak.repository import Session, Timing
+
+log = logging.getLogger(__name__)
+
+class Span(object):
+    def __init__(self, phase, subject=None, detail=None):
+        self.phase = phase
+        self.subject = subject
+        self.detail = detail
+        self.size = None
+        self.started = None
+        self.duration = None
+        self.success = False
+        self._start = None
+
+    def __enter__(self):
+        self.started = time.time()
+        self._start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.duration = time.monotonic() - self._start
+        self.success = exc_type is None
+        log.debug(
+            "%s%s took %.1fs%s", self.phase,
+            f" of {self.subject}" if self.subject else "", self.duration,
+            "" if self.success else " (failed)"
+        )
+        record(self)
+        return False
+
+def span(phase, subject=None, detail=None):
+    """Return a span that records the duration of the with block. Set the
+    size attribute to also record the amount of bytes produced."""
+    return Span(phase, subject, detail)
+
+def record(s):
+    """Store a finished span. A failure to store it is not fatal."""
+    ses = Session()
+    try:
+        ses.add(Timing(
+            phase=s.phase, subject=s.subject, detail=s.detail,
+            started=s.started, duration=s.duration, size=s.size,
+            success=s.success
+        ))
+        ses.commit()
+    except SQLAlchemyError as e:
+        log.debug("Could not store timing of %s: %s", s.phase, e)
+        ses.rollback()
+    finally:
+        ses.close()
+
+def load(phase=None, since=None):
+    """Return the stored timings, optionally of a single phase and started
+    after the since timestamp."""
+    ses = Session()
+    try:
+        query = ses.query(Timing)
+        if phase:
+            query = query.filter_by(phase=phase)
+        if since:
+            query = query.filter(Timing.started >= since)
+        return query.order_by(Timing.started).all()
+    finally:
+        ses.close()
+
+def expected(phase, samples=20):
+    """Return the median duration of the last successful spans of a phase,
+    or None if there are none."""
+    ses = Session()
+    try:
+        durations = [
+            t.duration for t in ses.query(Timing.duration)
+            .filter_by(phase=phase, success=True)
+            .order_by(Timing.started.desc()).limit(samples)
+        ]
+    except SQLAlchemyError as e:
+        log.debug("Could not read timings of %s: %s", phase, e)
+        return None
+    finally:
+        ses.close()
+
+    return percentile(durations, 50)
+
+def percentile(values, pct):
+    """Return the pct percentile of the values, interpolating between the
+    two closest ranks."""
+    if not values:
+        return None
+
+    values = sorted(values)
+    k = (len(values) - 1) * pct / 100
+    low = int(k)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (k - low)
+
+def summarize(timings, key=lambda t: t.phase):
+    """Group the timings by key and return a list of dicts with the amount,
+    failures, total and duration percentiles of each group. Only successful
+    spans count towards the percentiles."""
+    groups = {}
+    for t in timings:
+        groups.setdefault(key(t), []).append(t)
+
+    rows = []
+    for name, group in sorted(groups.items(), key=lambda g: str(g[0])):
+        durations = [t.duration for t in group if t.success]
+        sizes = [t.size for t in group if t.success and t.size]
+        rows.append({
+            "name": name,
+            "count": len(group),
+            "failed": len(group) - len(durations),
+            "total": sum(durations),
+            "p50": percentile(durations, 50),
+            "p90": percentile(durations, 90),
+            "p99": percentile(durations, 99),
+            "max": max(durations) if durations else None,
+            "size_p50": percentile(sizes, 50),
+        })
+
+    return rows
@@ -19,6 +19,7 @@ class WindowsXP(OperatingSystem):
     mount = "/mnt/winxp"
     nictype = "Am79C973"
     osdir = os.path.join("$oem$", "$1")
+    iso_edit_files = [os.path.join("i386", "winnt.sif")]
     genisoargs = [
         "-no-emul-boot", "-boot-load-seg", "1984", "-boot-load-size", "4",
         "-iso-level", "2", "-J", "-l", "-D", "-N", "-joliet-long",